@@ -5,6 +5,7 @@ from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 import time
 import sys
+import threading
 import os
 from dotenv import load_dotenv
 
@@ -19,6 +20,9 @@ sys.path.insert(0, project_root)
 from api.routes import chat_routes, db_routes, read_routes, ppt_routes, kb_routes, write_routes, log_routes, mastery_routes, skill_routes, auth_routes, qa_routes, write_v3_routes, copilot_routes
 # 数据库初始化
 from src.db import init_db
+from src.jobs import job_manager
+from src.pdf_extract import shutdown_pool as shutdown_pdf_pool
+from src.tokenizer import preload as preload_tokenizer, shutdown_pool as shutdown_tokenize_pool
 from fastapi.staticfiles import StaticFiles
 
 # 创建 FastAPI 应用
@@ -109,6 +113,16 @@ async def startup_event():
     except Exception as e:
         print(f"❌ 数据库初始化失败: {e}")
 
+    # 启动知识库后台任务队列 (回收上次中断的任务)
+    try:
+        job_manager.start()
+        print("✅ 后台任务队列已启动")
+    except Exception as e:
+        print(f"❌ 后台任务队列启动失败: {e}")
+
+    # 后台预加载 jieba 词典，第一次 BM25 检索不再等待懒加载 (约 1 秒)
+    threading.Thread(target=preload_tokenizer, daemon=True).start()
+
     print("🚀 RAG Agent API 启动成功!")
     print("📌 API 文档：http://localhost:8000/docs")
     print("📌 ReDoc: http://localhost:8000/redoc")
@@ -118,6 +132,9 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     """应用关闭时的清理工作"""
+    job_manager.stop()
+    shutdown_pdf_pool()
+    shutdown_tokenize_pool()
     print("👋 RAG Agent API 已关闭")
 
 if __name__ == "__main__":
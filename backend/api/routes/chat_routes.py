@@ -6,6 +6,8 @@ from fastapi import APIRouter, HTTPException, Query
 from fastapi.responses import StreamingResponse
 import json
 
+from src.metadata_filter import parse_filter
+
 # 模块级延迟导入，避免循环引用
 chat_graph = None
 
@@ -30,7 +32,8 @@ async def chat_stream(request: dict):
         "query": "用户问题",
         "session_id": "会话 ID (可选)",
         "kb_ids": [1, 2, 3] (可选，使用的知识库 ID 列表),
-        "mode": "chat|deep_qa" (可选，对话模式)
+        "mode": "chat|deep_qa" (可选，对话模式),
+        "kb_filter": {"source": "2023年报.pdf"} (可选，检索前的元数据过滤，字段 source/page/language/ingested_at)
     }
     ```
     
@@ -48,6 +51,10 @@ async def chat_stream(request: dict):
     
     if not query:
         raise HTTPException(status_code=400, detail="Missing required field: query")
+    try:
+        parse_filter(request.get("kb_filter"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"kb_filter 不合法：{str(e)}")
     
     # 构造初始状态 (参考原 chat.py 逻辑)
     initial_state = {
@@ -56,6 +63,7 @@ async def chat_stream(request: dict):
         "session_id": session_id,
         "kb_ids": kb_ids,
         "mode": mode,
+        "kb_filter": request.get("kb_filter"),
     }
     
     async def event_generator():
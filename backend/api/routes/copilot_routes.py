@@ -1,11 +1,10 @@
+import asyncio
 import json
 import re
-from io import BytesIO
 from typing import Any, Dict, Optional
 
 from fastapi import APIRouter, File, HTTPException, UploadFile
 from fastapi.responses import Response, StreamingResponse
-from pypdf import PdfReader
 from pydantic import BaseModel, Field
 
 from src.db import (
@@ -20,6 +19,7 @@ from src.db import (
 from src.graphs.copilot_graph import copilot_chat_graph, copilot_init_graph, load_session_meta
 from src.logger import get_logger
 from src.nodes.common import get_llm
+from src.pdf_extract import extract_pdf_pages_from_bytes
 
 
 logger = get_logger("CopilotRoutes")
@@ -253,18 +253,13 @@ async def init_copilot_from_text(raw_text: str):
 
 def extract_pdf_text(file_bytes: bytes) -> Dict[str, Any]:
     try:
-        reader = PdfReader(BytesIO(file_bytes))
-        pages = []
-        for index, page in enumerate(reader.pages):
-            text = (page.extract_text() or "").strip()
-            if not text:
-                continue
-            pages.append(text)
+        all_pages = extract_pdf_pages_from_bytes(file_bytes)
+        pages = [text.strip() for text in all_pages if text.strip()]
 
         full_text = "\n\n".join(pages).strip()
         return {
             "text": full_text,
-            "page_count": len(reader.pages),
+            "page_count": len(all_pages),
             "non_empty_pages": len(pages),
         }
     except Exception as e:
@@ -294,7 +289,7 @@ async def init_copilot_pdf(file: UploadFile = File(...)):
         if not content:
             raise HTTPException(status_code=400, detail="PDF 文件为空")
 
-        parsed = extract_pdf_text(content)
+        parsed = await asyncio.to_thread(extract_pdf_text, content)
         if not parsed["text"]:
             raise HTTPException(status_code=400, detail="PDF 中未提取到可读文本")
 
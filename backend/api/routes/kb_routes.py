@@ -2,36 +2,59 @@
 知识库管理相关 API 路由
 提供知识库列表、删除、文件上传并向量化等功能
 """
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException
-from typing import List
-import tempfile
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from typing import List, Optional
+import asyncio
+import json
 import os
-
-from langchain_core.documents import Document
-from pypdf import PdfReader
+import shutil
 
 from src.storage import (
     list_kbs,
     delete_kb,
-    save_kb,
     get_kb_details,
     get_kb_documents,
     search_kb_chunks,
-    resume_kb_embedding,
     get_chunk_vector
 )
-from src.utils import split_documents
+from src.kb_cache import kb_cache
+from src.embedding_cache import embedding_cache
+from src.query_embedding import query_embedder
+from src.retrieval_cache import retrieval_cache
+from src.pdf_extract import pdf_text_cache
+from src.concurrency import controller_stats
+from src.jobs import TERMINAL_STATUSES, job_manager, new_upload_dir
+from src.tokenizer import TOKENIZER_MODES
+from src.vector_index import INDEX_TYPES
 
 router = APIRouter()
 
+# 上传文件落盘时每次读取的块大小
+UPLOAD_READ_BLOCK = 1024 * 1024
+# append 追加 / new 重建整个知识库 / replace 按文档名替换同名文档
+UPLOAD_MODES = ("append", "new", "replace")
+# 可指定的向量索引类型，auto 按规模自动选择
+INDEX_CHOICES = INDEX_TYPES + ("auto",)
+
+
+def _check_index_type(index_type: Optional[str]):
+    """index_type 不在可选范围内时返回 400，而不是等后台任务失败。"""
+    if index_type and index_type not in INDEX_CHOICES:
+        raise HTTPException(status_code=400, detail=f"index_type 必须是 {' / '.join(INDEX_CHOICES)}")
+
+
 @router.post("/{kb_name}/resume", summary="断点续传/修复知识库索引")
-async def resume_kb(kb_name: str):
+async def resume_kb(kb_name: str, index_type: Optional[str] = None):
     """
     当健康度检查发现 mismatch 或 corrupted 时，调用此接口触发断点续传或修复。
+    index_type: 可选 flat / ivf_flat / hnsw / ivf_pq / auto，完成后将索引转换为该类型
+    续传在后台任务中执行，立即返回 job_id，进度通过 /api/kb/jobs/{job_id} 查询。
     """
+    _check_index_type(index_type)
     try:
-        current, total = resume_kb_embedding(kb_name)
-        return {"status": "success", "current": current, "total": total}
+        job_id = job_manager.submit("resume", kb_name, {"index_type": index_type})
+        return {"status": "queued", "job_id": job_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"修复知识库失败：{str(e)}")
 
@@ -54,6 +77,22 @@ async def get_kb_list():
     return {"kbs": list_kbs()}
 
 
+@router.get("/metrics", summary="获取知识库检索链路的运行指标")
+async def get_kb_metrics():
+    """
+    返回知识库缓存、Embedding 缓存、查询向量缓存 (含合批情况)、检索结果缓存、PDF 文本缓存的命中率与占用，以及外部 API 的自适应并发状态
+    (当前并发上限、在途请求、限流次数、重试次数) 等运行指标，便于观察性能。
+    """
+    return {
+        "cache": kb_cache.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "query_embedding": query_embedder.stats(),
+        "retrieval_cache": retrieval_cache.stats(),
+        "pdf_text_cache": pdf_text_cache.stats(),
+        "concurrency": controller_stats(),
+    }
+
+
 @router.get("/health", summary="获取所有知识库的健康状态")
 async def get_all_kb_health():
     """
@@ -67,7 +106,7 @@ async def get_all_kb_health():
 @router.delete("/{kb_name}", summary="删除知识库")
 async def delete_knowledge_base(kb_name: str):
     """
-    删除指定知识库（JSON 与向量索引）
+    删除指定知识库（片段库与向量索引）
     """
     try:
         delete_kb(kb_name)
@@ -86,32 +125,24 @@ async def add_text_to_kb(
     """
     将直接粘贴的纯文本切分后写入指定知识库并向量化。
     """
-    if mode not in ("append", "new"):
-        raise HTTPException(status_code=400, detail="mode 必须是 'append' 或 'new'")
-
-    if mode == "new":
-        try:
-            delete_kb(kb_name)
-        except Exception:
-            pass
+    if mode not in UPLOAD_MODES:
+        raise HTTPException(status_code=400, detail="mode 必须是 'append'、'new' 或 'replace'")
 
     if not text.strip():
         raise HTTPException(status_code=400, detail="文本内容为空")
 
     try:
-        raw_doc = Document(
-            page_content=text,
-            metadata={"source": doc_name}
-        )
-        
-        # 文本切分
-        from src.utils import split_documents
-        chunks = split_documents([raw_doc])
-
-        # 写入并向量化
-        save_kb(kb_name, chunks)
-
-        return {"status": "success", "chunks_count": len(chunks)}
+        # 文本落盘后交给后台任务切分与向量化，避免大段文本占用请求
+        upload_dir = new_upload_dir()
+        text_path = upload_dir / "text.txt"
+        text_path.write_text(text, encoding="utf-8")
+        job_id = job_manager.submit("add_text", kb_name, {
+            "text_path": str(text_path),
+            "doc_name": doc_name,
+            "mode": mode,
+            "upload_dir": str(upload_dir),
+        })
+        return {"status": "queued", "job_id": job_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f'添加文本失败：{str(e)}')
 
@@ -120,81 +151,111 @@ async def add_text_to_kb(
 async def upload_to_kb(
     kb_name: str = Form(...),
     files: List[UploadFile] = File(...),
-    mode: str = Form("append"),  # append 或 new
+    mode: str = Form("append"),  # append / new / replace
+    index_type: Optional[str] = Form(None),
+    tokenizer: Optional[str] = Form(None),
 ):
     """
     上传一个或多个文件，切分后写入指定知识库并向量化。
 
     - kb_name: 知识库名称
     - files: 上传文件列表（支持 PDF、TXT 等）
-    - mode: "append" 追加 / "new" 重建
+    - mode: "append" 追加 / "new" 重建 / "replace" 替换知识库中同名文档 (只删除并重写这些文档)
+    - index_type: 向量索引类型 flat / ivf_flat / hnsw / ivf_pq / auto（可选，默认按规模自动选择）
+    - tokenizer: BM25 分词模式 jieba / bigram（可选，默认沿用知识库已有模式；
+      bigram 不依赖词典、分词更快，切换已有知识库的模式会重建其 BM25 索引）
     """
-    if mode not in ("append", "new"):
-        raise HTTPException(status_code=400, detail="mode 必须是 'append' 或 'new'")
-
-    # 如果是重建模式，先删除旧知识库
-    if mode == "new":
-        try:
-            delete_kb(kb_name)
-        except Exception:
-            # 不存在时忽略错误
-            pass
-
-    raw_docs: List[Document] = []
+    if mode not in UPLOAD_MODES:
+        raise HTTPException(status_code=400, detail="mode 必须是 'append'、'new' 或 'replace'")
+    if tokenizer and tokenizer not in TOKENIZER_MODES:
+        raise HTTPException(status_code=400, detail=f"tokenizer 必须是 {' / '.join(TOKENIZER_MODES)}")
+    _check_index_type(index_type)
 
+    upload_dir = new_upload_dir()
     try:
-        for file in files:
+        tmp_files: List[tuple] = []
+        for i, file in enumerate(files):
             suffix = os.path.splitext(file.filename)[1].lower() or ".txt"
-
-            # 将 UploadFile 写入临时文件，供 LangChain loader 使用
-            with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-                content = await file.read()
-                tmp.write(content)
-                tmp_path = tmp.name
-
-            try:
-                # 直接使用 pypdf / 文本读取，避免 langchain_community 的兼容性问题
-                if suffix == ".pdf":
-                    reader = PdfReader(tmp_path)
-                    for i, page in enumerate(reader.pages):
-                        text = page.extract_text() or ""
-                        if not text.strip():
-                            continue
-                        raw_docs.append(
-                            Document(
-                                page_content=text,
-                                metadata={"source": file.filename, "page": i},
-                            )
-                        )
-                else:
-                    with open(tmp_path, "r", encoding="utf-8") as f:
-                        text = f.read()
-                    if text.strip():
-                        raw_docs.append(
-                            Document(
-                                page_content=text,
-                                metadata={"source": file.filename},
-                            )
-                        )
-            finally:
-                if os.path.exists(tmp_path):
-                    os.remove(tmp_path)
-
-        if not raw_docs:
-            return {"status": "no_content", "chunks_count": 0}
-
-        # 文本切分
-        from src.utils import split_documents
-        chunks = split_documents(raw_docs)
-
-        # 写入并向量化
-        save_kb(kb_name, chunks)
-
-        return {"status": "success", "chunks_count": len(chunks)}
+            tmp_path = upload_dir / f"{i}{suffix}"
+
+            # 将 UploadFile 分块写入任务暂存目录，不在内存中持有整份上传
+            with open(tmp_path, "wb") as tmp:
+                while True:
+                    block = await file.read(UPLOAD_READ_BLOCK)
+                    if not block:
+                        break
+                    tmp.write(block)
+            tmp_files.append((str(tmp_path), file.filename))
+
+        # 重建模式的删除、解析 → 切分 → 向量化 → 写索引 均在后台任务中执行
+        job_id = job_manager.submit("upload", kb_name, {
+            "files": tmp_files,
+            "mode": mode,
+            "index_type": index_type,
+            "tokenizer": tokenizer,
+            "upload_dir": str(upload_dir),
+        })
+        return {"status": "queued", "job_id": job_id, "files_count": len(tmp_files)}
     except Exception as e:
+        shutil.rmtree(upload_dir, ignore_errors=True)
         raise HTTPException(status_code=500, detail=f'上传知识库失败：{str(e)}')
 
 
+@router.get("/jobs", summary="获取后台任务列表")
+async def list_kb_jobs(kb_name: Optional[str] = None, limit: int = Query(50, ge=1, le=500)):
+    """按提交时间倒序返回后台任务，可按知识库过滤。"""
+    return {"jobs": job_manager.list_jobs(kb_name=kb_name, limit=limit)}
+
+
+@router.get("/jobs/{job_id}", summary="查询后台任务状态与进度")
+async def get_kb_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job
+
+
+@router.get("/jobs/{job_id}/events", summary="以 SSE 推送后台任务进度")
+async def stream_kb_job(job_id: str):
+    """每秒推送一次任务状态，进度或状态变化时发送，任务结束后关闭连接。"""
+    if job_manager.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+
+    async def event_generator():
+        last = None
+        while True:
+            job = await asyncio.to_thread(job_manager.get, job_id)
+            if job is None:
+                break
+            snapshot = (job["status"], job["progress_current"], job["progress_total"], job["message"])
+            if snapshot != last:
+                last = snapshot
+                yield f"data: {json.dumps(job, ensure_ascii=False)}\n\n"
+            if job["status"] in TERMINAL_STATUSES:
+                break
+            await asyncio.sleep(1.0)
+        yield "data: {\"type\": \"done\"}\n\n"
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no"  # Nginx 缓冲禁用
+        }
+    )
+
+
+@router.post("/jobs/{job_id}/cancel", summary="取消后台任务")
+async def cancel_kb_job(job_id: str):
+    """排队中的任务立即取消；运行中的任务在下一个检查点停止，已写入的部分可断点续传。"""
+    job = job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job
+
+
 @router.get("/{kb_name}/documents", summary="获取知识库的文档列表视图")
 async def get_kb_documents_view(kb_name: str):
     """
@@ -207,6 +268,19 @@ async def get_kb_documents_view(kb_name: str):
         raise HTTPException(status_code=500, detail=f"获取知识库文档失败：{str(e)}")
 
 
+@router.delete("/{kb_name}/documents", summary="从知识库中删除一个文档")
+async def delete_kb_document(kb_name: str, source: str = Query(..., description="文档名 (片段 metadata.source)")):
+    """
+    删除该文档的片段与向量，其余文档不受影响、不需要重新向量化。
+    删除在后台任务中执行 (与同一知识库的其他写入串行)，返回任务 id。
+    """
+    try:
+        job_id = job_manager.submit("delete_document", kb_name, {"source": source})
+        return {"status": "queued", "job_id": job_id}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"删除文档失败：{str(e)}")
+
+
 @router.get("/{kb_name}/health", summary="获取单个知识库的健康状态")
 async def get_single_kb_health(kb_name: str):
     """
@@ -223,17 +297,23 @@ async def get_single_kb_health(kb_name: str):
 async def search_kb(
     kb_name: str,
     q: str,
-    limit: int = 20,
+    limit: int = Query(20, ge=1, le=200),
+    offset: int = Query(0, ge=0, description="分页偏移，传上一页返回的 next_offset"),
+    filter: Optional[str] = Query(None, description='元数据过滤 (JSON)，如 {"source": "a.pdf", "page": {"$lte": 10}}'),
 ):
     """
-    在知识库的 JSON 片段中进行关键词搜索，用于调试向量库。
+    在知识库的片段中进行关键词搜索，用于调试向量库。
+    结果按相关度排序，每条带 highlights (关键词在 content 中的 [起, 止) 区间)。
     """
-    if not q:
+    if not q.strip():
         raise HTTPException(status_code=400, detail="缺少搜索关键词 q")
 
     try:
-        results = search_kb_chunks(kb_name, q, limit=limit)
-        return {"results": results}
+        metadata_filter = json.loads(filter) if filter else None
+        return search_kb_chunks(kb_name, q, limit=limit, offset=offset, metadata_filter=metadata_filter)
+    except ValueError as e:
+        # json.JSONDecodeError 也是 ValueError
+        raise HTTPException(status_code=400, detail=f"过滤条件不合法：{str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"搜索失败：{str(e)}")
 
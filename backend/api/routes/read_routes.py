@@ -4,6 +4,7 @@
 """
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException
 from fastapi.responses import StreamingResponse
+import asyncio
 import tempfile
 import os
 import sys
@@ -17,6 +18,7 @@ from src.graphs.deep_read_graph import deep_read_graph
 from src.state import AgentState
 from src.db import save_report, get_all_reports, get_report_content, delete_report
 from src.logger import get_logger
+from src.pdf_extract import extract_pdf_pages
 
 logger = get_logger("ReadAPI")
 
@@ -98,13 +100,11 @@ async def analyze_document(
 
     # 读取全文内容（目前按纯文本读取，后续可以接入更复杂的 loader）
     try:
-        from langchain_community.document_loaders import PyPDFLoader, TextLoader
         full_text = ""
 
         if file_path.lower().endswith(".pdf"):
-            loader = PyPDFLoader(file_path)
-            pages = loader.load()
-            full_text = "\n\n".join([p.page_content for p in pages])
+            pages = await asyncio.to_thread(extract_pdf_pages, file_path)
+            full_text = "\n\n".join(pages)
         else:
             # 回退：按 UTF-8 文本读取
             with open(file_path, "r", encoding="utf-8") as f:
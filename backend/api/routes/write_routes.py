@@ -17,7 +17,7 @@ from src.graphs.write_graph_v2 import planning_graph, drafting_graph
 from src.nodes.write_nodes_v2 import outline_architect_node, outline_refiner_node
 from src.nodes.common import get_llm
 from langchain_core.messages import HumanMessage
-from langchain_community.document_loaders import PyPDFLoader
+from src.pdf_extract import extract_pdf_pages
 from src.logger import get_logger
 from src.db import (
     create_writing_project, 
@@ -237,9 +237,8 @@ async def extract_text(file: UploadFile = File(...)):
     try:
         full_text = ""
         if file_ext == ".pdf":
-            loader = PyPDFLoader(tmp_path)
-            pages = loader.load()
-            full_text = "\n\n".join([p.page_content for p in pages])
+            pages = await asyncio.to_thread(extract_pdf_pages, tmp_path)
+            full_text = "\n\n".join(pages)
         else:
             full_text = content.decode("utf-8")
         
@@ -1,28 +1,274 @@
-"""BM25 检索器封装。"""
+"""BM25 检索器封装。分词见 src/tokenizer.py (jieba / bigram 两种模式)。"""
 
-from typing import List
-import jieba
+import heapq
+import json
+import math
+import sqlite3
+from collections import Counter
+from contextlib import contextmanager
+from itertools import islice
+from pathlib import Path
+from typing import Iterable, List, Tuple
 from rank_bm25 import BM25Okapi
 from langchain_core.documents import Document
 
+from src.chunk_store import ensure_schema_once, table_names
+from src.tokenizer import check_mode, tokenize, tokenize_many
+
+# add_documents 每批分词的文档数 (进程池按 TOKENIZE_TASK_SIZE 再切分)
+_TOKENIZE_BATCH = 2000
+
 
 class SimpleBM25Retriever:
-    """简单的内存级 BM25 检索器。"""
+    """
+    简单的内存级 BM25 检索器。
+    corpus 可传入已分好的词元列表 (与 documents 对齐)，否则构建时批量分词 (片段多时走进程池)。
+    """
 
-    def __init__(self, documents: List[Document]):
+    def __init__(self, documents: List[Document], corpus: List[List[str]] = None, tokenizer: str = None):
         self.documents = documents
+        self.tokenizer = check_mode(tokenizer)
         # 预处理：中文分词
-        self.corpus = [self._tokenize(doc.page_content) for doc in documents]
+        self.corpus = corpus if corpus is not None else tokenize_many(
+            [doc.page_content for doc in documents], self.tokenizer
+        )
         self.bm25 = BM25Okapi(self.corpus)
 
-    @staticmethod
-    def _tokenize(text: str) -> List[str]:
-        """使用 Jieba 进行中文分词。"""
-        return list(jieba.cut(text))
+    def _tokenize(self, text: str) -> List[str]:
+        return tokenize(text, self.tokenizer)
 
     def search(self, query: str, k: int = 3) -> List[Document]:
         """执行检索。"""
         tokenized_query = self._tokenize(query)
         # 获取 top_k 文档
         top_docs = self.bm25.get_top_n(tokenized_query, self.documents, n=k)
-        return top_docs
\ No newline at end of file
+        return top_docs
+
+    def search_with_scores(self, query: str, k: int = 3) -> List[Tuple[Document, float]]:
+        """执行检索，返回按得分降序的 [(文档, 得分)]。"""
+        scores = self.bm25.get_scores(self._tokenize(query))
+        top = heapq.nlargest(k, range(len(self.documents)), key=lambda i: scores[i])
+        return [(self.documents[i], float(scores[i])) for i in top]
+
+
+class PersistentBM25Index:
+    """
+    持久化 BM25 倒排索引（SQLite）。
+
+    入库时一次性分词并写入 postings / 文档长度 / 文档频率 (df)，
+    追加片段只写新增部分；查询时只读取查询词对应的 postings，
+    耗时取决于查询词的命中数量而不是语料规模。
+    每个文档的词元列表缓存在 bm25_doc_terms 中，删除文档时按缓存定位 postings，不再重新分词。
+    tokenizer 为分词模式，入库与查询必须一致 (按知识库记录在 manifest 中)。
+
+    IDF 由磁盘上的 df 与文档总数在查询时计算
+    (Lucene 形式 log(1 + (N - df + 0.5) / (df + 0.5)))，
+    这样追加片段时无需重写整个词表。
+    """
+
+    def __init__(self, db_path: Path, k1: float = 1.5, b: float = 0.75, tokenizer: str = None):
+        self.db_path = Path(db_path)
+        self.k1 = k1
+        self.b = b
+        self.tokenizer = check_mode(tokenizer)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(str(self.db_path), timeout=60.0, check_same_thread=False)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL;")
+            ensure_schema_once(conn, self.db_path, "bm25", self._ensure_schema, self._schema_current)
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    _TABLES = ("bm25_postings", "bm25_doclen", "bm25_terms", "bm25_stats", "bm25_doc_terms")
+    _STATS_KEYS = ("doc_count", "total_len", "next_doc_id")
+
+    @classmethod
+    def _schema_current(cls, conn: sqlite3.Connection) -> bool:
+        if not set(cls._TABLES) <= table_names(conn):
+            return False
+        return set(cls._STATS_KEYS) <= {row[0] for row in conn.execute("SELECT key FROM bm25_stats")}
+
+    @classmethod
+    def _ensure_schema(cls, conn: sqlite3.Connection):
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS bm25_postings (
+            term TEXT NOT NULL,
+            doc_id INTEGER NOT NULL,
+            tf INTEGER NOT NULL,
+            PRIMARY KEY (term, doc_id)
+        ) WITHOUT ROWID
+        """)
+        conn.execute("CREATE TABLE IF NOT EXISTS bm25_doclen (doc_id INTEGER PRIMARY KEY, length INTEGER NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS bm25_terms (term TEXT PRIMARY KEY, df INTEGER NOT NULL) WITHOUT ROWID")
+        conn.execute("CREATE TABLE IF NOT EXISTS bm25_stats (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS bm25_doc_terms (doc_id INTEGER PRIMARY KEY, terms TEXT NOT NULL)")
+        for key in cls._STATS_KEYS:
+            conn.execute("INSERT OR IGNORE INTO bm25_stats (key, value) VALUES (?, 0)", (key,))
+
+    @staticmethod
+    def _get_stats(conn: sqlite3.Connection) -> dict:
+        return {key: value for key, value in conn.execute("SELECT key, value FROM bm25_stats")}
+
+    def next_doc_id(self) -> int:
+        """已索引的最大 doc_id + 1，用于和片段库对齐（断点补索引）。"""
+        with self._connect() as conn:
+            return self._get_stats(conn)["next_doc_id"]
+
+    def add_documents(self, items: Iterable[Tuple[int, str]]) -> int:
+        """
+        增量写入文档。
+        items: [(doc_id, text), ...]，doc_id 需递增且与片段库 id 一致
+        返回本次写入的文档数。
+        """
+        items = iter(items)
+        added = 0
+        while True:
+            batch = list(islice(items, _TOKENIZE_BATCH))
+            if not batch:
+                return added
+            terms = tokenize_many([text for _, text in batch], self.tokenizer)
+            added += self.add_terms(zip((doc_id for doc_id, _ in batch), terms))
+
+    def add_terms(self, items: Iterable[Tuple[int, List[str]]]) -> int:
+        """
+        增量写入已分词的文档 (入库流水线在进程池中预先分词)。
+        items: [(doc_id, 词元列表), ...]，要求同 add_documents
+        """
+        added = 0
+        with self._connect() as conn:
+            stats = self._get_stats(conn)
+            total_len = stats["total_len"]
+            next_doc_id = stats["next_doc_id"]
+            df_delta: Counter = Counter()
+
+            for doc_id, terms in items:
+                if doc_id < next_doc_id:
+                    continue  # 已索引过，跳过（幂等）
+                term_freqs = Counter(terms)
+                length = sum(term_freqs.values())
+                conn.executemany(
+                    "INSERT OR REPLACE INTO bm25_postings (term, doc_id, tf) VALUES (?, ?, ?)",
+                    [(term, doc_id, tf) for term, tf in term_freqs.items()],
+                )
+                conn.execute("INSERT OR REPLACE INTO bm25_doclen (doc_id, length) VALUES (?, ?)", (doc_id, length))
+                conn.execute(
+                    "INSERT OR REPLACE INTO bm25_doc_terms (doc_id, terms) VALUES (?, ?)",
+                    (doc_id, json.dumps(terms, ensure_ascii=False)),
+                )
+                df_delta.update(term_freqs.keys())
+                total_len += length
+                next_doc_id = doc_id + 1
+                added += 1
+
+            if added:
+                conn.executemany(
+                    "INSERT INTO bm25_terms (term, df) VALUES (?, ?) "
+                    "ON CONFLICT(term) DO UPDATE SET df = df + excluded.df",
+                    list(df_delta.items()),
+                )
+                conn.executemany(
+                    "UPDATE bm25_stats SET value = ? WHERE key = ?",
+                    [(stats["doc_count"] + added, "doc_count"), (total_len, "total_len"), (next_doc_id, "next_doc_id")],
+                )
+        return added
+
+    def remove_documents(self, items: Iterable[Tuple[int, str]]) -> int:
+        """
+        删除文档 (按文档 / 替换某个来源时使用)。
+        items: [(doc_id, text)]，按缓存的词元定位 postings，不需要扫描全表
+        (旧版索引没有词元缓存时对 text 重新分词)
+        返回实际删除的文档数。
+        """
+        removed = 0
+        with self._connect() as conn:
+            stats = self._get_stats(conn)
+            total_len = stats["total_len"]
+            df_delta: Counter = Counter()
+
+            for doc_id, text in items:
+                row = conn.execute("SELECT length FROM bm25_doclen WHERE doc_id = ?", (doc_id,)).fetchone()
+                if row is None:
+                    continue  # 未索引或已删除
+                cached = conn.execute("SELECT terms FROM bm25_doc_terms WHERE doc_id = ?", (doc_id,)).fetchone()
+                terms = set(json.loads(cached[0]) if cached else tokenize(text, self.tokenizer))
+                conn.executemany(
+                    "DELETE FROM bm25_postings WHERE term = ? AND doc_id = ?",
+                    [(term, doc_id) for term in terms],
+                )
+                conn.execute("DELETE FROM bm25_doclen WHERE doc_id = ?", (doc_id,))
+                conn.execute("DELETE FROM bm25_doc_terms WHERE doc_id = ?", (doc_id,))
+                df_delta.update(terms)
+                total_len -= row[0]
+                removed += 1
+
+            if removed:
+                conn.executemany(
+                    "UPDATE bm25_terms SET df = df - ? WHERE term = ?",
+                    [(count, term) for term, count in df_delta.items()],
+                )
+                conn.execute("DELETE FROM bm25_terms WHERE df <= 0")
+                conn.executemany(
+                    "UPDATE bm25_stats SET value = ? WHERE key = ?",
+                    [(max(0, stats["doc_count"] - removed), "doc_count"), (max(0, total_len), "total_len")],
+                )
+        return removed
+
+    def reset(self):
+        """清空索引 (切换分词模式后由调用方重新写入全部文档)。"""
+        with self._connect() as conn:
+            for table in ("bm25_postings", "bm25_doclen", "bm25_terms", "bm25_doc_terms"):
+                conn.execute(f"DELETE FROM {table}")
+            conn.execute("UPDATE bm25_stats SET value = 0")
+
+    def search(self, query: str, k: int = 3, doc_ids: Iterable[int] = None) -> List[Tuple[int, float]]:
+        """
+        执行检索，返回按得分降序的 [(doc_id, score), ...]。
+        doc_ids 不为 None 时只读取这些文档的 postings (元数据过滤后的候选集)，IDF 仍按全库统计。
+        """
+        query_terms = Counter(tokenize(query, self.tokenizer))
+        if not query_terms or not self.db_path.exists():
+            return []
+        if doc_ids is not None:
+            doc_ids = list(doc_ids)
+            if not doc_ids:
+                return []
+
+        scores: dict = {}
+        with self._connect() as conn:
+            stats = self._get_stats(conn)
+            n_docs = stats["doc_count"]
+            if n_docs == 0:
+                return []
+            avgdl = stats["total_len"] / n_docs
+
+            restrict = ""
+            if doc_ids is not None:
+                # 候选 id 放进临时表，与 postings 的主键 (term, doc_id) 做连接
+                conn.execute("CREATE TEMP TABLE IF NOT EXISTS bm25_filter (doc_id INTEGER PRIMARY KEY)")
+                conn.execute("DELETE FROM bm25_filter")
+                conn.executemany("INSERT OR IGNORE INTO bm25_filter (doc_id) VALUES (?)", ((i,) for i in doc_ids))
+                restrict = " AND p.doc_id IN (SELECT doc_id FROM bm25_filter)"
+
+            for term, qtf in query_terms.items():
+                row = conn.execute("SELECT df FROM bm25_terms WHERE term = ?", (term,)).fetchone()
+                if not row:
+                    continue
+                df = row[0]
+                idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                postings = conn.execute(
+                    "SELECT p.doc_id, p.tf, d.length FROM bm25_postings p "
+                    f"JOIN bm25_doclen d ON d.doc_id = p.doc_id WHERE p.term = ?{restrict}",
+                    (term,),
+                )
+                for doc_id, tf, length in postings:
+                    denom = tf + self.k1 * (1 - self.b + self.b * length / avgdl)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + qtf * idf * tf * (self.k1 + 1) / denom
+
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
@@ -0,0 +1,798 @@
+"""
+知识库片段存储（追加式）。
+
+每个知识库对应 storage/{kb}_chunks.db 一个 SQLite 文件：
+- chunks 表按 id 顺序保存片段，追加上传只写入新行，不再整库重写；
+- manifest 表记录片段数、下一个 id 与写入代数 (generation)，每次写入 +1；
+- 所有写入都在单个事务内完成，进程中途崩溃不会损坏已有数据；
+- 片段 id 一经分配不再改变 (删除后也不复用)，读取时以 metadata["chunk_id"] 返回，
+  向量索引以它为键关联片段，可以按来源删除 / 替换单个文档。
+
+chunks_fts 是以 chunks 为外部内容的 FTS5 trigram 全文索引，由触发器随片段增删同步维护，
+关键词调试搜索走索引、按 bm25 排序并分页 (中文无需分词，任意 >= 3 字的子串均可命中)。
+
+统计信息 (字符数、语言分布、按来源聚合、预览行) 与片段在同一事务内增量维护，
+健康检查 / 文档列表只读 manifest 与 source_stats，不再扫描全部片段。
+sample_reservoir 是随写入维护的蓄水池样本 (Algorithm R)，随机采样只读这张小表。
+chunk_meta_index 按 (字段, 值) 记录片段 id (source / page / language / ingested_at)，
+检索前的元数据过滤直接在索引上求出候选片段 id 集合。
+
+读取统一走 iter_chunks 流式迭代器，内存占用与知识库大小无关。
+旧版 storage/{kb}.json 会在首次访问时自动迁移，原文件改名为 .json.bak 保留。
+"""
+import json
+import os
+import random
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from src.db import STORAGE_DIR
+from src.logger import get_logger
+
+logger = get_logger("ChunkStore")
+
+CHUNK_DB_SUFFIX = "_chunks.db"
+SCHEMA_VERSION = 1
+STATS_VERSION = 1
+PREVIEW_ROWS = 3
+PREVIEW_CHARS = 100
+SAMPLE_RESERVOIR_SIZE = int(os.getenv("KB_SAMPLE_RESERVOIR", "64"))
+SAMPLE_CHARS = 200
+# 建立元数据索引的字段 (可用于检索前过滤)
+FILTER_FIELDS = ("source", "page", "language", "ingested_at")
+
+
+def chunk_db_path(kb_name: str) -> Path:
+    return STORAGE_DIR / f"{kb_name}{CHUNK_DB_SUFFIX}"
+
+
+def _legacy_json_path(kb_name: str) -> Path:
+    return STORAGE_DIR / f"{kb_name}.json"
+
+
+def _ensure_schema(conn: sqlite3.Connection):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS chunks (
+        id INTEGER PRIMARY KEY,
+        source TEXT,
+        page_content TEXT NOT NULL,
+        metadata TEXT NOT NULL
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_source ON chunks (source)")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS manifest (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    """)
+    conn.execute(
+        "INSERT OR IGNORE INTO manifest (key, value) VALUES ('schema_version', ?)",
+        (str(SCHEMA_VERSION),),
+    )
+    for key in ("next_id", "chunk_count", "generation"):
+        conn.execute("INSERT OR IGNORE INTO manifest (key, value) VALUES (?, '0')", (key,))
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS source_stats (
+        source TEXT PRIMARY KEY,
+        chunk_count INTEGER NOT NULL,
+        total_chars INTEGER NOT NULL,
+        first_id INTEGER NOT NULL
+    )
+    """)
+    # 在 ensure_schema_once 的写事务 (BEGIN IMMEDIATE) 中执行，并发连接不会重复回填
+    if conn.execute("SELECT 1 FROM manifest WHERE key = 'stats_version'").fetchone() is None:
+        _rebuild_stats(conn)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS sample_reservoir (
+        slot INTEGER PRIMARY KEY,
+        chunk_id INTEGER NOT NULL,
+        source TEXT,
+        content TEXT NOT NULL
+    )
+    """)
+    if conn.execute("SELECT 1 FROM manifest WHERE key = 'sample_seen'").fetchone() is None:
+        _refill_samples(conn)
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chunk_meta_index'").fetchone() is None:
+        conn.execute("""
+        CREATE TABLE chunk_meta_index (
+            field TEXT NOT NULL,
+            value NOT NULL,
+            chunk_id INTEGER NOT NULL,
+            PRIMARY KEY (field, value, chunk_id)
+        ) WITHOUT ROWID
+        """)
+        conn.execute("CREATE INDEX idx_chunk_meta_chunk ON chunk_meta_index (chunk_id)")
+        # 已有片段从 metadata JSON 回填
+        for field in FILTER_FIELDS:
+            conn.execute(
+                "INSERT OR IGNORE INTO chunk_meta_index (field, value, chunk_id) "
+                "SELECT ?, json_extract(metadata, '$.' || ?), id FROM chunks "
+                "WHERE json_type(metadata, '$.' || ?) IN ('text', 'integer', 'real')",
+                (field, field, field),
+            )
+    # 早期版本把入库日期以 date 字段写入元数据索引
+    conn.execute("UPDATE OR IGNORE chunk_meta_index SET field = 'ingested_at' WHERE field = 'date'")
+    _ensure_fts(conn)
+
+
+_SCHEMA_TABLES = ("chunks", "manifest", "source_stats", "sample_reservoir", "chunk_meta_index", "chunks_fts")
+_SCHEMA_MANIFEST_KEYS = ("schema_version", "next_id", "chunk_count", "generation", "stats_version", "sample_seen")
+
+
+def table_names(conn: sqlite3.Connection) -> Set[str]:
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def _schema_current(conn: sqlite3.Connection) -> bool:
+    """只读检查：各表与 manifest 基础键都已存在 (无需建表 / 回填)。"""
+    if not set(_SCHEMA_TABLES) <= table_names(conn):
+        return False
+    keys = {row[0] for row in conn.execute("SELECT key FROM manifest")}
+    if not set(_SCHEMA_MANIFEST_KEYS) <= keys:
+        return False
+    return conn.execute("SELECT 1 FROM chunk_meta_index WHERE field = 'date' LIMIT 1").fetchone() is None
+
+
+# 已确认结构为最新的 (库文件, 模块名)。每个进程对每个库只建表 / 迁移一次，
+# 之后打开连接不再执行任何写语句，只读路径不会争抢写锁
+_schema_ready: Set[Tuple[str, str]] = set()
+_schema_lock = threading.Lock()
+
+
+def ensure_schema_once(conn: sqlite3.Connection, path: Path, name: str,
+                       ensure: Callable[[sqlite3.Connection], None],
+                       is_current: Callable[[sqlite3.Connection], bool] = None):
+    """
+    本进程首次打开 path 时执行 ensure(conn) 建表 / 迁移 (单独的写事务，立即提交)。
+    is_current(conn) 为 True 时说明库已是最新结构，直接记下，不做任何写入。
+    name 区分同一个库文件中的不同模块 (片段库、BM25、近重复索引)。
+    """
+    key = (str(path), name)
+    if key in _schema_ready:
+        return
+    with _schema_lock:
+        if key in _schema_ready:
+            return
+        if is_current is None or not is_current(conn):
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            try:
+                ensure(conn)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        _schema_ready.add(key)
+
+
+def _forget_schema(path: Path):
+    """库文件被删除后，下次创建时需重新建表。"""
+    with _schema_lock:
+        _schema_ready.difference_update({key for key in _schema_ready if key[0] == str(path)})
+
+
+def _ensure_fts(conn: sqlite3.Connection):
+    """创建 trigram 全文索引及同步触发器；已有片段的旧库在首次打开时全量构建一次。"""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chunks_fts'").fetchone():
+        return
+    try:
+        conn.execute(
+            "CREATE VIRTUAL TABLE chunks_fts USING fts5("
+            "page_content, content='chunks', content_rowid='id', tokenize='trigram')"
+        )
+    except sqlite3.OperationalError as e:
+        # SQLite < 3.34 没有 trigram 分词器：关键词搜索退化为 LIKE 扫描
+        logger.warning(f"当前 SQLite 不支持 FTS5 trigram，关键词搜索将逐行扫描: {e}")
+        return
+    conn.execute("""
+    CREATE TRIGGER chunks_fts_ai AFTER INSERT ON chunks BEGIN
+        INSERT INTO chunks_fts (rowid, page_content) VALUES (new.id, new.page_content);
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER chunks_fts_ad AFTER DELETE ON chunks BEGIN
+        INSERT INTO chunks_fts (chunks_fts, rowid, page_content) VALUES ('delete', old.id, old.page_content);
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER chunks_fts_au AFTER UPDATE OF page_content ON chunks BEGIN
+        INSERT INTO chunks_fts (chunks_fts, rowid, page_content) VALUES ('delete', old.id, old.page_content);
+        INSERT INTO chunks_fts (rowid, page_content) VALUES (new.id, new.page_content);
+    END
+    """)
+    if conn.execute("SELECT 1 FROM chunks LIMIT 1").fetchone():
+        conn.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('rebuild')")
+        logger.info("已为现有片段构建 trigram 全文索引")
+
+
+def _open(path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(str(path), timeout=60.0, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    return conn
+
+
+@contextmanager
+def get_connection(kb_name: str, create: bool = False):
+    """
+    打开知识库片段库的连接（事务）。
+    create=False 且知识库不存在时返回 None，调用方按空库处理。
+    """
+    _migrate_legacy_json(kb_name)
+    path = chunk_db_path(kb_name)
+    if not create and not path.exists():
+        yield None
+        return
+
+    conn = _open(path)
+    try:
+        ensure_schema_once(conn, path, "chunks", _ensure_schema, _schema_current)
+        yield conn
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"知识库 {kb_name} 片段库事务回滚: {e}", exc_info=True)
+        raise e
+    finally:
+        conn.close()
+
+
+def _get_manifest_int(conn: sqlite3.Connection, key: str) -> int:
+    row = conn.execute("SELECT value FROM manifest WHERE key = ?", (key,)).fetchone()
+    return int(row["value"]) if row and row["value"] is not None else 0
+
+
+def _set_manifest(conn: sqlite3.Connection, key: str, value: Any):
+    conn.execute(
+        "INSERT INTO manifest (key, value) VALUES (?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (key, str(value)),
+    )
+
+
+def _get_manifest_json(conn: sqlite3.Connection, key: str, default: Any = None) -> Any:
+    row = conn.execute("SELECT value FROM manifest WHERE key = ?", (key,)).fetchone()
+    if not row or row["value"] is None:
+        return default
+    return json.loads(row["value"])
+
+
+def _set_manifest_json(conn: sqlite3.Connection, key: str, value: Any):
+    _set_manifest(conn, key, json.dumps(value, ensure_ascii=False))
+
+
+# ===== 统计信息 (与片段写入同一事务) =====
+
+def _stats_source(source: Optional[str]) -> str:
+    return "unknown" if source is None else source
+
+
+def _refresh_preview(conn: sqlite3.Connection):
+    """预览取 id 最小的几行，走主键，开销与知识库大小无关。"""
+    preview = []
+    for row in conn.execute(
+        "SELECT source, page_content FROM chunks ORDER BY id LIMIT ?", (PREVIEW_ROWS,)
+    ):
+        content = row["page_content"] or ""
+        preview.append({
+            "content": content[:PREVIEW_CHARS] + "..." if len(content) > PREVIEW_CHARS else content,
+            "source": _stats_source(row["source"]),
+        })
+    _set_manifest_json(conn, "preview", preview)
+
+
+def _rebuild_stats(conn: sqlite3.Connection):
+    """由片段全量重算统计信息 (旧版片段库首次打开时执行一次)。"""
+    conn.execute("DELETE FROM source_stats")
+    conn.execute("""
+    INSERT INTO source_stats (source, chunk_count, total_chars, first_id)
+    SELECT COALESCE(source, 'unknown'), COUNT(*), COALESCE(SUM(LENGTH(page_content)), 0), MIN(id)
+    FROM chunks GROUP BY COALESCE(source, 'unknown')
+    """)
+    total_chars = conn.execute("SELECT COALESCE(SUM(total_chars), 0) FROM source_stats").fetchone()[0]
+    languages: Dict[str, int] = {}
+    for row in conn.execute(
+        "SELECT json_extract(metadata, '$.language') AS language, COUNT(*) AS n FROM chunks "
+        "WHERE json_extract(metadata, '$.language') IS NOT NULL GROUP BY 1"
+    ):
+        languages[str(row["language"])] = row["n"]
+    _set_manifest(conn, "total_chars", total_chars)
+    _set_manifest_json(conn, "languages", languages)
+    _refresh_preview(conn)
+    _set_manifest(conn, "stats_version", STATS_VERSION)
+
+
+def _apply_stats(conn: sqlite3.Connection, rows: List[Tuple[int, Optional[str], str, Dict[str, Any]]], sign: int):
+    """
+    按新增 (sign=1) / 删除 (sign=-1) 的片段增量更新统计。
+    rows: [(id, source, page_content, metadata)]
+    """
+    if not rows:
+        return
+    per_source: Dict[str, List[int]] = {}
+    languages: Dict[str, int] = _get_manifest_json(conn, "languages", {}) or {}
+    chars = 0
+    for chunk_id, source, content, meta in rows:
+        agg = per_source.setdefault(_stats_source(source), [0, 0, chunk_id])
+        agg[0] += 1
+        agg[1] += len(content)
+        agg[2] = min(agg[2], chunk_id)
+        chars += len(content)
+        language = meta.get("language")
+        if language is not None:
+            key = str(language)
+            languages[key] = languages.get(key, 0) + sign
+            if languages[key] <= 0:
+                del languages[key]
+
+    if sign > 0:
+        conn.executemany(
+            "INSERT INTO source_stats (source, chunk_count, total_chars, first_id) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(source) DO UPDATE SET chunk_count = chunk_count + excluded.chunk_count, "
+            "total_chars = total_chars + excluded.total_chars, first_id = MIN(first_id, excluded.first_id)",
+            [(source, n, c, first) for source, (n, c, first) in per_source.items()],
+        )
+    else:
+        conn.executemany(
+            "UPDATE source_stats SET chunk_count = chunk_count - ?, total_chars = total_chars - ? WHERE source = ?",
+            [(n, c, source) for source, (n, c, _) in per_source.items()],
+        )
+        conn.execute("DELETE FROM source_stats WHERE chunk_count <= 0")
+    _set_manifest(conn, "total_chars", max(0, _get_manifest_int(conn, "total_chars") + sign * chars))
+    _set_manifest_json(conn, "languages", languages)
+    _refresh_preview(conn)
+
+
+# ===== 元数据索引 =====
+
+def _meta_index_rows(chunk_id: int, meta: Dict[str, Any]) -> List[tuple]:
+    return [
+        (field, meta[field], chunk_id)
+        for field in FILTER_FIELDS
+        if isinstance(meta.get(field), (str, int, float)) and not isinstance(meta.get(field), bool)
+    ]
+
+
+_FILTER_OPS = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+
+def _filter_sql(conditions: Dict[str, Dict[str, Any]]) -> Tuple[str, List[Any]]:
+    """
+    把已校验的过滤条件 {字段: {操作符: 值}} 转为返回片段 id 的 SQL (各字段取交集)。
+    操作符：$eq / $in / $gt / $gte / $lt / $lte / $prefix。
+    """
+    parts, params = [], []
+    for field, ops in conditions.items():
+        clauses, field_params = [], []
+        for op, value in ops.items():
+            if op == "$eq":
+                clauses.append("value = ?")
+                field_params.append(value)
+            elif op == "$in":
+                clauses.append(f"value IN ({','.join('?' * len(value))})")
+                field_params.extend(value)
+            elif op == "$prefix":
+                # 前缀匹配 (如 ingested_at = "2023" 匹配 "2023-05-01")，走主键范围扫描
+                clauses.append("value >= ? AND value < ?")
+                field_params.extend([value, value + "\uffff"])
+            else:
+                clauses.append(f"value {_FILTER_OPS[op]} ?")
+                field_params.append(value)
+        parts.append(f"SELECT chunk_id FROM chunk_meta_index WHERE field = ? AND {' AND '.join(clauses)}")
+        params.extend([field, *field_params])
+    return " INTERSECT ".join(parts), params
+
+
+def filter_chunk_ids(kb_name: str, conditions: Dict[str, Dict[str, Any]]) -> List[int]:
+    """满足全部过滤条件的片段 id (升序)。"""
+    if not conditions:
+        return list_chunk_ids(kb_name)
+    sql, params = _filter_sql(conditions)
+    with get_connection(kb_name) as conn:
+        if conn is None:
+            return []
+        return [row[0] for row in conn.execute(f"SELECT chunk_id FROM ({sql}) ORDER BY chunk_id", params)]
+
+
+# ===== 蓄水池样本 =====
+
+def _sample_row(slot: int, chunk_id: int, source: Optional[str], content: str) -> tuple:
+    return slot, chunk_id, source, (content or "")[:SAMPLE_CHARS]
+
+
+def _update_samples(conn: sqlite3.Connection, rows: List[Tuple[int, Optional[str], str, Dict[str, Any]]]):
+    """Algorithm R：第 i 个片段 (从 0 计) 以 R/(i+1) 的概率替换蓄水池中的随机一格。"""
+    seen = _get_manifest_int(conn, "sample_seen")
+    size = SAMPLE_RESERVOIR_SIZE
+    picked: Dict[int, tuple] = {}
+    for chunk_id, source, content, _ in rows:
+        slot = seen if seen < size else random.randint(0, seen)
+        if slot < size:
+            picked[slot] = _sample_row(slot, chunk_id, source, content)
+        seen += 1
+    if picked:
+        conn.executemany(
+            "INSERT OR REPLACE INTO sample_reservoir (slot, chunk_id, source, content) VALUES (?, ?, ?, ?)",
+            list(picked.values()),
+        )
+    _set_manifest(conn, "sample_seen", seen)
+
+
+def _refill_samples(conn: sqlite3.Connection):
+    """
+    补满蓄水池 (旧库首次打开 / 删除片段后)：在 id 范围内随机取点，取 >= 该点的第一个片段，
+    每次都走主键索引，开销与知识库大小无关。
+    """
+    size = SAMPLE_RESERVOIR_SIZE
+    taken = {row[0]: row[1] for row in conn.execute("SELECT slot, chunk_id FROM sample_reservoir")}
+    free = [slot for slot in range(size) if slot not in taken]
+    chunk_count = _get_manifest_int(conn, "chunk_count")
+    bounds = conn.execute("SELECT MIN(id), MAX(id) FROM chunks").fetchone()
+    if free and bounds[0] is not None:
+        want = min(len(free), chunk_count - len(taken))
+        used = set(taken.values())
+        fresh = []
+        for _ in range(want * 4):
+            if len(fresh) >= want:
+                break
+            row = conn.execute(
+                "SELECT id, source, page_content FROM chunks WHERE id >= ? ORDER BY id LIMIT 1",
+                (random.randint(bounds[0], bounds[1]),),
+            ).fetchone()
+            if row is not None and row["id"] not in used:
+                used.add(row["id"])
+                fresh.append(row)
+        conn.executemany(
+            "INSERT INTO sample_reservoir (slot, chunk_id, source, content) VALUES (?, ?, ?, ?)",
+            [_sample_row(slot, row["id"], row["source"], row["page_content"]) for slot, row in zip(free, fresh)],
+        )
+    # 补满后视为对现有片段的均匀样本，之后的写入继续按 Algorithm R 维护
+    _set_manifest(conn, "sample_seen", chunk_count)
+
+
+def _row_to_record(row: sqlite3.Row) -> Dict[str, Any]:
+    metadata = json.loads(row["metadata"]) if row["metadata"] else {}
+    metadata["chunk_id"] = row["id"]
+    return {
+        "id": row["id"],
+        "page_content": row["page_content"],
+        "metadata": metadata,
+    }
+
+
+def _insert_records(conn: sqlite3.Connection, records: Iterable[Dict[str, Any]]) -> List[int]:
+    next_id = _get_manifest_int(conn, "next_id")
+    ids: List[int] = []
+    rows = []
+    for item in records:
+        meta = {k: v for k, v in (item.get("metadata", {}) or {}).items() if k != "chunk_id"}
+        rows.append((next_id, meta.get("source"), item.get("page_content", "") or "", meta))
+        ids.append(next_id)
+        next_id += 1
+
+    if rows:
+        conn.executemany(
+            "INSERT INTO chunks (id, source, page_content, metadata) VALUES (?, ?, ?, ?)",
+            [(i, source, content, json.dumps(meta, ensure_ascii=False)) for i, source, content, meta in rows],
+        )
+        _apply_stats(conn, rows, 1)
+        _update_samples(conn, rows)
+        conn.executemany(
+            "INSERT OR IGNORE INTO chunk_meta_index (field, value, chunk_id) VALUES (?, ?, ?)",
+            [index_row for i, _, _, meta in rows for index_row in _meta_index_rows(i, meta)],
+        )
+        _set_manifest(conn, "next_id", next_id)
+        _set_manifest(conn, "chunk_count", _get_manifest_int(conn, "chunk_count") + len(rows))
+        _set_manifest(conn, "generation", _get_manifest_int(conn, "generation") + 1)
+    return ids
+
+
+def _migrate_legacy_json(kb_name: str):
+    """
+    将旧版整库 JSON 迁移到片段库。
+    先写入临时文件再原子替换，迁移中断不会留下半成品。
+    """
+    json_path = _legacy_json_path(kb_name)
+    db_path = chunk_db_path(kb_name)
+    if db_path.exists() or not json_path.exists():
+        return
+
+    try:
+        with open(json_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception as e:
+        logger.error(f"读取旧版知识库 {kb_name} JSON 失败，跳过迁移: {e}")
+        return
+    if not isinstance(data, list):
+        return
+
+    tmp_path = db_path.with_name(db_path.name + ".tmp")
+    if tmp_path.exists():
+        tmp_path.unlink()
+    conn = _open(tmp_path)
+    try:
+        _ensure_schema(conn)
+        _insert_records(conn, data)
+        conn.commit()
+        # 切回 DELETE 模式，保证 -wal 内容落盘后再替换文件
+        conn.execute("PRAGMA journal_mode=DELETE;")
+    finally:
+        conn.close()
+
+    os.replace(tmp_path, db_path)
+    os.replace(json_path, json_path.with_name(json_path.name + ".bak"))
+    logger.info(f"知识库 {kb_name}: 已从旧版 JSON 迁移 {len(data)} 个片段到 {db_path.name}")
+
+
+def list_chunk_kbs() -> List[str]:
+    return [p.name[: -len(CHUNK_DB_SUFFIX)] for p in STORAGE_DIR.glob(f"*{CHUNK_DB_SUFFIX}")]
+
+
+def kb_exists(kb_name: str) -> bool:
+    return chunk_db_path(kb_name).exists() or _legacy_json_path(kb_name).exists()
+
+
+def append_chunks(kb_name: str, records: Iterable[Dict[str, Any]]) -> List[int]:
+    """
+    追加片段，返回新分配的片段 id 列表。
+    records: [{"page_content": str, "metadata": dict}, ...]
+    """
+    with get_connection(kb_name, create=True) as conn:
+        return _insert_records(conn, records)
+
+
+def iter_chunks(kb_name: str, offset: int = 0, batch_size: int = 500, start_id: int = 0) -> Iterator[Dict[str, Any]]:
+    """
+    按 id 顺序流式读取片段，每次只从磁盘取 batch_size 行。
+    offset: 跳过前 offset 个片段（断点续传使用）
+    start_id: 只读取 id >= start_id 的片段（增量索引使用）
+    """
+    with get_connection(kb_name) as conn:
+        if conn is None:
+            return
+        cursor = conn.execute(
+            "SELECT id, page_content, metadata FROM chunks WHERE id >= ? ORDER BY id LIMIT -1 OFFSET ?",
+            (max(0, start_id), max(0, offset)),
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield _row_to_record(row)
+
+
+def get_chunks(kb_name: str, chunk_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    """按 id 批量读取片段，返回 {id: record}。"""
+    if not chunk_ids:
+        return {}
+    result: Dict[int, Dict[str, Any]] = {}
+    with get_connection(kb_name) as conn:
+        if conn is None:
+            return result
+        ids = list(dict.fromkeys(int(i) for i in chunk_ids))
+        # SQLite 默认单条语句最多 999 个参数
+        for start in range(0, len(ids), 900):
+            part = ids[start:start + 900]
+            placeholders = ",".join("?" * len(part))
+            for row in conn.execute(
+                f"SELECT id, page_content, metadata FROM chunks WHERE id IN ({placeholders})", part
+            ):
+                result[row["id"]] = _row_to_record(row)
+    return result
+
+
+def list_chunk_ids(kb_name: str) -> List[int]:
+    """按顺序返回全部片段 id (不读取正文)。"""
+    with get_connection(kb_name) as conn:
+        if conn is None:
+            return []
+        return [row[0] for row in conn.execute("SELECT id FROM chunks ORDER BY id")]
+
+
+def source_chunk_ids(kb_name: str, source: str) -> List[int]:
+    """某个来源的片段 id (升序)。"""
+    with get_connection(kb_name) as conn:
+        if conn is None:
+            return []
+        return [row[0] for row in conn.execute("SELECT id FROM chunks WHERE source = ? ORDER BY id", (source,))]
+
+
+def _delete_ids(conn: sqlite3.Connection, chunk_ids: List[int]) -> List[Dict[str, Any]]:
+    deleted: List[Dict[str, Any]] = []
+    ids = sorted(set(int(i) for i in chunk_ids))
+    for start in range(0, len(ids), 900):
+        part = ids[start:start + 900]
+        placeholders = ",".join("?" * len(part))
+        deleted.extend(
+            _row_to_record(row)
+            for row in conn.execute(
+                f"SELECT id, page_content, metadata FROM chunks WHERE id IN ({placeholders}) ORDER BY id", part
+            )
+        )
+    if not deleted:
+        return deleted
+    conn.executemany("DELETE FROM chunks WHERE id = ?", [(item["id"],) for item in deleted])
+    _apply_stats(conn, [
+        (item["id"], item["metadata"].get("source"), item["page_content"], item["metadata"]) for item in deleted
+    ], -1)
+    conn.executemany("DELETE FROM chunk_meta_index WHERE chunk_id = ?", [(item["id"],) for item in deleted])
+    conn.execute(
+        "DELETE FROM sample_reservoir WHERE chunk_id IN "
+        "(SELECT chunk_id FROM sample_reservoir EXCEPT SELECT id FROM chunks)"
+    )
+    _set_manifest(conn, "chunk_count", max(0, _get_manifest_int(conn, "chunk_count") - len(deleted)))
+    _set_manifest(conn, "generation", _get_manifest_int(conn, "generation") + 1)
+    _refill_samples(conn)
+    return deleted
+
+
+def delete_chunks(kb_name: str, chunk_ids: List[int]) -> List[Dict[str, Any]]:
+    """按 id 删除片段，返回被删除的片段 (含正文，供倒排索引扣减)。"""
+    if not chunk_ids:
+        return []
+    with get_connection(kb_name) as conn:
+        if conn is None:
+            return []
+        return _delete_ids(conn, chunk_ids)
+
+
+def delete_chunks_by_source(kb_name: str, source: str) -> List[Dict[str, Any]]:
+    """删除某个来源的全部片段，返回被删除的片段 (含正文，供倒排索引扣减)。"""
+    with get_connection(kb_name) as conn:
+        if conn is None:
+            return []
+        ids = [row[0] for row in conn.execute("SELECT id FROM chunks WHERE source = ?", (source,))]
+        return _delete_ids(conn, ids)
+
+
+# trigram 分词器只能匹配 >= 3 个字符的词，更短的词用 LIKE 过滤
+_FTS_MIN_TERM = 3
+
+
+def _like_pattern(term: str) -> str:
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def search_chunks(kb_name: str, terms: List[str], limit: int = 20, offset: int = 0,
+                  conditions: Dict[str, Dict[str, Any]] = None) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    搜索同时包含全部 terms (大小写不敏感的子串) 的片段。
+    有 >= 3 字的词时走 trigram 索引并按 bm25 相关度排序 (record["score"] 越大越相关)，
+    否则按片段 id 顺序逐行匹配。conditions 为元数据过滤条件 (见 _filter_sql)。
+    返回 (本页片段, 是否还有下一页)。
+    """
+    terms = [t for t in terms if t]
+    if not terms or limit <= 0:
+        return [], False
+    with get_connection(kb_name) as conn:
+        if conn is None:
+            return [], False
+        has_fts = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chunks_fts'"
+        ).fetchone() is not None
+        fts_terms = [t for t in terms if len(t) >= _FTS_MIN_TERM] if has_fts else []
+        like_terms = [t for t in terms if t not in fts_terms]
+        like_sql = "".join(" AND c.page_content LIKE ? ESCAPE '\\'" for _ in like_terms)
+        like_params = [_like_pattern(t) for t in like_terms]
+        if conditions:
+            filter_sql, filter_params = _filter_sql(conditions)
+            like_sql += f" AND c.id IN ({filter_sql})"
+            like_params.extend(filter_params)
+
+        if fts_terms:
+            # 每个词作为短语 (双引号转义)，多个词之间为 AND
+            match = " ".join('"' + t.replace('"', '""') + '"' for t in fts_terms)
+            sql = (
+                "SELECT c.id, c.page_content, c.metadata, bm25(chunks_fts) AS rank "
+                "FROM chunks_fts JOIN chunks c ON c.id = chunks_fts.rowid "
+                f"WHERE chunks_fts MATCH ?{like_sql} ORDER BY rank, c.id LIMIT ? OFFSET ?"
+            )
+            params = [match, *like_params, limit + 1, max(0, offset)]
+        else:
+            sql = (
+                "SELECT c.id, c.page_content, c.metadata, NULL AS rank FROM chunks c "
+                f"WHERE 1{like_sql} ORDER BY c.id LIMIT ? OFFSET ?"
+            )
+            params = [*like_params, limit + 1, max(0, offset)]
+
+        rows = conn.execute(sql, params).fetchall()
+    records = []
+    for row in rows[:limit]:
+        record = _row_to_record(row)
+        # bm25() 越小越相关，取负后越大越相关
+        record["score"] = -row["rank"] if row["rank"] is not None else None
+        records.append(record)
+    return records, len(rows) > limit
+
+
+def sample_chunks(kb_name: str, k: int) -> List[Dict[str, Any]]:
+    """从蓄水池中随机取 k 个样本 [{"chunk_id", "source", "content"}] (content 截断到 SAMPLE_CHARS 字)。"""
+    with get_connection(kb_name) as conn:
+        if conn is None:
+            return []
+        rows = conn.execute("SELECT chunk_id, source, content FROM sample_reservoir").fetchall()
+    picked = random.sample(rows, min(k, len(rows)))
+    return [{"chunk_id": row["chunk_id"], "source": row["source"], "content": row["content"]} for row in picked]
+
+
+def get_manifest(kb_name: str) -> Dict[str, int]:
+    """返回 {"chunk_count", "next_id", "generation"}，知识库不存在时全为 0。"""
+    manifest = {"chunk_count": 0, "next_id": 0, "generation": 0}
+    with get_connection(kb_name) as conn:
+        if conn is None:
+            return manifest
+        for key in manifest:
+            manifest[key] = _get_manifest_int(conn, key)
+    return manifest
+
+
+def get_manifest_value(kb_name: str, key: str, default: Any = None) -> Any:
+    """读取 manifest 中的 JSON 扩展字段 (如向量索引参数)。"""
+    with get_connection(kb_name) as conn:
+        if conn is None:
+            return default
+        return _get_manifest_json(conn, key, default)
+
+
+def set_manifest_value(kb_name: str, key: str, value: Any):
+    """写入 manifest 中的 JSON 扩展字段，不改变 generation。"""
+    with get_connection(kb_name, create=True) as conn:
+        _set_manifest_json(conn, key, value)
+
+
+def get_stats(kb_name: str, keys: Iterable[str] = ()) -> Dict[str, Any]:
+    """
+    读取统计信息：{"chunk_count", "total_chars", "languages", "preview", ...}，
+    keys 中列出的 manifest JSON 扩展字段一并返回 (不存在时为 None)。
+    """
+    stats: Dict[str, Any] = {"chunk_count": 0, "total_chars": 0, "languages": [], "preview": []}
+    stats.update({key: None for key in keys})
+    with get_connection(kb_name) as conn:
+        if conn is None:
+            return stats
+        stats["chunk_count"] = _get_manifest_int(conn, "chunk_count")
+        stats["total_chars"] = _get_manifest_int(conn, "total_chars")
+        stats["languages"] = sorted(_get_manifest_json(conn, "languages", {}) or {})
+        stats["preview"] = _get_manifest_json(conn, "preview", []) or []
+        for key in keys:
+            stats[key] = _get_manifest_json(conn, key)
+    return stats
+
+
+def list_sources(kb_name: str) -> List[Dict[str, Any]]:
+    """按来源聚合的文档列表 [{"name", "chunk_count", "total_chars"}]，按首次入库顺序。"""
+    with get_connection(kb_name) as conn:
+        if conn is None:
+            return []
+        return [
+            {"name": row["source"], "chunk_count": row["chunk_count"], "total_chars": row["total_chars"]}
+            for row in conn.execute(
+                "SELECT source, chunk_count, total_chars FROM source_stats ORDER BY first_id"
+            )
+        ]
+
+
+def count_chunks(kb_name: str) -> int:
+    return get_manifest(kb_name)["chunk_count"]
+
+
+def delete_chunk_store(kb_name: str):
+    db_path = chunk_db_path(kb_name)
+    json_path = _legacy_json_path(kb_name)
+    _forget_schema(db_path)
+    for path in (
+        db_path,
+        Path(f"{db_path}-wal"),
+        Path(f"{db_path}-shm"),
+        json_path,
+        json_path.with_name(json_path.name + ".bak"),
+    ):
+        if path.exists():
+            os.remove(path)
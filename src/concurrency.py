@@ -0,0 +1,278 @@
+"""
+外部 API 调用的自适应并发控制 (AIMD) 与重试。
+
+- 请求健康 (成功且延迟不超过目标) 时并发上限加性增长，每轮约 +1；
+- 遇到 429 / 超时 / 5xx 时乘性减半，同一冷却窗口内只减一次，避免一批失败把上限打到底；
+- 可重试的失败按指数退避 + 全抖动 (full jitter) 重试，不再静默返回 None。
+
+控制器状态只由线程锁保护，同一个实例可同时用于线程池 (slot) 与协程 (aslot)。
+各控制器的当前并发上限、限流次数等指标通过 controller_stats() 暴露。
+"""
+import asyncio
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+import httpx
+
+from src.logger import get_logger
+
+logger = get_logger("Concurrency")
+
+T = TypeVar("T")
+
+# 视为"被限流 / 过载"的 HTTP 状态码，触发乘性退让并重试
+THROTTLE_STATUS = {408, 429, 500, 502, 503, 504}
+# 视为"请求内容有问题"的 HTTP 状态码 (输入非法 / 请求体过大)，拆小请求可能成功
+INPUT_ERROR_STATUS = {400, 413, 422}
+
+
+def _status_code(error: BaseException) -> Optional[int]:
+    code = getattr(error, "status_code", None)
+    if code is None:
+        code = getattr(getattr(error, "response", None), "status_code", None)
+    return code if isinstance(code, int) else None
+
+
+def is_throttle_error(error: BaseException) -> bool:
+    """429 / 5xx / 超时 / 连接错误视为过载信号，可重试。"""
+    code = _status_code(error)
+    if code is not None:
+        return code in THROTTLE_STATUS
+    name = type(error).__name__
+    return isinstance(error, (TimeoutError, ConnectionError, httpx.TransportError)) or "Timeout" in name or "Connection" in name
+
+
+def is_input_error(error: BaseException) -> bool:
+    """400 / 413 / 422 视为输入问题，可拆分请求定位出错的输入；鉴权、配置等其他错误重发也不会成功。"""
+    return _status_code(error) in INPUT_ERROR_STATUS
+
+
+class AdaptiveConcurrencyController:
+    """AIMD 并发控制器。"""
+
+    def __init__(self, name: str, initial: float = 2, min_limit: float = 1, max_limit: float = 16,
+                 latency_target: float = 10.0, decrease_factor: float = 0.5, cooldown: float = 2.0):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = float(min_limit)
+        self.max_limit = float(max_limit)
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self.in_flight = 0
+        self.successes = 0
+        self.errors = 0
+        self.throttles = 0
+        self.retries = 0
+        self.latency_ewma: Optional[float] = None
+        self._last_decrease = 0.0
+
+    # ---- 槽位 ----
+
+    def _try_enter(self) -> bool:
+        with self._cond:
+            if self.in_flight < max(1, int(self.limit)):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        """阻塞直到拿到并发槽位。"""
+        with self._cond:
+            while self.in_flight >= max(1, int(self.limit)):
+                self._cond.wait()
+            self.in_flight += 1
+
+    async def aacquire(self):
+        """异步获取并发槽位 (短间隔轮询，不绑定事件循环)。"""
+        delay = 0.005
+        while not self._try_enter():
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    def release(self, latency: float, error: Optional[BaseException] = None, throttled: bool = False):
+        """释放槽位并按结果调整上限。"""
+        with self._cond:
+            self.in_flight -= 1
+            if throttled or (error is not None and is_throttle_error(error)):
+                self._record_throttle()
+            elif error is not None:
+                self.errors += 1
+            else:
+                self._record_success(latency)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            self.release(time.monotonic() - start, e)
+            raise
+        self.release(time.monotonic() - start)
+
+    @asynccontextmanager
+    async def aslot(self):
+        await self.aacquire()
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            self.release(time.monotonic() - start, e)
+            raise
+        self.release(time.monotonic() - start)
+
+    # ---- AIMD 调整 (在 release 中持锁调用) ----
+
+    def _record_success(self, latency: float):
+        self.successes += 1
+        self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+        if latency <= self.latency_target:
+            # 加性增长：每完成约 limit 个请求上限 +1
+            self.limit = min(self.max_limit, self.limit + 1.0 / max(self.limit, 1.0))
+
+    def _record_throttle(self):
+        self.throttles += 1
+        now = time.monotonic()
+        if now - self._last_decrease >= self.cooldown:
+            old = self.limit
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            self._last_decrease = now
+            logger.warning(f"[{self.name}] 触发限流/超时，并发上限 {old:.1f} -> {self.limit:.1f}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "limit": round(self.limit, 2),
+                "in_flight": self.in_flight,
+                "successes": self.successes,
+                "errors": self.errors,
+                "throttles": self.throttles,
+                "retries": self.retries,
+                "latency_ewma": round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+            }
+
+    # ---- 带重试的调用 ----
+
+    def _backoff(self, attempt: int, base_delay: float, max_delay: float) -> float:
+        with self._lock:
+            self.retries += 1
+        # full jitter: 在 [0, min(max, base * 2^attempt)] 内均匀取值，避免多线程同时重试
+        return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+    def call(self, fn: Callable[[], T], max_attempts: int = 4, base_delay: float = 0.5, max_delay: float = 20.0,
+             before: Optional[Callable[[], None]] = None) -> T:
+        """
+        在并发槽位内调用 fn，可重试的失败按抖动退避重试，最终失败抛出最后一次异常。
+        before: 每次尝试前、占用槽位前执行 (如限速等待)，等待时间不计入延迟
+        """
+        for attempt in range(max_attempts):
+            try:
+                if before:
+                    before()
+                with self.slot():
+                    return fn()
+            except Exception as e:
+                if not is_throttle_error(e) or attempt == max_attempts - 1:
+                    raise
+                delay = self._backoff(attempt, base_delay, max_delay)
+                logger.info(f"[{self.name}] 第 {attempt + 1} 次调用失败 ({e})，{delay:.2f}s 后重试")
+                time.sleep(delay)
+        raise RuntimeError("unreachable")
+
+    async def acall(self, fn: Callable[[], Awaitable[T]], max_attempts: int = 4, base_delay: float = 0.5, max_delay: float = 20.0,
+                    before: Optional[Callable[[], Awaitable[None]]] = None) -> T:
+        """call 的异步版本。"""
+        for attempt in range(max_attempts):
+            try:
+                if before:
+                    await before()
+                async with self.aslot():
+                    return await fn()
+            except Exception as e:
+                if not is_throttle_error(e) or attempt == max_attempts - 1:
+                    raise
+                delay = self._backoff(attempt, base_delay, max_delay)
+                logger.info(f"[{self.name}] 第 {attempt + 1} 次调用失败 ({e})，{delay:.2f}s 后重试")
+                await asyncio.sleep(delay)
+        raise RuntimeError("unreachable")
+
+
+_controllers: Dict[str, AdaptiveConcurrencyController] = {}
+_controllers_lock = threading.Lock()
+
+
+def get_controller(name: str, **kwargs) -> AdaptiveConcurrencyController:
+    """按名称获取 (首次创建) 进程级共享的控制器，参数只在首次创建时生效。"""
+    with _controllers_lock:
+        if name not in _controllers:
+            _controllers[name] = AdaptiveConcurrencyController(name, **kwargs)
+        return _controllers[name]
+
+
+def controller_stats() -> Dict[str, Dict[str, Any]]:
+    with _controllers_lock:
+        controllers = list(_controllers.items())
+    return {name: c.stats() for name, c in controllers}
+
+
+# ===== httpx 传输层包装：让 SDK 客户端 (如 ChatOpenAI) 也受控制器约束 =====
+
+def _release_on_headers(controller: AdaptiveConcurrencyController, response: httpx.Response, latency: float) -> httpx.Response:
+    """
+    收到响应头即释放槽位，延迟按首字节时间计：控制器只约束同时发起的请求数，
+    不随流式输出的时长占住槽位 (一次长回答可能持续数分钟，占住槽位会让其他对话排队)。
+    429 / 5xx 记为限流 (响应原样返回，重试交给 SDK 自身的退避逻辑)。
+    """
+    controller.release(latency, throttled=response.status_code in THROTTLE_STATUS)
+    return response
+
+
+class AdaptiveTransport(httpx.BaseTransport):
+    """同步传输层：请求开始时占用槽位，收到响应头时释放。"""
+
+    def __init__(self, controller: AdaptiveConcurrencyController, transport: Optional[httpx.BaseTransport] = None):
+        self.controller = controller
+        self._transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self.controller.acquire()
+        start = time.monotonic()
+        try:
+            response = self._transport.handle_request(request)
+        except BaseException as e:
+            self.controller.release(time.monotonic() - start, e)
+            raise
+        return _release_on_headers(self.controller, response, time.monotonic() - start)
+
+    def close(self):
+        self._transport.close()
+
+
+class AsyncAdaptiveTransport(httpx.AsyncBaseTransport):
+    """AdaptiveTransport 的异步版本。"""
+
+    def __init__(self, controller: AdaptiveConcurrencyController, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.controller = controller
+        self._transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await self.controller.aacquire()
+        start = time.monotonic()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException as e:
+            self.controller.release(time.monotonic() - start, e)
+            raise
+        return _release_on_headers(self.controller, response, time.monotonic() - start)
+
+    async def aclose(self):
+        await self._transport.aclose()
@@ -0,0 +1,481 @@
+"""
+入库时的近重复片段检测（MinHash + LSH）。
+
+同一份报告的多个版本反复上传时，大量片段几乎相同，重复向量化既浪费 API 调用，
+又会在检索结果里挤占有效上下文。这里在向量化之前对每个新片段：
+- 取规范化文本的字符 n-gram (默认 5) 作为 shingle，计算 MinHash 签名；
+- 在该知识库的 LSH 索引 (band 分桶) 中查找候选，用签名估计 Jaccard 相似度；
+- 相似度 >= 阈值的视为近重复：不入库、不向量化，
+  link 模式下在 dedup_links 表中记录其来源、正文与对应的已有片段，drop 模式下直接丢弃。
+  被折叠到的已有片段随其文档删除时，仍在库中的来源的重复片段会按记录的正文重新入库
+  (见 orphaned_duplicates)，不会跟着丢失。
+
+签名与 LSH 桶和 BM25 一样存放在 storage/{kb}_chunks.db 中，删除知识库时一并删除；
+旧知识库首次去重时会按片段 id 增量补齐签名。
+"""
+import hashlib
+import json
+import os
+import threading
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from src import chunk_store
+from src.embedding_cache import normalize_text
+from src.logger import get_logger
+
+logger = get_logger("Dedup")
+
+KB_DEDUP_ENABLED = os.getenv("KB_DEDUP", "1") != "0"
+# 估计 Jaccard 相似度阈值，>= 该值视为近重复
+KB_DEDUP_THRESHOLD = float(os.getenv("KB_DEDUP_THRESHOLD", "0.9"))
+# link: 记录重复片段与已有片段的对应关系；drop: 直接丢弃
+KB_DEDUP_MODE = os.getenv("KB_DEDUP_MODE", "link")
+KB_DEDUP_NUM_PERM = int(os.getenv("KB_DEDUP_NUM_PERM", "128"))
+KB_DEDUP_BANDS = int(os.getenv("KB_DEDUP_BANDS", "16"))
+KB_DEDUP_SHINGLE = int(os.getenv("KB_DEDUP_SHINGLE", "5"))
+
+_MASK32 = np.uint64(0xFFFFFFFF)
+_QUERY_BATCH = 900
+
+
+def _permutations(num_perm: int) -> Tuple[np.ndarray, np.ndarray]:
+    # 固定种子：签名会持久化，各进程必须使用同一组哈希函数
+    rng = np.random.default_rng(20240517)
+    a = rng.integers(1, 2 ** 32 - 1, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2 ** 32 - 1, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def shingles(text: str, size: int = KB_DEDUP_SHINGLE) -> np.ndarray:
+    """规范化文本的字符 n-gram 哈希 (crc32，跨进程稳定)。"""
+    norm = normalize_text(text).lower()
+    if len(norm) <= size:
+        grams = {norm} if norm else set()
+    else:
+        grams = {norm[i:i + size] for i in range(len(norm) - size + 1)}
+    return np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams))
+
+
+class MinHasher:
+    """MinHash 签名 (uint32 x num_perm) 与 LSH 分桶。"""
+
+    def __init__(self, num_perm: int = KB_DEDUP_NUM_PERM, bands: int = KB_DEDUP_BANDS):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) 必须能被 bands ({bands}) 整除")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self._a, self._b = _permutations(num_perm)
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """空文本返回 None (不参与去重)。"""
+        hashes = shingles(text)
+        if hashes.size == 0:
+            return None
+        # (a * h + b) mod 2^32，a/h 均小于 2^32，乘积不会溢出 uint64
+        values = (self._a[:, None] * hashes[None, :] + self._b[:, None]) & _MASK32
+        return values.min(axis=1).astype(np.uint32)
+
+    def buckets(self, signature: np.ndarray) -> List[int]:
+        """每个 band 的桶号 (有符号 64 位，便于存入 SQLite INTEGER)。"""
+        rows = signature.reshape(self.bands, self.rows)
+        return [
+            int.from_bytes(hashlib.blake2b(row.tobytes(), digest_size=8).digest(), "little", signed=True)
+            for row in rows
+        ]
+
+    @staticmethod
+    def similarity(sig_a: np.ndarray, sig_b: np.ndarray) -> float:
+        return float(np.mean(sig_a == sig_b))
+
+
+def _ensure_schema(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS dedup_signatures (
+        chunk_id INTEGER PRIMARY KEY,
+        signature BLOB NOT NULL
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS dedup_lsh (
+        band INTEGER NOT NULL,
+        bucket INTEGER NOT NULL,
+        chunk_id INTEGER NOT NULL,
+        PRIMARY KEY (band, bucket, chunk_id)
+    ) WITHOUT ROWID
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS dedup_links (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        canonical_id INTEGER NOT NULL,
+        source TEXT,
+        page INTEGER,
+        similarity REAL NOT NULL,
+        page_content TEXT,
+        metadata TEXT
+    )
+    """)
+    # 旧版只记录来源，补上正文与 metadata 列 (旧记录为 NULL，无法恢复)
+    for column in _LINK_CONTENT_COLUMNS - _columns(conn, "dedup_links"):
+        conn.execute(f"ALTER TABLE dedup_links ADD COLUMN {column} TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_dedup_links_canonical ON dedup_links (canonical_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_dedup_links_source ON dedup_links (source)")
+
+
+_TABLES = ("dedup_signatures", "dedup_lsh", "dedup_links")
+_LINK_CONTENT_COLUMNS = {"page_content", "metadata"}
+_LINK_COLUMNS = "canonical_id, source, page, similarity, page_content, metadata"
+_INSERT_LINK = f"INSERT INTO dedup_links ({_LINK_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)"
+
+
+def _columns(conn, table: str):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _schema_current(conn) -> bool:
+    return set(_TABLES) <= chunk_store.table_names(conn) and _LINK_CONTENT_COLUMNS <= _columns(conn, "dedup_links")
+
+
+def _prepare(conn, kb_name: str):
+    """本进程首次打开该知识库时建表，之后不再写入。"""
+    chunk_store.ensure_schema_once(conn, chunk_store.chunk_db_path(kb_name), "dedup", _ensure_schema, _schema_current)
+
+
+class NearDuplicateDetector:
+    """
+    单个知识库的近重复检测器，一次上传 (一个流水线 / 一次 save_kb) 使用一个实例。
+
+    filter(docs) 在向量化前调用，返回保留的片段；同一次上传内部的重复也会被识别。
+    片段写入片段库后调用 sync() 把新片段的签名写入 LSH 索引。
+    """
+
+    def __init__(self, kb_name: str, threshold: float = KB_DEDUP_THRESHOLD, mode: str = KB_DEDUP_MODE,
+                 hasher: MinHasher = None, exclude_ids: Iterable[int] = ()):
+        if mode not in ("link", "drop"):
+            raise ValueError(f"未知的去重模式: {mode}")
+        self.kb_name = kb_name
+        # 不作为候选的已入库片段 (替换文档时的旧版本，新版本不能折叠到即将删除的片段上)
+        self.exclude_ids = set(exclude_ids)
+        self.threshold = threshold
+        self.mode = mode
+        self.hasher = hasher or MinHasher()
+        self.collapsed = 0
+        # 本次上传中已保留、尚未写入片段库的片段: 文本哈希 -> 签名
+        self._pending: Dict[str, np.ndarray] = {}
+        self._pending_buckets: Dict[Tuple[int, int], List[str]] = {}
+        # 指向尚未入库片段的重复记录 (见 _link_row)，sync 拿到片段 id 后再写入
+        self._pending_links: Dict[str, List[tuple]] = {}
+        self._synced = False
+        # 流水线中 filter (切分线程) 与 sync (写索引线程) 并发调用
+        self._lock = threading.RLock()
+
+    # ---- LSH 查询 ----
+
+    def _stored_candidates(self, conn, buckets: List[int]) -> List[int]:
+        ids = set()
+        for band, bucket in enumerate(buckets):
+            for (chunk_id,) in conn.execute(
+                "SELECT chunk_id FROM dedup_lsh WHERE band = ? AND bucket = ?", (band, bucket)
+            ):
+                ids.add(chunk_id)
+        return list(ids)
+
+    def _load_signatures(self, conn, chunk_ids: List[int]) -> Dict[int, np.ndarray]:
+        result: Dict[int, np.ndarray] = {}
+        for start in range(0, len(chunk_ids), _QUERY_BATCH):
+            part = chunk_ids[start:start + _QUERY_BATCH]
+            placeholders = ",".join("?" * len(part))
+            for chunk_id, blob in conn.execute(
+                f"SELECT chunk_id, signature FROM dedup_signatures WHERE chunk_id IN ({placeholders})", part
+            ):
+                result[chunk_id] = np.frombuffer(blob, dtype=np.uint32)
+        return result
+
+    def _best_match(self, conn, signature: np.ndarray, buckets: List[int]) -> Tuple[Any, float]:
+        """返回 (已入库片段 id 或待入库片段的文本哈希, 相似度)，没有达到阈值的候选时返回 (None, 0)。"""
+        best, best_sim = None, 0.0
+        if conn is not None:
+            stored = [i for i in self._stored_candidates(conn, buckets) if i not in self.exclude_ids]
+            for chunk_id, cand in self._load_signatures(conn, stored).items():
+                sim = self.hasher.similarity(signature, cand)
+                if sim > best_sim:
+                    best, best_sim = chunk_id, sim
+        pending = {key for band, bucket in enumerate(buckets) for key in self._pending_buckets.get((band, bucket), ())}
+        for key in pending:
+            sim = self.hasher.similarity(signature, self._pending[key])
+            if sim > best_sim:
+                best, best_sim = key, sim
+        if best_sim >= self.threshold:
+            return best, best_sim
+        return None, 0.0
+
+    # ---- 对外接口 ----
+
+    def filter(self, docs: Sequence[Document]) -> List[Document]:
+        """剔除近重复片段，返回保留的片段 (保持原顺序)。"""
+        if not docs:
+            return []
+        with self._lock:
+            return self._filter(docs)
+
+    def _filter(self, docs: Sequence[Document]) -> List[Document]:
+        if not self._synced:
+            self.sync()
+
+        kept: List[Document] = []
+        links = []
+        with chunk_store.get_connection(self.kb_name) as conn:
+            if conn is not None:
+                _prepare(conn, self.kb_name)
+            for doc in docs:
+                signature = self.hasher.signature(doc.page_content)
+                if signature is None:
+                    kept.append(doc)
+                    continue
+                buckets = self.hasher.buckets(signature)
+                match, sim = self._best_match(conn, signature, buckets)
+                if match is None:
+                    key = _text_key(doc.page_content)
+                    if key not in self._pending:
+                        self._pending[key] = signature
+                        for band, bucket in enumerate(buckets):
+                            self._pending_buckets.setdefault((band, bucket), []).append(key)
+                    kept.append(doc)
+                    continue
+
+                self.collapsed += 1
+                if self.mode == "link":
+                    link = _link_row(doc, sim)
+                    if isinstance(match, str):
+                        self._pending_links.setdefault(match, []).append(link)
+                    else:
+                        links.append((match, *link))
+            if links:
+                conn.executemany(_INSERT_LINK, links)
+        return kept
+
+    def sync(self):
+        """把片段库中尚未建立签名的片段 (本次新写入的、或旧知识库的存量片段) 加入 LSH 索引。"""
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        self._synced = True
+        if not chunk_store.kb_exists(self.kb_name):
+            return
+        with chunk_store.get_connection(self.kb_name, create=True) as conn:
+            _prepare(conn, self.kb_name)
+            row = conn.execute("SELECT MAX(chunk_id) FROM dedup_signatures").fetchone()
+        start_id = (row[0] + 1) if row and row[0] is not None else 0
+        if start_id >= chunk_store.get_manifest(self.kb_name)["next_id"]:
+            return
+
+        indexed = 0
+        sig_rows, bucket_rows, link_rows = [], [], []
+
+        def _flush():
+            with chunk_store.get_connection(self.kb_name, create=True) as conn:
+                conn.executemany("INSERT OR REPLACE INTO dedup_signatures (chunk_id, signature) VALUES (?, ?)", sig_rows)
+                conn.executemany("INSERT OR IGNORE INTO dedup_lsh (band, bucket, chunk_id) VALUES (?, ?, ?)", bucket_rows)
+                conn.executemany(_INSERT_LINK, link_rows)
+            sig_rows.clear()
+            bucket_rows.clear()
+            link_rows.clear()
+
+        for item in chunk_store.iter_chunks(self.kb_name, start_id=start_id):
+            key = _text_key(item["page_content"])
+            signature = self._pending.pop(key, None)
+            if signature is None:
+                signature = self.hasher.signature(item["page_content"])
+            else:
+                for band, bucket in enumerate(self.hasher.buckets(signature)):
+                    keys = self._pending_buckets.get((band, bucket))
+                    if keys and key in keys:
+                        keys.remove(key)
+            if signature is None:
+                continue
+            sig_rows.append((item["id"], signature.tobytes()))
+            bucket_rows.extend((band, bucket, item["id"]) for band, bucket in enumerate(self.hasher.buckets(signature)))
+            link_rows.extend((item["id"], *link) for link in self._pending_links.pop(key, ()))
+            indexed += 1
+            if len(sig_rows) >= 1000:
+                _flush()
+        if sig_rows:
+            _flush()
+        if start_id > 0 or indexed > 1000:
+            logger.info(f"知识库 {self.kb_name}: 近重复索引补齐 {indexed} 个片段")
+
+
+def _text_key(text: str) -> str:
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def _link_row(doc: Document, sim: float) -> tuple:
+    """重复记录 (source, page, similarity, page_content, metadata)，正文用于 canonical 片段删除后恢复。"""
+    meta = {k: v for k, v in doc.metadata.items() if k != "chunk_id"}
+    return (
+        meta.get("source"), meta.get("page"), round(sim, 4),
+        doc.page_content, json.dumps(meta, ensure_ascii=False, default=str),
+    )
+
+
+def new_detector(kb_name: str, exclude_ids: Iterable[int] = ()) -> Optional[NearDuplicateDetector]:
+    """按配置创建检测器，关闭去重时返回 None。"""
+    if not KB_DEDUP_ENABLED:
+        return None
+    return NearDuplicateDetector(kb_name, exclude_ids=exclude_ids)
+
+
+def filter_duplicates(detector: Optional[NearDuplicateDetector], docs: List[Document]) -> List[Document]:
+    """向量化前剔除近重复片段；未启用或检测失败时原样返回，不影响入库。"""
+    if detector is None or not docs:
+        return docs
+    try:
+        kept = detector.filter(docs)
+    except Exception as e:
+        logger.error(f"知识库 {detector.kb_name}: 近重复检测失败，本批不去重: {e}", exc_info=True)
+        return docs
+    if len(kept) < len(docs):
+        logger.info(f"知识库 {detector.kb_name}: 折叠近重复片段 {len(docs) - len(kept)}/{len(docs)}")
+    return kept
+
+
+def get_duplicate_links(kb_name: str, chunk_ids: Sequence[int] = None) -> Dict[int, List[Dict[str, Any]]]:
+    """返回 {已入库片段 id: [{"source", "page", "similarity"}, ...]}，即被折叠到该片段上的重复来源。"""
+    result: Dict[int, List[Dict[str, Any]]] = {}
+    with chunk_store.get_connection(kb_name) as conn:
+        if conn is None:
+            return result
+        _prepare(conn, kb_name)
+        if chunk_ids is None:
+            rows = conn.execute("SELECT canonical_id, source, page, similarity FROM dedup_links ORDER BY id")
+        else:
+            ids = list(dict.fromkeys(int(i) for i in chunk_ids))
+            rows = []
+            for start in range(0, len(ids), _QUERY_BATCH):
+                part = ids[start:start + _QUERY_BATCH]
+                placeholders = ",".join("?" * len(part))
+                rows.extend(conn.execute(
+                    f"SELECT canonical_id, source, page, similarity FROM dedup_links "
+                    f"WHERE canonical_id IN ({placeholders}) ORDER BY id",
+                    part,
+                ))
+        for canonical_id, source, page, similarity in rows:
+            result.setdefault(canonical_id, []).append({"source": source, "page": page, "similarity": similarity})
+    return result
+
+
+def orphaned_duplicates(kb_name: str, chunk_ids: Sequence[int],
+                        removed_source: str = None) -> List[Tuple[int, Document, List[tuple]]]:
+    """
+    这些片段删除后会失去 canonical 的重复记录 (来源为 removed_source 的除外，它们随文档一起删除)。
+    每个被删片段上的第一条记录提升为待重新入库的片段，同组其余记录之后改为指向它：
+    返回 [(被删片段 id, 待入库文档, [(source, page, similarity, page_content, metadata), ...])]。
+    旧版未保存正文的记录无法恢复，只记日志。
+    """
+    groups: Dict[int, List[tuple]] = {}
+    lost = 0
+    with chunk_store.get_connection(kb_name) as conn:
+        if conn is None:
+            return []
+        _prepare(conn, kb_name)
+        ids = list(dict.fromkeys(int(i) for i in chunk_ids))
+        for start in range(0, len(ids), _QUERY_BATCH):
+            part = ids[start:start + _QUERY_BATCH]
+            placeholders = ",".join("?" * len(part))
+            for row in conn.execute(
+                f"SELECT {_LINK_COLUMNS} FROM dedup_links WHERE canonical_id IN ({placeholders}) ORDER BY id", part
+            ):
+                if removed_source is not None and row[1] == removed_source:
+                    continue
+                if row[4] is None:
+                    lost += 1
+                    continue
+                groups.setdefault(row[0], []).append(tuple(row[1:]))
+    if lost:
+        logger.warning(f"知识库 {kb_name}: {lost} 条旧版重复记录未保存正文，无法随 canonical 片段删除而恢复")
+
+    result = []
+    for canonical_id, links in groups.items():
+        _, _, _, content, meta = links[0]
+        doc = Document(page_content=content, metadata=json.loads(meta) if meta else {})
+        result.append((canonical_id, doc, links[1:]))
+    return result
+
+
+def add_links(kb_name: str, links: Sequence[tuple]):
+    """写入重复记录 [(canonical_id, source, page, similarity, page_content, metadata)]。"""
+    if not links:
+        return
+    with chunk_store.get_connection(kb_name, create=True) as conn:
+        _prepare(conn, kb_name)
+        conn.executemany(_INSERT_LINK, links)
+
+
+def last_link_id(kb_name: str) -> int:
+    """当前最大的重复记录 id (没有记录时为 0)，用于区分之后新写入的记录。"""
+    with chunk_store.get_connection(kb_name) as conn:
+        if conn is None:
+            return 0
+        _prepare(conn, kb_name)
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM dedup_links").fetchone()[0]
+
+
+def remove_links_after(kb_name: str, link_id: int):
+    """删除 id > link_id 的重复记录 (撤销一次失败的写入)。"""
+    with chunk_store.get_connection(kb_name) as conn:
+        if conn is None:
+            return
+        _prepare(conn, kb_name)
+        conn.execute("DELETE FROM dedup_links WHERE id > ?", (link_id,))
+
+
+def remove_chunks(kb_name: str, chunk_ids: Sequence[int], hasher: MinHasher = None,
+                  source: str = None, before_link: int = None):
+    """
+    删除片段的签名、LSH 桶以及折叠到这些片段上的重复记录；
+    source 不为空时一并删除该来源折叠到其他片段上的重复记录 (文档已删除)，
+    before_link 不为空时只删除其中 id <= before_link 的 (替换文档时保留新版本的记录)。
+    需要保留的重复片段先用 orphaned_duplicates 取出。
+    """
+    if not chunk_ids and source is None:
+        return
+    hasher = hasher or MinHasher()
+    with chunk_store.get_connection(kb_name) as conn:
+        if conn is None:
+            return
+        _prepare(conn, kb_name)
+        if source is not None:
+            conn.execute(
+                "DELETE FROM dedup_links WHERE source = ? AND id <= ?",
+                (source, before_link if before_link is not None else 2 ** 63 - 1),
+            )
+        ids = list(dict.fromkeys(int(i) for i in chunk_ids))
+        for start in range(0, len(ids), _QUERY_BATCH):
+            part = ids[start:start + _QUERY_BATCH]
+            placeholders = ",".join("?" * len(part))
+            rows = conn.execute(
+                f"SELECT chunk_id, signature FROM dedup_signatures WHERE chunk_id IN ({placeholders})", part
+            ).fetchall()
+            conn.executemany(
+                "DELETE FROM dedup_lsh WHERE band = ? AND bucket = ? AND chunk_id = ?",
+                [
+                    (band, bucket, chunk_id)
+                    for chunk_id, blob in rows
+                    for band, bucket in enumerate(hasher.buckets(np.frombuffer(blob, dtype=np.uint32)))
+                ],
+            )
+            conn.execute(f"DELETE FROM dedup_signatures WHERE chunk_id IN ({placeholders})", part)
+            conn.execute(f"DELETE FROM dedup_links WHERE canonical_id IN ({placeholders})", part)
+
+
+def count_duplicate_links(kb_name: str) -> int:
+    with chunk_store.get_connection(kb_name) as conn:
+        if conn is None:
+            return 0
+        _prepare(conn, kb_name)
+        return conn.execute("SELECT COUNT(*) FROM dedup_links").fetchone()[0]
@@ -0,0 +1,142 @@
+"""
+向量化结果缓存（内容哈希）。
+
+以 (模型名, 规范化文本的 SHA-256) 为键，把 Embedding 结果以 float32 二进制
+存入 storage/embedding_cache.db，所有知识库与 Copilot 会话共用。
+重复上传、mode=new 重建、跨知识库的相同页面都直接命中缓存，不再请求 API。
+
+规范化只合并空白字符 (与发送给 API 前去掉换行的处理一致)，不改变文本语义。
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from src.db import STORAGE_DIR
+from src.logger import get_logger
+
+logger = get_logger("EmbeddingCache")
+
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE", "1") != "0"
+EMBEDDING_CACHE_PATH = STORAGE_DIR / "embedding_cache.db"
+
+# SQLite 默认单条语句最多 999 个参数
+_QUERY_BATCH = 500
+
+
+def normalize_text(text: str) -> str:
+    """合并连续空白 (含换行) 为单个空格并去掉首尾空白。"""
+    return " ".join((text or "").split())
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """持久化的 Embedding 缓存，线程安全 (每次操作独立连接)。"""
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(str(self.db_path), timeout=60.0, check_same_thread=False)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                dim INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                PRIMARY KEY (model, hash)
+            ) WITHOUT ROWID
+            """)
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """按输入顺序返回缓存中的向量，未命中的位置为 None。"""
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        if not texts:
+            return results
+
+        positions: Dict[str, List[int]] = {}
+        for i, text in enumerate(texts):
+            if text and text.strip():
+                positions.setdefault(text_hash(text), []).append(i)
+
+        hashes = list(positions.keys())
+        try:
+            with self._connect() as conn:
+                for start in range(0, len(hashes), _QUERY_BATCH):
+                    part = hashes[start:start + _QUERY_BATCH]
+                    placeholders = ",".join("?" * len(part))
+                    rows = conn.execute(
+                        f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({placeholders})",
+                        [model, *part],
+                    )
+                    for h, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float32).tolist()
+                        for i in positions[h]:
+                            results[i] = vector
+        except sqlite3.Error as e:
+            logger.warning(f"读取 Embedding 缓存失败，全部按未命中处理: {e}")
+
+        hit = sum(1 for text, vec in zip(texts, results) if vec is not None)
+        with self._lock:
+            self.hits += hit
+            self.misses += len(texts) - hit
+        return results
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[Optional[List[float]]]):
+        """写入新计算的向量，None 结果 (调用失败) 不缓存。"""
+        rows = []
+        for text, vec in zip(texts, vectors):
+            if vec is None or not text or not text.strip():
+                continue
+            arr = np.asarray(vec, dtype=np.float32)
+            rows.append((model, text_hash(text), int(arr.shape[0]), arr.tobytes()))
+        if not rows:
+            return
+        try:
+            with self._connect() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, hash, dim, vector) VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"写入 Embedding 缓存失败: {e}")
+            return
+        with self._lock:
+            self.writes += len(rows)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": EMBEDDING_CACHE_ENABLED,
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH)
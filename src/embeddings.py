@@ -1,82 +1,286 @@
 import os
+import asyncio
+import weakref
 import requests
+import httpx
 import concurrent.futures
-from typing import List, Optional
+from typing import List, Optional, Sequence
 from langchain_core.embeddings import Embeddings
 from src.logger import get_logger
+from src.embedding_cache import EMBEDDING_CACHE_ENABLED, embedding_cache
+from src.query_embedding import query_embedder
+from src.rate_limit import embedding_rate_limiter
+from src.concurrency import get_controller, is_input_error, is_throttle_error
 
 logger = get_logger("Embeddings")
 
+# 单次请求打包的输入上限：条数 / 估算 token 数 / 字符数，任一达到即切分批次
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "16"))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "8000"))
+EMBEDDING_BATCH_MAX_CHARS = int(os.getenv("EMBEDDING_BATCH_MAX_CHARS", "16000"))
+# 自适应并发：初始并发数 / 上限，健康时加性增长，限流时减半
+EMBEDDING_INITIAL_CONCURRENCY = float(os.getenv("EMBEDDING_INITIAL_CONCURRENCY", "2"))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "16"))
+EMBEDDING_MAX_ATTEMPTS = int(os.getenv("EMBEDDING_MAX_ATTEMPTS", "4"))
+
+embedding_controller = get_controller(
+    "embedding",
+    initial=EMBEDDING_INITIAL_CONCURRENCY,
+    max_limit=EMBEDDING_MAX_CONCURRENCY,
+    latency_target=10.0,
+)
+
+# 异步客户端连接池大小 (keep-alive 复用)
+EMBEDDING_MAX_CONNECTIONS = int(os.getenv("EMBEDDING_MAX_CONNECTIONS", "10"))
+
+# 每个事件循环共用一个 httpx.AsyncClient，连接在请求之间复用
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+
+def _get_async_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=EMBEDDING_MAX_CONNECTIONS,
+                max_keepalive_connections=EMBEDDING_MAX_CONNECTIONS,
+            ),
+        )
+        _async_clients[loop] = client
+    return client
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符按 1 个计，其余按 4 个字符 1 个 token 计。"""
+    cjk = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def make_batches(texts: Sequence[str], indices: Sequence[int],
+                 max_items: int = EMBEDDING_BATCH_SIZE,
+                 max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS,
+                 max_chars: int = EMBEDDING_BATCH_MAX_CHARS) -> List[List[int]]:
+    """按条数、token、字符上限把待向量化的下标切成批次 (超长单条文本独占一批)。"""
+    batches: List[List[int]] = []
+    current: List[int] = []
+    tokens = chars = 0
+    for i in indices:
+        t, c = estimate_tokens(texts[i]), len(texts[i])
+        if current and (len(current) >= max_items or tokens + t > max_tokens or chars + c > max_chars):
+            batches.append(current)
+            current, tokens, chars = [], 0, 0
+        current.append(i)
+        tokens += t
+        chars += c
+    if current:
+        batches.append(current)
+    return batches
+
+
 class HunyuanEmbeddings(Embeddings):
     """
-    自定义腾讯混元 Embedding 适配器 (支持并发加速)
+    自定义腾讯混元 Embedding 适配器 (支持多输入批量请求与并发加速)
     """
     def __init__(self, api_key: str = None):
         self.api_key = api_key or os.getenv("HUNYUAN_API_KEY")
         self.api_url = "https://api.hunyuan.cloud.tencent.com/v1/embeddings"
         self.model_name = "hunyuan-embedding"
-        # 设置并发线程数，建议 5-10
-        self.max_workers = 2 # 降低并发数，防止触发腾讯 API 限流和内存不足
+        # 并发数由全局 AIMD 控制器 (embedding_controller) 按限流情况自动调整
+        # 内容哈希缓存：相同文本不再重复请求 API
+        self.use_cache = EMBEDDING_CACHE_ENABLED
 
-    def _call_api_single(self, text: str) -> Optional[List[float]]:
-        """单次 API 调用"""
-        if not text or not text.strip():
-            return None
-            
-        headers = {
+    def _headers(self) -> dict:
+        return {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"
         }
-        payload = {
+
+    def _call_api_batch(self, texts: List[str]) -> List[List[float]]:
+        """
+        一次请求向量化多条文本 (OpenAI 兼容接口的 input 支持列表)。
+        按返回的 index 字段映射回输入顺序；失败或条数不符时抛出异常，由调用方拆分重试。
+        限流 / 超时类错误在此按抖动退避重试，并发数受 embedding_controller 约束。
+        """
+        tokens = sum(estimate_tokens(t) for t in texts)
+
+        def _request():
+            response = requests.post(self.api_url, headers=self._headers(), json=self._batch_payload(texts), timeout=60)
+            response.raise_for_status()
+            return response.json()
+
+        data = embedding_controller.call(
+            _request, max_attempts=EMBEDDING_MAX_ATTEMPTS, before=lambda: embedding_rate_limiter.wait(tokens)
+        )
+        return self._parse_batch_response(data, len(texts))
+
+    def _batch_payload(self, texts: List[str]) -> dict:
+        return {
             "model": self.model_name,
-            "input": text.replace("\n", " ")
+            "input": [text.replace("\n", " ") for text in texts]
         }
-        
+
+    @staticmethod
+    def _parse_batch_response(data: dict, n_texts: int) -> List[List[float]]:
+        items = data.get("data") or []
+        if len(items) != n_texts:
+            raise ValueError(f"API 返回 {len(items)} 条向量，期望 {n_texts} 条")
+
+        results: List[Optional[List[float]]] = [None] * n_texts
+        for pos, item in enumerate(items):
+            results[item.get("index", pos)] = item["embedding"]
+        if any(r is None for r in results):
+            raise ValueError("API 返回的 index 不完整")
+        return results
+
+    def _embed_batch(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        批量向量化；输入类失败 (400 / 413 / 422，如单条输入非法、请求体过大) 或返回条数不符时
+        对半拆分重试，直到定位到失败的文本。
+        限流类失败已在 _call_api_batch 内重试过，鉴权 / 配置类失败 (401 / 403 / 404 等) 重发也不会成功，
+        拆分无益，整批记为失败。
+        """
         try:
-            response = requests.post(self.api_url, headers=headers, json=payload, timeout=30)
-            response.raise_for_status()
-            data = response.json()
-            if "data" in data and len(data["data"]) > 0:
-                return data["data"][0]["embedding"]
-            
-            logger.warning(f"API 返回数据格式异常: {data}")
-            return None
-        except requests.exceptions.Timeout:
-            logger.warning(f"Embedding API 超时: {text[:20]}...")
-            return None
+            return self._call_api_batch(texts)
         except Exception as e:
-            logger.error(f"Embedding API 调用错误: {e}")
-            return None
+            failed = self._handle_batch_error(texts, e)
+            if failed is not None:
+                return failed
+            mid = len(texts) // 2
+            return self._embed_batch(texts[:mid]) + self._embed_batch(texts[mid:])
+
+    @staticmethod
+    def _handle_batch_error(texts: List[str], error: Exception) -> Optional[List[None]]:
+        """返回整批失败结果；需要拆分重试时返回 None。"""
+        if is_throttle_error(error):
+            logger.error(f"Embedding API 重试 {EMBEDDING_MAX_ATTEMPTS} 次仍失败，{len(texts)} 条文本未能向量化: {error}")
+            return [None] * len(texts)
+        if not (is_input_error(error) or isinstance(error, ValueError)):
+            logger.error(f"Embedding API 调用错误，{len(texts)} 条文本未能向量化: {error}")
+            return [None] * len(texts)
+        if len(texts) == 1:
+            logger.error(f"Embedding API 调用错误: {error} ({texts[0][:20]}...)")
+            return [None]
+        mid = len(texts) // 2
+        logger.warning(f"批量 Embedding 请求失败 ({len(texts)} 条)，拆分为 {mid}+{len(texts) - mid} 重试: {error}")
+        return None
 
     def embed_documents(self, texts: List[str], progress_callback=None) -> List[List[float]]:
         """
-        并发为文档列表生成向量。
+        并发为文档列表生成向量，先查内容哈希缓存，只对未命中的文本调用 API。
         progress_callback: 可选的回调函数，用于更新 UI 进度条
         """
         logger.info(f"开始并发向量化，文档数量: {len(texts)}")
-        embeddings = [None] * len(texts)
-        
-        # 使用线程池并发处理
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            # 提交所有任务
-            future_to_index = {executor.submit(self._call_api_single, text): i for i, text in enumerate(texts)}
+        if self.use_cache:
+            embeddings = embedding_cache.get_many(self.model_name, texts)
+        else:
+            embeddings = [None] * len(texts)
+        pending = [i for i, emb in enumerate(embeddings) if emb is None]
+        cached_count = len(texts) - len(pending)
+        if self.use_cache and texts:
+            logger.info(f"Embedding 缓存命中 {cached_count}/{len(texts)} ({cached_count / len(texts):.0%})")
+
+        # 空文本不请求 API；其余按 token / 字符上限打包成多输入请求
+        pending = [i for i in pending if texts[i] and texts[i].strip()]
+        batches = make_batches(texts, pending)
+        completed_count = len(texts) - len(pending)
+        if progress_callback and completed_count:
+            progress_callback(completed_count, len(texts))
+
+        # 使用线程池并发处理各批次，实际并发由 embedding_controller 动态限制
+        workers = max(1, min(EMBEDDING_MAX_CONCURRENCY, len(batches)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            future_to_batch = {
+                executor.submit(self._embed_batch, [texts[i] for i in batch]): batch for batch in batches
+            }
             
-            completed_count = 0
-            for future in concurrent.futures.as_completed(future_to_index):
-                index = future_to_index[future]
+            for future in concurrent.futures.as_completed(future_to_batch):
+                batch = future_to_batch[future]
                 try:
-                    emb = future.result()
-                    embeddings[index] = emb
+                    batch_embs = future.result()
                 except Exception as e:
-                    logger.error(f"Worker Error at index {index}: {e}")
-                    embeddings[index] = None
+                    logger.error(f"Worker Error at batch {batch[0]}-{batch[-1]}: {e}")
+                    batch_embs = [None] * len(batch)
+                for index, emb in zip(batch, batch_embs):
+                    embeddings[index] = emb
                 
                 # 更新进度
-                completed_count += 1
+                completed_count += len(batch)
                 if progress_callback:
                     progress_callback(completed_count, len(texts))
+
+        if self.use_cache and pending:
+            embedding_cache.put_many(self.model_name, [texts[i] for i in pending], [embeddings[i] for i in pending])
                     
         return embeddings
 
     def embed_query(self, text: str) -> List[float]:
-        return self._call_api_single(text)
\ No newline at end of file
+        """查询向量化走 query_embedder：重复查询命中内存 LRU，并发查询合并为一次多输入请求。"""
+        if not text or not text.strip():
+            return None
+        return query_embedder.embed(text, self._embed_batch, namespace=(self.model_name, self.api_key))
+
+    # ===== 异步接口：供 async 路由 / 图节点使用，不阻塞事件循环 =====
+
+    async def _acall_api_batch(self, texts: List[str]) -> List[List[float]]:
+        tokens = sum(estimate_tokens(t) for t in texts)
+
+        async def _request():
+            response = await _get_async_client().post(self.api_url, headers=self._headers(), json=self._batch_payload(texts))
+            response.raise_for_status()
+            return response.json()
+
+        data = await embedding_controller.acall(
+            _request, max_attempts=EMBEDDING_MAX_ATTEMPTS, before=lambda: embedding_rate_limiter.acquire(tokens)
+        )
+        return self._parse_batch_response(data, len(texts))
+
+    async def _aembed_batch(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """_embed_batch 的异步版本。"""
+        try:
+            return await self._acall_api_batch(texts)
+        except Exception as e:
+            failed = self._handle_batch_error(texts, e)
+            if failed is not None:
+                return failed
+            mid = len(texts) // 2
+            return await self._aembed_batch(texts[:mid]) + await self._aembed_batch(texts[mid:])
+
+    async def aembed_documents(self, texts: List[str], progress_callback=None) -> List[List[float]]:
+        """embed_documents 的异步版本：共享连接池，按令牌桶限速，并发受 embedding_controller 约束。"""
+        logger.info(f"开始异步向量化，文档数量: {len(texts)}")
+        if self.use_cache:
+            embeddings = await asyncio.to_thread(embedding_cache.get_many, self.model_name, texts)
+        else:
+            embeddings = [None] * len(texts)
+        pending = [i for i, emb in enumerate(embeddings) if emb is None and texts[i] and texts[i].strip()]
+        cached_count = sum(1 for emb in embeddings if emb is not None)
+        if self.use_cache and texts:
+            logger.info(f"Embedding 缓存命中 {cached_count}/{len(texts)} ({cached_count / len(texts):.0%})")
+
+        completed_count = len(texts) - len(pending)
+        if progress_callback and completed_count:
+            progress_callback(completed_count, len(texts))
+
+        async def _run(batch: List[int]):
+            nonlocal completed_count
+            batch_embs = await self._aembed_batch([texts[i] for i in batch])
+            for index, emb in zip(batch, batch_embs):
+                embeddings[index] = emb
+            completed_count += len(batch)
+            if progress_callback:
+                progress_callback(completed_count, len(texts))
+
+        await asyncio.gather(*(_run(batch) for batch in make_batches(texts, pending)))
+
+        if self.use_cache and pending:
+            await asyncio.to_thread(
+                embedding_cache.put_many, self.model_name, [texts[i] for i in pending], [embeddings[i] for i in pending]
+            )
+        return embeddings
+
+    async def aembed_query(self, text: str) -> List[float]:
+        if not text or not text.strip():
+            return None
+        return await query_embedder.aembed(text, self._aembed_batch, namespace=(self.model_name, self.api_key))
\ No newline at end of file
@@ -0,0 +1,123 @@
+"""
+多知识库联合向量检索。
+
+以前选中多个知识库时，load_kbs 会用 merge_from 把各库的向量逐个拷进一个新索引，
+每次请求都要复制全部向量，内存翻倍，且索引类型不同 (flat / ivf / pq) 时无法合并。
+
+FederatedVectorStore 只持有各知识库缓存中的向量库引用，组合本身没有任何开销：
+- 查询向量只计算一次，各库在线程池中并行检索 (faiss 检索期间释放 GIL)；
+- 各库的得分先换算到统一的"越大越相似"尺度，再用堆按得分合并取 top-k；
+- 实现 LangChain VectorStore 接口，as_retriever() 等调用方式保持不变；
+- 检索方法接受 metadata_filter (见 src/metadata_filter.py)，各库先按元数据索引求出候选片段，
+  只在候选向量中检索，而不是全库检索后再过滤。
+"""
+import heapq
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from src.logger import get_logger
+from src.metadata_filter import parse_filter, resolve_chunk_ids
+from src.vector_index import docstore_positions, search_positions
+
+logger = get_logger("FederatedSearch")
+
+FEDERATED_SEARCH_WORKERS = int(os.getenv("FEDERATED_SEARCH_WORKERS", "8"))
+
+_executor = ThreadPoolExecutor(max_workers=FEDERATED_SEARCH_WORKERS, thread_name_prefix="kb-search")
+
+
+def normalize_score(vectorstore: FAISS, score: float) -> float:
+    """
+    把各库原始得分换算为"越大越相似"的统一尺度。
+    L2 索引返回平方距离 d，按单位向量下 d = 2 - 2·cos 换算为 1 - d/2 (对任意向量仍保持单调)；
+    内积索引的得分本身即相似度。
+    """
+    metric = getattr(vectorstore.index, "metric_type", faiss.METRIC_L2)
+    if metric == faiss.METRIC_INNER_PRODUCT:
+        return float(score)
+    return 1.0 - float(score) / 2.0
+
+
+class FederatedVectorStore(VectorStore):
+    """多个知识库向量库的只读联合视图。"""
+
+    def __init__(self, stores: Sequence[Tuple[str, FAISS]], embedding: Embeddings):
+        self.stores = list(stores)
+        self._embedding = embedding
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self._embedding
+
+    @property
+    def kb_names(self) -> List[str]:
+        return [name for name, _ in self.stores]
+
+    def _search_one(self, kb_name: str, vectorstore: FAISS, embedding: List[float], k: int,
+                    conditions: Dict[str, Dict[str, Any]] = None, **kwargs: Any) -> List[Tuple[float, Document]]:
+        try:
+            if conditions:
+                positions = docstore_positions(vectorstore)
+                chunk_ids = resolve_chunk_ids(kb_name, conditions)
+                candidates = [positions[key] for key in map(str, chunk_ids) if key in positions]
+                hits = search_positions(vectorstore, embedding, k, np.array(candidates, dtype="int64"))
+            else:
+                hits = vectorstore.similarity_search_with_score_by_vector(embedding, k=k, **kwargs)
+        except Exception as e:
+            logger.warning(f"知识库 {kb_name}: 向量检索失败: {e}")
+            return []
+        results = []
+        for doc, score in hits:
+            # 缓存中的 Document 由多个请求共享，复制后再标注来源知识库
+            tagged = Document(page_content=doc.page_content, metadata={**doc.metadata, "kb_name": kb_name})
+            results.append((normalize_score(vectorstore, score), tagged))
+        return results
+
+    def similarity_search_with_relevance_by_vector(self, embedding: List[float], k: int = 4,
+                                                   **kwargs: Any) -> List[Tuple[Document, float]]:
+        """返回 [(片段, 统一尺度得分)]，得分降序。kwargs 中的 metadata_filter 为元数据过滤表达式。"""
+        if not self.stores or k <= 0:
+            return []
+        conditions = parse_filter(kwargs.pop("metadata_filter", None))
+        if len(self.stores) == 1:
+            name, vs = self.stores[0]
+            per_kb = [self._search_one(name, vs, embedding, k, conditions, **kwargs)]
+        else:
+            futures = [
+                _executor.submit(self._search_one, name, vs, embedding, k, conditions, **kwargs)
+                for name, vs in self.stores
+            ]
+            per_kb = [f.result() for f in futures]
+        # 各库结果已按得分降序，堆合并后只取前 k 个
+        merged = heapq.merge(*per_kb, key=lambda item: item[0], reverse=True)
+        return [(doc, score) for score, doc in itertools.islice(merged, k)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_relevance_by_vector(self._embedding.embed_query(query), k, **kwargs)
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_relevance_by_vector(embedding, k, **kwargs)]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        # 得分已换算为相似度
+        return lambda score: score
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
+        raise TypeError("FederatedVectorStore 是只读视图，请通过 KBWriter (save_kb) 写入具体知识库")
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   **kwargs: Any) -> "FederatedVectorStore":
+        raise TypeError("FederatedVectorStore 是只读视图，只能由已有知识库组合而成，请通过 KBWriter (save_kb) 写入")
@@ -1,19 +1,28 @@
 # src/graphs/copilot_graph.py
+from collections import OrderedDict
 from typing import Any, Dict, List, Optional, Tuple
+import asyncio
 import json
 import re
+import threading
 
 from langchain_community.vectorstores import FAISS
 from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langgraph.graph import END, StateGraph
 
+from src.bm25 import SimpleBM25Retriever
 from src.db import STORAGE_DIR, create_copilot_session, get_copilot_messages, get_copilot_session
 from src.embeddings import HunyuanEmbeddings
+from src.hybrid_search import build_hybrid_retriever
+from src.mmr import MMR_LAMBDA
+from src.logger import get_logger
 from src.nodes.common import get_llm
 from src.state import CopilotState
 
 
+logger = get_logger("Copilot_Graph")
+
 llm = get_llm()
 llm_json_mode = get_llm().bind(response_format={"type": "json_object"})
 
@@ -205,11 +214,64 @@ def build_quote_context(chunks: List[Dict[str, Any]], target_idx: int, selected_
     return "\n\n".join(blocks), refs
 
 
+def chunk_to_document(chunk: Dict[str, Any]) -> Document:
+    return Document(
+        page_content=f"{chunk['section_title']}\n\n{chunk['content']}",
+        metadata={
+            "chunk_id": chunk["chunk_id"],
+            "section_id": chunk["section_id"],
+            "section_title": chunk["section_title"],
+            "section_index": chunk["section_index"],
+            "chunk_index": chunk["chunk_index"],
+            "preview": chunk["preview"],
+        },
+    )
+
+
+# 会话 id -> (meta 文件修改时间, BM25 检索器)，最多保留最近使用的 _SESSION_BM25_CACHE_SIZE 个会话
+_SESSION_BM25_CACHE_SIZE = 16
+_session_bm25: "OrderedDict[str, Tuple[int, SimpleBM25Retriever]]" = OrderedDict()
+_session_bm25_lock = threading.Lock()
+
+
+def get_session_bm25(session_id: str) -> Optional[SimpleBM25Retriever]:
+    """
+    会话段落的 BM25 检索器，按 meta 文件修改时间缓存分词结果：
+    会话重新初始化 (meta 重写) 后自动重建；meta 尚未写入或没有段落时返回 None 且不缓存。
+    """
+    meta_path = STORAGE_DIR / f"copilot_{session_id}_meta.json"
+    try:
+        version = meta_path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+    with _session_bm25_lock:
+        item = _session_bm25.get(session_id)
+        if item is not None and item[0] == version:
+            _session_bm25.move_to_end(session_id)
+            return item[1]
+
+    chunks = load_session_meta(session_id).get("chunks", [])
+    if not chunks:
+        return None
+    bm25 = SimpleBM25Retriever([chunk_to_document(chunk) for chunk in chunks])
+    with _session_bm25_lock:
+        _session_bm25[session_id] = (version, bm25)
+        _session_bm25.move_to_end(session_id)
+        while len(_session_bm25) > _SESSION_BM25_CACHE_SIZE:
+            _session_bm25.popitem(last=False)
+    return bm25
+
+
 def build_search_context(session_id: str, query: str) -> Tuple[str, List[Dict[str, Any]]]:
     embeddings = HunyuanEmbeddings()
     faiss_path = STORAGE_DIR / f"copilot_{session_id}_faiss"
     vector_store = FAISS.load_local(str(faiss_path), embeddings, allow_dangerous_deserialization=True)
-    docs = vector_store.similarity_search(query, k=4)
+    bm25 = get_session_bm25(session_id)
+    # 向量 + BM25 融合，术语 / 专有名词的精确匹配不会被语义相近的段落挤掉
+    retriever = build_hybrid_retriever(vector_store, bm25.search_with_scores if bm25 else None,
+                                       top_k=4, vector_k=8, bm25_k=8)
+    # 相邻段落有重叠，MMR 去掉近似重复的段落
+    docs = retriever.invoke(query, mmr_lambda=MMR_LAMBDA, fetch_k=12)
     refs = extract_references_from_docs(docs)
     context_blocks = []
     for doc in docs:
@@ -507,32 +569,35 @@ def save_session_node(state: CopilotState) -> CopilotState:
     return {"session_id": session_id}
 
 
-def vector_store_builder_node(state: CopilotState) -> CopilotState:
+async def vector_store_builder_node(state: CopilotState) -> CopilotState:
     formatted_md = state["formatted_markdown"]
     session_id = state["session_id"]
     raw_text = state["raw_text"]
     sections = state.get("sections", [])
     chunks = state.get("chunks", [])
 
-    documents = [
-        Document(
-            page_content=f"{chunk['section_title']}\n\n{chunk['content']}",
-            metadata={
-                "chunk_id": chunk["chunk_id"],
-                "section_id": chunk["section_id"],
-                "section_title": chunk["section_title"],
-                "section_index": chunk["section_index"],
-                "chunk_index": chunk["chunk_index"],
-                "preview": chunk["preview"],
-            },
-        )
-        for chunk in chunks
-    ]
+    documents = [chunk_to_document(chunk) for chunk in chunks]
 
+    # 异步向量化，避免初始化大文档时阻塞其他会话的流式输出
     embeddings = HunyuanEmbeddings()
-    vector_store = FAISS.from_documents(documents, embeddings)
+    texts = [doc.page_content for doc in documents]
+    vectors = await embeddings.aembed_documents(texts)
+    valid = [(doc, vec) for doc, vec in zip(documents, vectors) if vec]
+    if not valid:
+        raise RuntimeError(f"会话 {session_id}: {len(documents)} 个段落全部向量化失败，请检查 API Key 或网络")
+    if len(valid) < len(documents):
+        logger.warning(f"会话 {session_id}: {len(documents) - len(valid)}/{len(documents)} 个段落向量化失败，未写入向量索引")
+    # docstore 以 chunk_id 为键，MMR 按片段 id 定位已存的向量
+    ids = [str(doc.metadata.get("chunk_id")) for doc, _ in valid]
+    vector_store = await asyncio.to_thread(
+        FAISS.from_embeddings,
+        [(doc.page_content, vec) for doc, vec in valid],
+        embeddings,
+        [doc.metadata for doc, _ in valid],
+        ids if len(set(ids)) == len(ids) else None,
+    )
     faiss_path = STORAGE_DIR / f"copilot_{session_id}_faiss"
-    vector_store.save_local(str(faiss_path))
+    await asyncio.to_thread(vector_store.save_local, str(faiss_path))
 
     save_session_meta(session_id, raw_text, formatted_md, sections, chunks)
     return {"vector_store": vector_store}
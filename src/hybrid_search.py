@@ -0,0 +1,190 @@
+"""
+混合检索：向量检索 + BM25 的结果融合。
+
+以前 search_node 把向量结果和 BM25 结果直接拼接、按全文去重后截取前 6 条，
+向量结果总是排在前面，BM25 的得分被丢弃。这里：
+- 每路检索器单独设置召回深度 (k)，各自返回按相关度降序的 [(片段, 得分)]；
+- 融合方式：
+  * rrf (默认)：Reciprocal Rank Fusion，score = Σ w / (rrf_k + 名次)，只看名次，不受各路得分尺度影响；
+  * weighted：各路得分 min-max 归一化到 [0, 1] 后加权求和；
+- 同一片段按 (知识库, 片段 id) 去重 (没有 id 时退化为正文)，在多路中同时出现的片段得分累加。
+
+融合后的得分写在 metadata["fusion_score"]，命中的检索器写在 metadata["retrievers"]。
+调用时传 mmr_lambda 可在融合结果上再做 MMR 去冗余 (src/mmr.py)：先融合出 fetch_k 个候选再重选 top_k。
+"""
+import os
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+from src.federated_search import FederatedVectorStore, normalize_score
+from src.logger import get_logger
+from src.mmr import MMR_FETCH_K, mmr_rerank
+
+logger = get_logger("HybridSearch")
+
+FUSION_RRF = "rrf"
+FUSION_WEIGHTED = "weighted"
+
+HYBRID_FUSION = os.getenv("HYBRID_FUSION", FUSION_RRF)
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+HYBRID_VECTOR_K = int(os.getenv("HYBRID_VECTOR_K", "10"))
+HYBRID_BM25_K = int(os.getenv("HYBRID_BM25_K", "10"))
+HYBRID_VECTOR_WEIGHT = float(os.getenv("HYBRID_VECTOR_WEIGHT", "1.0"))
+HYBRID_BM25_WEIGHT = float(os.getenv("HYBRID_BM25_WEIGHT", "1.0"))
+
+# 检索器：(查询, k) -> 按相关度降序的 [(片段, 得分)]，得分越大越相关
+SearchFn = Callable[[str, int], List[Tuple[Document, float]]]
+
+
+def doc_key(doc: Document) -> Hashable:
+    """片段去重键：(知识库, 片段 id)，没有 id 的片段按正文去重。"""
+    meta = doc.metadata or {}
+    chunk_id = meta.get("chunk_id")
+    if chunk_id is None:
+        return ("content", doc.page_content)
+    return (meta.get("kb_name"), chunk_id)
+
+
+def _normalized(hits: List[Tuple[Document, float]]) -> List[float]:
+    scores = [float(score) for _, score in hits]
+    if not scores:
+        return []
+    low, high = min(scores), max(scores)
+    if high == low:
+        return [1.0] * len(scores)
+    return [(s - low) / (high - low) for s in scores]
+
+
+def fuse(ranked: Dict[str, List[Tuple[Document, float]]], k: int, method: str = None,
+         weights: Dict[str, float] = None, rrf_k: int = None) -> List[Tuple[Document, float]]:
+    """
+    融合多路检索结果，返回前 k 个 [(片段, 融合得分)]。
+    ranked: {检索器名: 按相关度降序的 [(片段, 得分)]}
+    """
+    method = method or HYBRID_FUSION
+    weights = weights or {}
+    rrf_k = HYBRID_RRF_K if rrf_k is None else rrf_k
+    if method not in (FUSION_RRF, FUSION_WEIGHTED):
+        raise ValueError(f"不支持的融合方式: {method}")
+
+    fused: Dict[Hashable, List] = {}  # key -> [得分, 片段, 命中的检索器]
+    for name, hits in ranked.items():
+        weight = weights.get(name, 1.0)
+        if method == FUSION_RRF:
+            contributions = [weight / (rrf_k + rank) for rank in range(1, len(hits) + 1)]
+        else:
+            contributions = [weight * s for s in _normalized(hits)]
+        seen = set()
+        for (doc, _), contribution in zip(hits, contributions):
+            key = doc_key(doc)
+            # 同一路里重复出现的片段只按最好的名次计一次
+            if key in seen:
+                continue
+            seen.add(key)
+            entry = fused.get(key)
+            if entry is None:
+                fused[key] = [contribution, doc, [name]]
+            else:
+                entry[0] += contribution
+                entry[2].append(name)
+
+    # 得分相同时按首次出现的顺序 (dict 保序 + 稳定排序)
+    top = sorted(fused.values(), key=lambda entry: entry[0], reverse=True)[:k]
+    results = []
+    for score, doc, names in top:
+        # 检索结果可能来自共享缓存，复制后再写入融合信息
+        tagged = Document(
+            page_content=doc.page_content,
+            metadata={**(doc.metadata or {}), "fusion_score": score, "retrievers": names},
+        )
+        results.append((tagged, score))
+    return results
+
+
+class HybridRetriever:
+    """
+    组合多路检索器并融合结果。
+
+    retriever = HybridRetriever(top_k=6)
+    retriever.add("vector", vector_search_fn, k=10, weight=1.0)
+    retriever.add("bm25", bm25_search_fn, k=10)
+    docs = retriever.invoke(query, queries={"bm25": f"{query} {keywords}"})
+    """
+
+    def __init__(self, top_k: int = 6, method: str = None, rrf_k: int = None, vector_store=None):
+        self.top_k = top_k
+        self.method = method or HYBRID_FUSION
+        self.rrf_k = HYBRID_RRF_K if rrf_k is None else rrf_k
+        # MMR 重选时从这里读取候选片段的向量
+        self.vector_store = vector_store
+        self._retrievers: List[Tuple[str, SearchFn, int, float]] = []
+
+    def add(self, name: str, search_fn: SearchFn, k: int, weight: float = 1.0) -> "HybridRetriever":
+        self._retrievers.append((name, search_fn, k, weight))
+        return self
+
+    def search_with_scores(self, query: str, queries: Dict[str, str] = None, top_k: int = None,
+                           mmr_lambda: float = None, fetch_k: int = None) -> List[Tuple[Document, float]]:
+        """
+        queries 可为个别检索器指定不同的查询串 (如 BM25 使用扩展关键词)。
+        mmr_lambda 不为 None 时先融合出 fetch_k 个候选，再按 MMR 选出 top_k 个
+        (λ 越小越强调多样性，1 等价于不做 MMR)。
+        """
+        top_k = top_k or self.top_k
+        if mmr_lambda is None:
+            return self._fused(query, queries, top_k)
+        candidates = self._fused(query, queries, max(top_k, fetch_k or MMR_FETCH_K))
+        return mmr_rerank(candidates, self.vector_store, top_k, mmr_lambda)
+
+    def _fused(self, query: str, queries: Optional[Dict[str, str]], top_k: int) -> List[Tuple[Document, float]]:
+        queries = queries or {}
+        ranked: Dict[str, List[Tuple[Document, float]]] = {}
+        for name, search_fn, k, _ in self._retrievers:
+            try:
+                ranked[name] = search_fn(queries.get(name, query), k) if k > 0 else []
+            except Exception as e:
+                logger.warning(f"{name} 检索失败: {e}")
+                ranked[name] = []
+        weights = {name: weight for name, _, _, weight in self._retrievers}
+        return fuse(ranked, top_k, method=self.method, weights=weights, rrf_k=self.rrf_k)
+
+    def invoke(self, query: str, queries: Dict[str, str] = None, top_k: int = None,
+               mmr_lambda: float = None, fetch_k: int = None) -> List[Document]:
+        hits = self.search_with_scores(query, queries=queries, top_k=top_k, mmr_lambda=mmr_lambda, fetch_k=fetch_k)
+        return [doc for doc, _ in hits]
+
+
+def vector_search_fn(vector_store, metadata_filter: Dict = None) -> Optional[SearchFn]:
+    """
+    把向量库包装为检索器，得分统一为"越大越相似"。
+    metadata_filter 只对知识库的联合检索视图生效 (依赖片段库中的元数据索引)。
+    """
+    if vector_store is None:
+        return None
+    # 联合检索视图的得分已是相似度；单个 FAISS 返回的是距离 / 内积，需要换算
+    if isinstance(vector_store, FederatedVectorStore):
+        return lambda query, k: vector_store.similarity_search_with_score(query, k=k, metadata_filter=metadata_filter)
+    if metadata_filter:
+        logger.warning("该向量库不是知识库检索视图，忽略元数据过滤条件")
+
+    def _search(query: str, k: int) -> List[Tuple[Document, float]]:
+        return [(doc, normalize_score(vector_store, score))
+                for doc, score in vector_store.similarity_search_with_score(query, k=k)]
+    return _search
+
+
+def build_hybrid_retriever(vector_store=None, bm25_fn: Optional[SearchFn] = None, top_k: int = 6,
+                           vector_k: int = None, bm25_k: int = None, method: str = None,
+                           metadata_filter: Dict = None) -> HybridRetriever:
+    """
+    按环境变量中的默认深度 / 权重组合向量检索与 BM25。
+    metadata_filter 作用于向量检索；bm25_fn 需由调用方自行带上同样的过滤条件。
+    """
+    retriever = HybridRetriever(top_k=top_k, method=method, vector_store=vector_store)
+    vector_fn = vector_search_fn(vector_store, metadata_filter)
+    if vector_fn is not None:
+        retriever.add("vector", vector_fn, HYBRID_VECTOR_K if vector_k is None else vector_k, HYBRID_VECTOR_WEIGHT)
+    if bm25_fn is not None:
+        retriever.add("bm25", bm25_fn, HYBRID_BM25_K if bm25_k is None else bm25_k, HYBRID_BM25_WEIGHT)
+    return retriever
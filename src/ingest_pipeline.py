@@ -0,0 +1,239 @@
+"""
+流水线式入库：解析 → 切分 → 向量化 → 写索引。
+
+各阶段运行在独立线程中，通过有界队列衔接 (背压)：
+- 解析阶段逐页产出文本，大 PDF 的前几页切分完即可开始向量化；
+- 切分后先剔除与知识库已有片段 / 本次上传中其他片段近重复的片段，不再向量化；
+- 向量化的同时把该批片段提交到分词进程池 (src/tokenizer.py)，写索引时直接取用词元；
+- 任一时刻内存中只有队列容量内的页面 / 片段批次，不会持有整份上传的文本；
+- 写索引阶段在调用线程中串行追加片段与向量，保证两者顺序一致 (可断点续传)。
+
+每个阶段统计处理条数与耗时，结束时输出吞吐，便于定位瓶颈。
+"""
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+from src.dedup import NearDuplicateDetector, filter_duplicates, new_detector
+from src.embeddings import HunyuanEmbeddings
+from src.logger import get_logger
+from src.storage import KBWriter, get_kb_tokenizer
+from src.tokenizer import tokenize_async
+from src.utils import iter_documents_from_path, split_documents
+
+logger = get_logger("IngestPipeline")
+
+# 每个向量化批次的片段数 / 阶段间队列容量 / 并行向量化的批次数
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "64"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "4"))
+INGEST_EMBED_WORKERS = int(os.getenv("INGEST_EMBED_WORKERS", "2"))
+
+_DONE = object()
+
+
+class IngestCancelled(Exception):
+    """入库任务被取消。"""
+
+
+class StageStats:
+    """单个阶段的处理条数与忙碌时间。"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, items: int, seconds: float):
+        with self._lock:
+            self.items += items
+            self.busy += seconds
+
+    def to_dict(self, wall: float) -> Dict[str, Any]:
+        return {
+            "items": self.items,
+            "busy_seconds": round(self.busy, 3),
+            "items_per_sec": round(self.items / self.busy, 2) if self.busy > 0 else None,
+            "utilization": round(self.busy / wall, 3) if wall > 0 else None,
+        }
+
+
+class _Pipeline:
+    def __init__(self, stop: threading.Event, cancel_event: Optional[threading.Event]):
+        self.stop = stop
+        self.cancel_event = cancel_event
+        self.error: Optional[BaseException] = None
+
+    def stopped(self) -> bool:
+        return self.stop.is_set() or (self.cancel_event is not None and self.cancel_event.is_set())
+
+    def put(self, q: queue.Queue, item: Any):
+        """阻塞写入队列 (背压)，流水线停止时放弃。"""
+        while not self.stopped():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise IngestCancelled()
+
+    def get(self, q: queue.Queue) -> Any:
+        while not self.stopped():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        raise IngestCancelled()
+
+    def run_stage(self, target: Callable[[], None]) -> threading.Thread:
+        def _wrapper():
+            try:
+                target()
+            except IngestCancelled:
+                pass
+            except BaseException as e:
+                logger.error(f"入库流水线阶段异常: {e}", exc_info=True)
+                if self.error is None:
+                    self.error = e
+                self.stop.set()
+
+        thread = threading.Thread(target=_wrapper, daemon=True)
+        thread.start()
+        return thread
+
+
+def run_ingest_pipeline(
+    kb_name: str,
+    files: Iterable[Tuple[str, str]],
+    language: str = "Chinese",
+    index_type: str = None,
+    progress_callback: Callable[[int, int], None] = None,
+    cancel_event: Optional[threading.Event] = None,
+    batch_size: int = INGEST_BATCH_SIZE,
+    queue_size: int = INGEST_QUEUE_SIZE,
+    embed_workers: int = INGEST_EMBED_WORKERS,
+    detector: Optional[NearDuplicateDetector] = None,
+) -> Dict[str, Any]:
+    """
+    流式入库若干文件。
+    files: [(本地路径, 原始文件名), ...]
+    progress_callback: 回调 (已写入片段数, 已切分片段数)，总量在解析完成前未知
+    cancel_event: 置位后尽快停止，已写入的部分保留并可断点续传
+    detector: 近重复检测器，不传时按配置新建 (替换文档时由 replace_documents 传入)
+    返回 {"chunks", "vectors", "duplicates", "seconds", "stages": {阶段名: 吞吐统计}}
+    """
+    stop = threading.Event()
+    pipe = _Pipeline(stop, cancel_event)
+    page_q: queue.Queue = queue.Queue(maxsize=queue_size)
+    chunk_q: queue.Queue = queue.Queue(maxsize=queue_size)
+    vector_q: queue.Queue = queue.Queue(maxsize=queue_size)
+    stats = {name: StageStats(name) for name in ("parse", "split", "embed", "index")}
+    produced = [0]
+    embeddings = HunyuanEmbeddings()
+    detector = detector or new_detector(kb_name)
+    tokenizer = get_kb_tokenizer(kb_name)
+    submitted = [0]
+
+    def _parse():
+        for path, filename in files:
+            pages = iter_documents_from_path(path, filename)
+            while True:
+                start = time.monotonic()
+                page = next(pages, None)
+                if page is None:
+                    break
+                stats["parse"].record(1, time.monotonic() - start)
+                pipe.put(page_q, page)
+        pipe.put(page_q, _DONE)
+
+    def _split():
+        buffer: List[Document] = []
+        while True:
+            page = pipe.get(page_q)
+            if page is _DONE:
+                break
+            start = time.monotonic()
+            chunks = split_documents([page])
+            submitted[0] += len(chunks)
+            chunks = filter_duplicates(detector, chunks)
+            stats["split"].record(len(chunks), time.monotonic() - start)
+            buffer.extend(chunks)
+            while len(buffer) >= batch_size:
+                batch, buffer = buffer[:batch_size], buffer[batch_size:]
+                produced[0] += len(batch)
+                pipe.put(chunk_q, batch)
+        if buffer:
+            produced[0] += len(buffer)
+            pipe.put(chunk_q, buffer)
+        for _ in range(embed_workers):
+            pipe.put(chunk_q, _DONE)
+
+    def _embed():
+        while True:
+            batch = pipe.get(chunk_q)
+            if batch is _DONE:
+                break
+            start = time.monotonic()
+            texts = [d.page_content for d in batch]
+            # 分词在子进程中与向量化并行，不占用本线程
+            terms = tokenize_async(texts, tokenizer)
+            vectors = embeddings.embed_documents(texts)
+            stats["embed"].record(len(batch), time.monotonic() - start)
+            pipe.put(vector_q, (batch, vectors, terms))
+        pipe.put(vector_q, _DONE)
+
+    wall_start = time.monotonic()
+    threads = [pipe.run_stage(_parse), pipe.run_stage(_split)]
+    threads += [pipe.run_stage(_embed) for _ in range(embed_workers)]
+
+    writer = KBWriter(kb_name, language=language, index_type=index_type, embeddings=embeddings, detector=detector)
+    try:
+        with writer:
+            finished = 0
+            while finished < embed_workers:
+                try:
+                    item = pipe.get(vector_q)
+                except IngestCancelled:
+                    if pipe.error is not None:
+                        raise pipe.error
+                    raise
+                if item is _DONE:
+                    finished += 1
+                    continue
+                batch, vectors, pending_terms = item
+                start = time.monotonic()
+                try:
+                    terms = pending_terms.result()
+                except Exception as e:
+                    logger.warning(f"批量分词失败，写入时重新分词: {e}")
+                    terms = None
+                writer.add_chunks(batch, terms=terms)
+                writer.add_embeddings(
+                    [d.page_content for d in batch], [d.metadata for d in batch], vectors
+                )
+                stats["index"].record(len(batch), time.monotonic() - start)
+                if progress_callback:
+                    progress_callback(writer.chunks_written, produced[0])
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=5)
+
+    wall = time.monotonic() - wall_start
+    result = {
+        "chunks": writer.chunks_written,
+        "vectors": writer.vectors_written,
+        "duplicates": submitted[0] - produced[0],
+        "seconds": round(wall, 3),
+        "stages": {name: s.to_dict(wall) for name, s in stats.items()},
+    }
+    logger.info(
+        f"知识库 {kb_name}: 流水线入库完成，片段 {result['chunks']}，向量 {result['vectors']}，"
+        f"折叠近重复 {result['duplicates']}，耗时 {wall:.1f}s；"
+        + "，".join(f"{name} {s['items_per_sec']}/s" for name, s in result["stages"].items())
+    )
+    return result
@@ -0,0 +1,448 @@
+"""
+后台任务队列（本地 SQLite）。
+
+知识库上传、粘贴文本入库、断点续传等耗时操作不再在 HTTP 请求内执行：
+接口提交任务后立即返回 job_id，由后台工作线程执行，客户端轮询或通过 SSE 获取进度。
+
+- 任务状态持久化在 storage/jobs.db，服务重启后可查询历史任务；
+  重启时仍标记为 running 但所属进程已不存在的任务会被标记为失败 (可再提交 resume 续传)；
+- 领取任务在 SQLite 写事务中完成，多个 worker 进程共享同一个队列时不会重复执行；
+- 并发限制：同一知识库同时最多 JOB_MAX_PER_KB 个任务，同一主机最多 JOB_MAX_PER_HOST 个任务；
+- 取消：排队中的任务直接取消，运行中的任务置取消标记，由任务在检查点处停止。
+"""
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from langchain_core.documents import Document
+
+from src.db import STORAGE_DIR
+from src.ingest_pipeline import IngestCancelled, run_ingest_pipeline
+from src.logger import get_logger
+from src.storage import (
+    delete_document,
+    delete_kb,
+    replace_documents,
+    resume_kb_embedding,
+    save_kb,
+    set_kb_tokenizer,
+    upsert_document,
+)
+from src.utils import split_documents
+
+logger = get_logger("Jobs")
+
+JOBS_DB_PATH = STORAGE_DIR / "jobs.db"
+JOB_UPLOAD_DIR = STORAGE_DIR / "job_uploads"
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_PER_KB = int(os.getenv("JOB_MAX_PER_KB", "1"))
+JOB_MAX_PER_HOST = int(os.getenv("JOB_MAX_PER_HOST", "2"))
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_SUCCEEDED = "succeeded"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+TERMINAL_STATUSES = (STATUS_SUCCEEDED, STATUS_FAILED, STATUS_CANCELLED)
+
+HOSTNAME = socket.gethostname()
+
+# 进度写库 / 取消标记检查的最小间隔 (秒)
+_PROGRESS_INTERVAL = 0.5
+
+
+class JobCancelled(Exception):
+    """任务被取消。"""
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobContext:
+    """传给任务处理函数的上下文：上报进度、感知取消。"""
+
+    def __init__(self, manager: "JobManager", job: Dict[str, Any]):
+        self.manager = manager
+        self.job_id = job["id"]
+        self.kind = job["kind"]
+        self.kb_name = job["kb_name"]
+        self.params = job["params"]
+        self.cancel_event = threading.Event()
+        self._last_flush = 0.0
+
+    def progress(self, current: int, total: int, message: Optional[str] = None):
+        now = time.monotonic()
+        if now - self._last_flush < _PROGRESS_INTERVAL and current < total:
+            return
+        self._last_flush = now
+        cancel_requested = self.manager._update_progress(self.job_id, current, total, message)
+        if cancel_requested:
+            self.cancel_event.set()
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+
+
+class JobManager:
+    def __init__(self, db_path: Path, workers: int = JOB_WORKERS,
+                 max_per_kb: int = JOB_MAX_PER_KB, max_per_host: int = JOB_MAX_PER_HOST):
+        self.db_path = Path(db_path)
+        self.workers = workers
+        self.max_per_kb = max_per_kb
+        self.max_per_host = max_per_host
+        self._handlers: Dict[str, Callable[[JobContext], Any]] = {}
+        self._running: Dict[str, JobContext] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._stopping = threading.Event()
+        self._init_schema()
+
+    # ===== 存储 =====
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(str(self.db_path), timeout=60.0, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"任务队列事务回滚: {e}")
+            raise e
+        finally:
+            conn.close()
+
+    def _init_schema(self):
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                kb_name TEXT,
+                status TEXT NOT NULL,
+                params TEXT,
+                progress_current INTEGER DEFAULT 0,
+                progress_total INTEGER DEFAULT 0,
+                message TEXT,
+                result TEXT,
+                error TEXT,
+                cancel_requested INTEGER DEFAULT 0,
+                host TEXT,
+                pid INTEGER,
+                created_at TEXT,
+                started_at TEXT,
+                finished_at TEXT
+            )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_kb ON jobs(kb_name, created_at)")
+
+    @staticmethod
+    def _row_to_job(row: sqlite3.Row) -> Dict[str, Any]:
+        job = dict(row)
+        job["params"] = json.loads(job["params"]) if job["params"] else {}
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        job["cancel_requested"] = bool(job["cancel_requested"])
+        return job
+
+    def _update_progress(self, job_id: str, current: int, total: int, message: Optional[str]) -> bool:
+        """写入进度，返回是否已被请求取消 (支持其他进程发起的取消)。"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET progress_current = ?, progress_total = ?, message = COALESCE(?, message) WHERE id = ?",
+                (current, total, message, job_id),
+            )
+            row = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row["cancel_requested"])
+
+    def _finish(self, job_id: str, status: str, result: Any = None, error: Optional[str] = None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+                (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, _now(), job_id),
+            )
+
+    # ===== 对外接口 =====
+
+    def register(self, kind: str, handler: Callable[[JobContext], Any]):
+        self._handlers[kind] = handler
+
+    def submit(self, kind: str, kb_name: Optional[str], params: Optional[Dict[str, Any]] = None) -> str:
+        if kind not in self._handlers:
+            raise ValueError(f"未知的任务类型: {kind}")
+        job_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, kb_name, status, params, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, kind, kb_name, STATUS_QUEUED, json.dumps(params or {}, ensure_ascii=False), _now()),
+            )
+        logger.info(f"提交任务 {job_id} ({kind}, 知识库 {kb_name})")
+        self.start()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def list_jobs(self, kb_name: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        with self._connect() as conn:
+            if kb_name:
+                rows = conn.execute(
+                    "SELECT * FROM jobs WHERE kb_name = ? ORDER BY rowid DESC LIMIT ?", (kb_name, limit)
+                ).fetchall()
+            else:
+                rows = conn.execute("SELECT * FROM jobs ORDER BY rowid DESC LIMIT ?", (limit,)).fetchall()
+        return [self._row_to_job(r) for r in rows]
+
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """取消任务：排队中直接取消；运行中置取消标记，由任务在检查点停止。"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status = ?",
+                (STATUS_CANCELLED, _now(), job_id, STATUS_QUEUED),
+            )
+            conn.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?", (job_id, STATUS_RUNNING)
+            )
+        with self._lock:
+            ctx = self._running.get(job_id)
+        if ctx is not None:
+            ctx.cancel_event.set()
+        job = self.get(job_id)
+        if job and job["status"] == STATUS_CANCELLED and job["params"].get("upload_dir"):
+            shutil.rmtree(job["params"]["upload_dir"], ignore_errors=True)
+        return job
+
+    # ===== 调度 =====
+
+    def start(self):
+        """启动工作线程 (幂等)，并回收上次异常退出遗留的 running 任务。"""
+        with self._lock:
+            if self._threads:
+                return
+            self._recover_stale_jobs()
+            self._stopping.clear()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker_loop, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        self._stopping.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        with self._lock:
+            for ctx in self._running.values():
+                ctx.cancel_event.set()
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join(timeout=5)
+
+    def _recover_stale_jobs(self):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, pid FROM jobs WHERE status = ? AND host = ?", (STATUS_RUNNING, HOSTNAME)
+            ).fetchall()
+            for row in rows:
+                if row["pid"] and row["pid"] != os.getpid() and _pid_alive(row["pid"]):
+                    continue
+                conn.execute(
+                    "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                    (STATUS_FAILED, "服务重启，任务中断 (可提交 resume 从断点续传)", _now(), row["id"]),
+                )
+                logger.warning(f"任务 {row['id']} 所属进程已退出，标记为失败")
+
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        """在写事务中领取一个满足并发限制的排队任务。"""
+        conn = sqlite3.connect(str(self.db_path), timeout=60.0, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            host_running = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND host = ?", (STATUS_RUNNING, HOSTNAME)
+            ).fetchone()[0]
+            if host_running >= self.max_per_host:
+                conn.execute("ROLLBACK")
+                return None
+            row = conn.execute(
+                """
+                SELECT * FROM jobs j WHERE j.status = ?
+                AND (j.kb_name IS NULL OR (
+                    SELECT COUNT(*) FROM jobs r WHERE r.status = ? AND r.kb_name = j.kb_name
+                ) < ?)
+                ORDER BY j.rowid LIMIT 1
+                """,
+                (STATUS_QUEUED, STATUS_RUNNING, self.max_per_kb),
+            ).fetchone()
+            if row is None:
+                conn.execute("ROLLBACK")
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, host = ?, pid = ?, started_at = ? WHERE id = ?",
+                (STATUS_RUNNING, HOSTNAME, os.getpid(), _now(), row["id"]),
+            )
+            conn.execute("COMMIT")
+            return self._row_to_job(row)
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _worker_loop(self):
+        while not self._stopping.is_set():
+            try:
+                job = self._claim()
+            except Exception as e:
+                logger.error(f"领取任务失败: {e}", exc_info=True)
+                job = None
+            if job is None:
+                # 其他进程提交的任务只能靠轮询发现，本进程提交时会立即唤醒
+                with self._wakeup:
+                    self._wakeup.wait(timeout=1.0)
+                continue
+            self._run(job)
+            with self._wakeup:
+                self._wakeup.notify_all()
+
+    def _run(self, job: Dict[str, Any]):
+        ctx = JobContext(self, job)
+        with self._lock:
+            self._running[job["id"]] = ctx
+        logger.info(f"开始执行任务 {job['id']} ({job['kind']}, 知识库 {job['kb_name']})")
+        try:
+            result = self._handlers[job["kind"]](ctx)
+            if ctx.cancel_event.is_set():
+                self._finish(job["id"], STATUS_CANCELLED, result=result)
+            else:
+                self._finish(job["id"], STATUS_SUCCEEDED, result=result)
+            logger.info(f"任务 {job['id']} 结束")
+        except JobCancelled:
+            self._finish(job["id"], STATUS_CANCELLED)
+            logger.info(f"任务 {job['id']} 已取消")
+        except Exception as e:
+            logger.error(f"任务 {job['id']} 失败: {e}", exc_info=True)
+            self._finish(job["id"], STATUS_FAILED, error=str(e))
+        finally:
+            with self._lock:
+                self._running.pop(job["id"], None)
+
+
+job_manager = JobManager(JOBS_DB_PATH)
+
+
+# ===== 知识库入库任务 =====
+
+def new_upload_dir() -> Path:
+    """为上传任务分配独立的文件暂存目录，任务结束后删除。"""
+    path = JOB_UPLOAD_DIR / uuid.uuid4().hex
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _prepare_kb(ctx: JobContext):
+    # 重建模式在任务内删除旧库，保证与同一知识库的其他任务串行
+    if ctx.params.get("mode") == "new":
+        try:
+            delete_kb(ctx.kb_name)
+        except Exception:
+            pass
+
+
+def _run_upload_job(ctx: JobContext) -> Dict[str, Any]:
+    upload_dir = ctx.params.get("upload_dir")
+    try:
+        ctx.check_cancelled()
+        _prepare_kb(ctx)
+        if ctx.params.get("tokenizer"):
+            # 分词模式需在写入片段前确定 (已有片段时会按新模式重建 BM25 索引)
+            set_kb_tokenizer(ctx.kb_name, ctx.params["tokenizer"])
+        files = [(path, filename) for path, filename in ctx.params["files"]]
+
+        def _ingest(detector=None):
+            return run_ingest_pipeline(
+                ctx.kb_name,
+                files,
+                index_type=ctx.params.get("index_type"),
+                progress_callback=ctx.progress,
+                cancel_event=ctx.cancel_event,
+                detector=detector,
+            )
+
+        try:
+            if ctx.params.get("mode") == "replace":
+                # 替换模式：先写入新版本，成功后再删除同名文档的旧片段与向量 (失败 / 取消时保留旧版本)
+                return replace_documents(ctx.kb_name, [filename for _, filename in files], _ingest)
+            return {**_ingest(), "replaced": 0}
+        except IngestCancelled:
+            raise JobCancelled()
+    finally:
+        if upload_dir:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+
+
+def _run_add_text_job(ctx: JobContext) -> Dict[str, Any]:
+    upload_dir = ctx.params.get("upload_dir")
+    try:
+        ctx.check_cancelled()
+        _prepare_kb(ctx)
+        with open(ctx.params["text_path"], "r", encoding="utf-8") as f:
+            text = f.read()
+        source = ctx.params.get("doc_name") or "粘贴的文本"
+        raw_doc = Document(page_content=text, metadata={"source": source})
+        chunks = split_documents([raw_doc])
+        if ctx.params.get("mode") == "replace":
+            return upsert_document(ctx.kb_name, source, chunks, progress_callback=ctx.progress)
+        return save_kb(ctx.kb_name, chunks, progress_callback=ctx.progress)
+    finally:
+        if upload_dir:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+
+
+def _run_resume_job(ctx: JobContext) -> Dict[str, Any]:
+    current, total = resume_kb_embedding(
+        ctx.kb_name,
+        progress_callback=ctx.progress,
+        index_type=ctx.params.get("index_type"),
+        cancel_event=ctx.cancel_event,
+    )
+    return {"current": current, "total": total}
+
+
+def _run_delete_document_job(ctx: JobContext) -> Dict[str, Any]:
+    return delete_document(ctx.kb_name, ctx.params["source"])
+
+
+job_manager.register("upload", _run_upload_job)
+job_manager.register("add_text", _run_add_text_job)
+job_manager.register("resume", _run_resume_job)
+job_manager.register("delete_document", _run_delete_document_job)
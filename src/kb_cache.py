@@ -0,0 +1,92 @@
+"""
+进程级知识库缓存。
+
+按知识库名缓存已加载的片段与向量索引，并记录加载时的版本戳
+(片段库 generation + 索引文件 mtime)。版本变化即视为失效，
+命中时直接复用内存中的对象，跳过磁盘读取与反序列化。
+
+总内存按估算字节数受 KB_CACHE_MAX_MB 限制，超出时按 LRU 淘汰。
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+from src.logger import get_logger
+
+logger = get_logger("KBCache")
+
+
+class KBCache:
+    """线程安全的 LRU 缓存，容量按估算字节数计算。"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[Hashable, Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, kb_name: str, version: Hashable, loader: Callable[[], Tuple[Any, int]]) -> Any:
+        """
+        读取缓存；未命中或版本不一致时调用 loader 加载。
+        loader 返回 (value, size_bytes)。
+        """
+        with self._lock:
+            entry = self._entries.get(kb_name)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(kb_name)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # 加载放在锁外，避免大库反序列化阻塞其他知识库的命中
+        value, size = loader()
+
+        with self._lock:
+            old = self._entries.pop(kb_name, None)
+            if old is not None:
+                self._bytes -= old[2]
+            if size <= self.max_bytes:
+                self._entries[kb_name] = (version, value, size)
+                self._bytes += size
+                self._evict()
+            else:
+                logger.warning(f"知识库 {kb_name} 估算占用 {size / 1024 / 1024:.1f}MB，超过缓存上限，不缓存")
+        return value
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            name, (_, _, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            logger.info(f"缓存淘汰知识库 {name} (释放 {size / 1024 / 1024:.1f}MB)")
+
+    def invalidate(self, kb_name: str):
+        with self._lock:
+            entry = self._entries.pop(kb_name, None)
+            if entry is not None:
+                self._bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": list(self._entries.keys()),
+                "used_mb": round(self._bytes / 1024 / 1024, 2),
+                "max_mb": round(self.max_bytes / 1024 / 1024, 2),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+kb_cache = KBCache(max_bytes=int(float(os.getenv("KB_CACHE_MAX_MB", "1024")) * 1024 * 1024))
@@ -0,0 +1,73 @@
+"""
+检索前的元数据过滤。
+
+过滤表达式是一个 dict，各字段之间为 AND：
+    {"source": "2023年报.pdf"}                          等值
+    {"source": {"$in": ["a.pdf", "b.pdf"]}}             任一
+    {"page": {"$gte": 10, "$lt": 20}}                  范围
+    {"language": "English"}
+    {"ingested_at": "2023"}                            日期前缀 (匹配 2023-xx-xx)
+    {"ingested_at": {"$gte": "2023-01-01", "$lte": "2023-06-30"}}
+
+可用字段见 chunk_store.FILTER_FIELDS；ingested_at 为片段的入库日期 (ISO 格式 YYYY-MM-DD)，
+不是文档自身的日期。过滤条件在片段库的 chunk_meta_index 上求出候选片段 id，
+再交给向量检索 (faiss ID selector / 子集精确检索) 与 BM25 (只读候选片段的 postings)。
+"""
+from typing import Any, Dict, List, Optional
+
+from src import chunk_store
+
+_RANGE_OPS = ("$gt", "$gte", "$lt", "$lte")
+_OPS = ("$eq", "$in", "$prefix") + _RANGE_OPS
+
+
+def _coerce(field: str, value: Any) -> Any:
+    if field == "page":
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            raise ValueError(f"过滤字段 page 需要数字: {value!r}")
+        return int(value)
+    if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+        raise ValueError(f"过滤字段 {field} 的值不合法: {value!r}")
+    return str(value)
+
+
+def parse_filter(expr: Optional[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """校验过滤表达式并规范化为 {字段: {操作符: 值}}；表达式不合法时抛出 ValueError。"""
+    if not expr:
+        return {}
+    if not isinstance(expr, dict):
+        raise ValueError("过滤表达式必须是对象")
+    conditions: Dict[str, Dict[str, Any]] = {}
+    for field, spec in expr.items():
+        if field not in chunk_store.FILTER_FIELDS:
+            raise ValueError(f"不支持的过滤字段: {field} (可用: {', '.join(chunk_store.FILTER_FIELDS)})")
+        ops = spec if isinstance(spec, dict) else {"$eq": spec}
+        if not ops:
+            raise ValueError(f"过滤字段 {field} 缺少条件")
+        normalized: Dict[str, Any] = {}
+        for op, value in ops.items():
+            if op not in _OPS:
+                raise ValueError(f"不支持的过滤操作符: {op}")
+            if op == "$in":
+                if not isinstance(value, (list, tuple)) or not value:
+                    raise ValueError(f"{field}.$in 需要非空列表")
+                normalized[op] = [_coerce(field, v) for v in value]
+            elif op == "$prefix":
+                # 前缀只对字符串字段有意义 (page 是整数)
+                if field == "page" or not isinstance(value, str):
+                    raise ValueError(f"{field}.$prefix 需要字符串字段与字符串值: {value!r}")
+                normalized[op] = value
+            else:
+                normalized[op] = _coerce(field, value)
+        # 日期等值按前缀匹配："2023" 匹配当年所有日期
+        if field == "ingested_at" and "$eq" in normalized:
+            normalized["$prefix"] = normalized.pop("$eq")
+        conditions[field] = normalized
+    return conditions
+
+
+def resolve_chunk_ids(kb_name: str, conditions: Dict[str, Dict[str, Any]]) -> Optional[List[int]]:
+    """满足条件的片段 id (升序)；没有条件时返回 None，表示不过滤。"""
+    if not conditions:
+        return None
+    return chunk_store.filter_chunk_ids(kb_name, conditions)
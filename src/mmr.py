@@ -0,0 +1,111 @@
+"""
+最大边际相关 (MMR) 重选。
+
+片段切分时相邻片段有 100~120 字重叠，向量 top-k 经常是几段几乎相同的相邻切片，
+发给 LLM 的上下文有一半是重复的。这里先多取 fetch_k 个候选，再用索引中已存的向量
+逐个挑选：score = λ · 相关度 - (1 - λ) · 与已选片段的最大余弦相似度。
+
+- 相关度沿用上一阶段 (混合检索融合) 的得分，min-max 归一化到 [0, 1]；
+- 候选向量按片段 id 在 docstore 中定位 (vector_index.docstore_positions 的缓存)，
+  从索引中按内部序号重构 (压缩索引读冷文件中的原始向量)，不重新调用向量化接口；
+- 查不到向量的候选 (如只被 BM25 命中、未向量化的片段) 视为与其他片段不相似。
+"""
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from src.federated_search import FederatedVectorStore
+from src.logger import get_logger
+from src.vector_index import docstore_positions, reconstruct_positions
+
+logger = get_logger("MMR")
+
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))
+MMR_FETCH_K = int(os.getenv("MMR_FETCH_K", "20"))
+
+def _vector_key(doc: Document) -> Optional[str]:
+    """片段在向量库 docstore 中的键 (片段 id)，没有 id 的片段查不到向量。"""
+    chunk_id = (doc.metadata or {}).get("chunk_id")
+    return None if chunk_id is None else str(chunk_id)
+
+
+def _stores_for(vector_store: Any) -> Dict[Optional[str], FAISS]:
+    if isinstance(vector_store, FederatedVectorStore):
+        return dict(vector_store.stores)
+    return {None: vector_store}
+
+
+def lookup_vectors(docs: Sequence[Document], vector_store: Any) -> np.ndarray:
+    """取出候选片段已存的向量，形状 (n, d)；查不到的行为全 0。"""
+    stores = _stores_for(vector_store)
+    wanted: Dict[Optional[str], List[Tuple[int, int]]] = {}  # 知识库 -> [(候选下标, 内部序号)]
+    for i, doc in enumerate(docs):
+        kb_name = (doc.metadata or {}).get("kb_name")
+        key = kb_name if kb_name in stores else None
+        vs = stores.get(key)
+        if vs is None:
+            continue
+        pos = docstore_positions(vs).get(_vector_key(doc))
+        if pos is not None:
+            wanted.setdefault(key, []).append((i, pos))
+
+    vectors: Optional[np.ndarray] = None
+    for key, items in wanted.items():
+        try:
+            rows = reconstruct_positions(stores[key].index, np.array([pos for _, pos in items]))
+        except Exception as e:
+            logger.debug(f"重构向量失败: {e}")
+            continue
+        if vectors is None:
+            vectors = np.zeros((len(docs), rows.shape[1]), dtype="float32")
+        if rows.shape[1] == vectors.shape[1]:
+            vectors[[i for i, _ in items]] = rows
+    return vectors if vectors is not None else np.zeros((len(docs), 0), dtype="float32")
+
+
+def mmr_select(relevance: np.ndarray, vectors: np.ndarray, k: int, lambda_mult: float = MMR_LAMBDA) -> List[int]:
+    """
+    返回按 MMR 依次选出的候选下标。
+    relevance: (n,) 相关度，越大越相关；vectors: (n, d) 候选向量 (全 0 行视为无向量)。
+    """
+    n = len(relevance)
+    k = min(k, n)
+    if k <= 0:
+        return []
+    rel = np.asarray(relevance, dtype="float64")
+    span = rel.max() - rel.min()
+    rel = (rel - rel.min()) / span if span > 0 else np.ones(n)
+
+    if vectors.size:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        unit = np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+        similarity = unit @ unit.T
+    else:
+        similarity = np.zeros((n, n), dtype="float32")
+
+    selected = [int(np.argmax(rel))]
+    max_sim = similarity[:, selected[0]].astype("float64")
+    available = np.ones(n, dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < k:
+        scores = lambda_mult * rel - (1.0 - lambda_mult) * max_sim
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(max_sim, similarity[:, best], out=max_sim)
+    return selected
+
+
+def mmr_rerank(hits: List[Tuple[Document, float]], vector_store: Any, k: int,
+               lambda_mult: float = MMR_LAMBDA) -> List[Tuple[Document, float]]:
+    """对 [(片段, 相关度)] 做 MMR 重选，返回 k 个，顺序即选择顺序。"""
+    if len(hits) <= 1 or vector_store is None:
+        return hits[:k]
+    docs = [doc for doc, _ in hits]
+    vectors = lookup_vectors(docs, vector_store)
+    order = mmr_select(np.array([score for _, score in hits]), vectors, k, lambda_mult)
+    return [hits[i] for i in order]
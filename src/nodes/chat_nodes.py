@@ -1,13 +1,17 @@
 # src/nodes/chat_nodes.py
-from typing import Literal
+from typing import Any, Dict, List, Literal, Optional, Tuple
 from pydantic import BaseModel, Field
+from langchain_core.documents import Document
 from langchain_core.messages import SystemMessage, AIMessage, HumanMessage
 from langchain_core.output_parsers import PydanticOutputParser
 from src.state import AgentState
 from src.nodes.common import get_llm
 from src.logger import get_logger
 from src.bm25 import SimpleBM25Retriever
-from src.storage import peek_kb_random_chunks
+from src.hybrid_search import build_hybrid_retriever
+from src.mmr import MMR_LAMBDA
+from src.retrieval_cache import retrieval_cache
+from src.storage import kb_versions, peek_kb_random_chunks, search_kbs_bm25_with_scores
 
 # 获取 logger 实例
 logger = get_logger("Node_Chat")
@@ -76,23 +80,9 @@ def supervisor_node(state: AgentState) -> dict:
 
 # === Searcher ===
 
-def search_node(state: AgentState) -> dict:
-    query = state.get("current_search_query", "")
-    source_docs = state.get("source_documents", [])
-    vector_store = state.get("vector_store", None)
-    kb_names = state.get("kb_names", [])
-    # 获取当前的动态画像
-    current_summary = state.get("kb_summary", "未知领域")
-    
-    # [Log] 记录搜索动作
-    logger.info(f"[Searcher] 开始执行搜索任务: '{query}' | 当前对库的理解: {current_summary}")
-    
-    if not query:
-        logger.warning("[Searcher] 收到空查询指令")
-        return {"messages": [AIMessage(content="Searcher: 指令为空。", name="Searcher")]}
-
-    llm = get_llm()
-
+def _retrieve(llm, query: str, kb_names: List[str], source_docs: List[Document], vector_store,
+              current_summary: str, kb_filter: Optional[Dict[str, Any]]) -> Tuple[List[Document], str]:
+    """按知识库采样扩展关键词，再做向量 + BM25 混合检索，返回 (片段, 扩展关键词)。"""
     # === 1. [核心通用逻辑] 获取样本 ===
     # 无论 current_summary 是否为空，都获取样本，增强 Prompt 的"体感"
     # 这步操作非常快（毫秒级），不会影响性能
@@ -133,31 +123,56 @@ def search_node(state: AgentState) -> dict:
         logger.error(f"[Searcher] 关键词生成失败: {e}")
         bm25_keywords = query
     
-    results_bm25 = []
-    results_vector = []
-
-    if source_docs:
+    bm25_fn = None
+    if kb_names:
+        # 使用入库时建好的持久化倒排索引，不再每轮重建
+        bm25_fn = lambda q, k: search_kbs_bm25_with_scores(kb_names, q, k=k, metadata_filter=kb_filter)
+    elif source_docs:
         try:
-            bm25_retriever = SimpleBM25Retriever(source_docs)
-            results_bm25 = bm25_retriever.search(f"{query} {bm25_keywords}", k=10)
+            bm25_fn = SimpleBM25Retriever(source_docs).search_with_scores
         except Exception as e:
             logger.warning(f"BM25 检索失败: {e}")
-            results_bm25 = []
+
+    # 向量检索与 BM25 按名次融合 (RRF)，按片段 id 去重；再用 MMR 剔除重叠切片，取前 6 条
+    retriever = build_hybrid_retriever(vector_store, bm25_fn, top_k=6, metadata_filter=kb_filter)
+    docs = retriever.invoke(query, queries={"bm25": f"{query} {bm25_keywords}"}, mmr_lambda=MMR_LAMBDA)
+    return docs, bm25_keywords
+
+
+def search_node(state: AgentState) -> dict:
+    query = state.get("current_search_query", "")
+    source_docs = state.get("source_documents", [])
+    vector_store = state.get("vector_store", None)
+    kb_names = state.get("kb_names", [])
+    # 获取当前的动态画像
+    current_summary = state.get("kb_summary", "未知领域")
     
-    if vector_store:
-        try:
-            vector_retriever = vector_store.as_retriever(search_kwargs={"k": 10})
-            results_vector = vector_retriever.invoke(query)
-        except: pass
-
-    # 合并去重
-    all_results = results_vector + results_bm25
-    unique_docs = {}
-    for doc in all_results:
-        if doc.page_content not in unique_docs:
-            unique_docs[doc.page_content] = doc
-    
-    final_docs = list(unique_docs.values())[:6]
+    # [Log] 记录搜索动作
+    logger.info(f"[Searcher] 开始执行搜索任务: '{query}' | 当前对库的理解: {current_summary}")
+    
+    if not query:
+        logger.warning("[Searcher] 收到空查询指令")
+        return {"messages": [AIMessage(content="Searcher: 指令为空。", name="Searcher")]}
+
+    llm = get_llm()
+
+    # 可选的元数据过滤 (来源 / 页码 / 语言 / 入库日期)，在检索前缩小候选范围
+    kb_filter = state.get("kb_filter") or None
+
+    # 相同 / 近似的搜索指令在多轮、多用户间反复出现：知识库未变化时直接复用上次的检索结果
+    # (连同关键词扩展的 LLM 调用一起省去)
+    cache_key = None
+    cached = None
+    if kb_names:
+        cache_key = retrieval_cache.make_key(kb_versions(kb_names), query, k=6, params={"filter": kb_filter})
+        cached = retrieval_cache.lookup(cache_key)
+    if cached is not None:
+        final_docs, bm25_keywords = cached[0], cached[1].get("keywords", query)
+        logger.info(f"[Searcher] 命中检索缓存: '{query}'")
+    else:
+        final_docs, bm25_keywords = _retrieve(llm, query, kb_names, source_docs, vector_store, current_summary, kb_filter)
+        if cache_key is not None:
+            retrieval_cache.store(cache_key, final_docs, {"keywords": bm25_keywords})
     
     logger.info(f"[Searcher] 检索完成，找到 {len(final_docs)} 条相关片段")
 
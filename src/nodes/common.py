@@ -1,10 +1,24 @@
 # src/nodes/common.py
 import os
+import httpx
 from langchain_openai import ChatOpenAI
+from src.concurrency import AdaptiveTransport, AsyncAdaptiveTransport, get_controller
 from src.logger import get_logger
 
 logger = get_logger("LLM_Factory")
 
+# 所有 LLM 实例共用一个 AIMD 并发控制器与连接池：
+# 首字节延迟正常时逐步放开并发，遇到 429 / 5xx / 超时自动减半 (重试仍由 SDK 的 max_retries 负责)；
+# 槽位只在发起请求到收到响应头之间占用，流式输出期间不占槽位
+llm_controller = get_controller(
+    "llm",
+    initial=float(os.getenv("LLM_INITIAL_CONCURRENCY", "4")),
+    max_limit=int(os.getenv("LLM_MAX_CONCURRENCY", "16")),
+    latency_target=30.0,
+)
+_http_client = httpx.Client(transport=AdaptiveTransport(llm_controller), timeout=600)
+_http_async_client = httpx.AsyncClient(transport=AsyncAdaptiveTransport(llm_controller), timeout=600)
+
 def get_llm():
     api_key = os.getenv("DEEPSEEK_API_KEY")
     base_url = os.getenv("OPENAI_API_BASE", "https://api.deepseek.com")
@@ -19,6 +33,8 @@ def get_llm():
             openai_api_base=base_url,
             temperature=0.3,
             max_retries=3, # 增加重试次数
+            http_client=_http_client,
+            http_async_client=_http_async_client,
             # === [核心修复] 将超时设为 600 秒 (10分钟) ===
             request_timeout=600,
             # 显式拉大输出上限以防止截断
@@ -0,0 +1,303 @@
+"""
+PDF 文本提取服务（多进程 + 内容哈希缓存）。
+
+pypdf 的 extract_text 是纯 Python、CPU 密集的，长 PDF 在单核上要跑数分钟。这里：
+- 按页码区间 (PDF_PAGES_PER_TASK 页一组) 分片，提交到进程池并行解析；
+- 按页码顺序流式产出 (页码, 文本)，同时在途的分片数有上限，不会一次持有整份文本；
+- 每页有超时 (PDF_PAGE_TIMEOUT 秒)，卡死的页面记为空文本并告警，不拖垮整个文件；
+- 提取结果以文件内容的 SHA-256 为键缓存到 storage/pdf_text_cache.db，重复上传直接命中。
+
+页数较少 (< PDF_PARALLEL_MIN_PAGES) 时在当前线程串行解析，省去进程间传输开销。
+"""
+import hashlib
+import os
+import signal
+import sqlite3
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from pypdf import PdfReader
+
+from src.db import STORAGE_DIR
+from src.logger import get_logger
+from src.process_pool import SpawnProcessPool
+
+logger = get_logger("PdfExtract")
+
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+PDF_PAGE_TIMEOUT = float(os.getenv("PDF_PAGE_TIMEOUT", "30"))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "16"))
+PDF_TEXT_CACHE_ENABLED = os.getenv("PDF_TEXT_CACHE", "1") != "0"
+PDF_TEXT_CACHE_PATH = STORAGE_DIR / "pdf_text_cache.db"
+
+_HASH_BLOCK = 1024 * 1024
+
+
+class PageTimeout(Exception):
+    """单页解析超时。"""
+
+
+# ===== 进程池内执行的部分 (模块级函数，可被 spawn 子进程导入) =====
+
+@contextmanager
+def _page_deadline(seconds: float):
+    """用 SIGALRM 限制单页解析时间，只在支持的平台的主线程中生效。"""
+    if seconds <= 0 or not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def _on_alarm(signum, frame):
+        raise PageTimeout()
+
+    previous = signal.signal(signal.SIGALRM, _on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _extract_page(reader: PdfReader, index: int, page_timeout: float) -> Tuple[str, bool]:
+    """返回 (文本, 是否成功)，失败或超时的页面文本为空。"""
+    try:
+        with _page_deadline(page_timeout):
+            return reader.pages[index].extract_text() or "", True
+    except PageTimeout:
+        logger.warning(f"PDF 第 {index + 1} 页解析超过 {page_timeout:g}s，已跳过")
+    except Exception as e:
+        logger.warning(f"PDF 第 {index + 1} 页解析失败，已跳过: {e}")
+    return "", False
+
+
+def _extract_range(path: str, start: int, end: int, page_timeout: float) -> List[Tuple[str, bool]]:
+    """子进程任务：解析 [start, end) 页。"""
+    reader = PdfReader(path)
+    return [_extract_page(reader, i, page_timeout) for i in range(start, end)]
+
+
+# ===== 进程池 =====
+
+_pool = SpawnProcessPool(PDF_EXTRACT_WORKERS)
+
+
+def shutdown_pool():
+    _pool.shutdown()
+
+
+# ===== 内容哈希缓存 =====
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class PdfTextCache:
+    """按文件内容哈希缓存逐页文本，只缓存所有页面都解析成功的文件。"""
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(str(self.db_path), timeout=60.0, check_same_thread=False)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS pdf_files (
+                hash TEXT PRIMARY KEY,
+                page_count INTEGER NOT NULL
+            )
+            """)
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS pdf_pages (
+                hash TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                PRIMARY KEY (hash, page)
+            ) WITHOUT ROWID
+            """)
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def get(self, digest: str) -> Optional[List[str]]:
+        try:
+            with self._connect() as conn:
+                row = conn.execute("SELECT page_count FROM pdf_files WHERE hash = ?", (digest,)).fetchone()
+                pages = None
+                if row is not None:
+                    texts = [""] * row[0]
+                    for page, text in conn.execute("SELECT page, text FROM pdf_pages WHERE hash = ?", (digest,)):
+                        if 0 <= page < row[0]:
+                            texts[page] = text
+                    pages = texts
+        except sqlite3.Error as e:
+            logger.warning(f"读取 PDF 文本缓存失败: {e}")
+            pages = None
+        with self._lock:
+            if pages is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return pages
+
+    def put(self, digest: str, pages: List[str]):
+        try:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM pdf_pages WHERE hash = ?", (digest,))
+                conn.executemany(
+                    "INSERT INTO pdf_pages (hash, page, text) VALUES (?, ?, ?)",
+                    [(digest, i, text) for i, text in enumerate(pages) if text],
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO pdf_files (hash, page_count) VALUES (?, ?)",
+                    (digest, len(pages)),
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"写入 PDF 文本缓存失败: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": PDF_TEXT_CACHE_ENABLED,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+pdf_text_cache = PdfTextCache(PDF_TEXT_CACHE_PATH)
+
+
+# ===== 对外接口 =====
+
+def _iter_serial(path: str, page_count: int, page_timeout: float, failed: List[int]) -> Iterator[Tuple[int, str]]:
+    reader = PdfReader(path)
+    for i in range(page_count):
+        text, ok = _extract_page(reader, i, page_timeout)
+        if not ok:
+            failed.append(i)
+        yield i, text
+
+
+def _iter_parallel(path: str, page_count: int, page_timeout: float, pages_per_task: int,
+                   failed: List[int]) -> Iterator[Tuple[int, str]]:
+    ranges = [(s, min(s + pages_per_task, page_count)) for s in range(0, page_count, pages_per_task)]
+    pool = _pool.get()
+    # 在途分片数上限：保持每个进程有活干，同时限制已解析未消费的文本量
+    window = max(2, PDF_EXTRACT_WORKERS * 2)
+    pending: deque = deque()
+    next_range = 0
+
+    def _submit():
+        nonlocal next_range
+        start, end = ranges[next_range]
+        pending.append((start, end, pool.submit(_extract_range, path, start, end, page_timeout)))
+        next_range += 1
+
+    try:
+        while next_range < len(ranges) and len(pending) < window:
+            _submit()
+        while pending:
+            start, end, future = pending.popleft()
+            # 子进程内已有逐页超时，这里的整体超时只兜底无法被信号打断的情况
+            wait = page_timeout * (end - start) * 2 if page_timeout > 0 else None
+            try:
+                results = future.result(timeout=wait)
+            except FutureTimeout:
+                logger.warning(f"PDF 第 {start + 1}-{end} 页解析超时，已跳过")
+                results = [("", False)] * (end - start)
+                _pool.reset()
+                pool = _pool.get()
+            for offset, (text, ok) in enumerate(results):
+                if not ok:
+                    failed.append(start + offset)
+                yield start + offset, text
+            if next_range < len(ranges):
+                _submit()
+    finally:
+        for _, _, future in pending:
+            future.cancel()
+
+
+def iter_pdf_pages(path: str, page_timeout: float = None, use_cache: bool = True) -> Iterator[Tuple[int, str]]:
+    """
+    按页码顺序产出 (页码, 文本)，包含空白页 (文本为空)，便于调用方统计页数。
+    解析失败 / 超时的页面以空文本产出；整份文件全部成功时写入缓存。
+    """
+    page_timeout = PDF_PAGE_TIMEOUT if page_timeout is None else page_timeout
+    use_cache = use_cache and PDF_TEXT_CACHE_ENABLED
+
+    digest = file_hash(path) if use_cache else None
+    if digest is not None:
+        cached = pdf_text_cache.get(digest)
+        if cached is not None:
+            logger.info(f"PDF 文本缓存命中: {os.path.basename(path)} ({len(cached)} 页)")
+            yield from enumerate(cached)
+            return
+
+    page_count = len(PdfReader(path).pages)
+    failed: List[int] = []
+    texts: List[str] = []
+    if PDF_EXTRACT_WORKERS > 1 and page_count >= PDF_PARALLEL_MIN_PAGES:
+        pages = _iter_parallel(path, page_count, page_timeout, PDF_PAGES_PER_TASK, failed)
+    else:
+        pages = _iter_serial(path, page_count, page_timeout, failed)
+
+    try:
+        for index, text in pages:
+            texts.append(text)
+            yield index, text
+    except BrokenProcessPool:
+        # 子进程崩溃 (如内存不足)：重建进程池，剩余页面在当前线程串行解析
+        logger.warning("PDF 解析进程池异常，剩余页面改为串行解析")
+        _pool.reset()
+        reader = PdfReader(path)
+        for i in range(len(texts), page_count):
+            text, ok = _extract_page(reader, i, page_timeout)
+            if not ok:
+                failed.append(i)
+            texts.append(text)
+            yield i, text
+
+    if digest is not None and not failed:
+        pdf_text_cache.put(digest, texts)
+    elif failed:
+        logger.warning(f"PDF {os.path.basename(path)}: {len(failed)} 页解析失败，结果不缓存")
+
+
+def extract_pdf_pages(path: str, page_timeout: float = None) -> List[str]:
+    """返回全部页面文本 (按页码)。"""
+    return [text for _, text in iter_pdf_pages(path, page_timeout=page_timeout)]
+
+
+def extract_pdf_pages_from_bytes(data: bytes, page_timeout: float = None) -> List[str]:
+    """内存中的 PDF：落到临时文件后交给进程池解析 (子进程按路径读取，避免跨进程传输整份文件)。"""
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
+        tmp.write(data)
+        tmp_path = tmp.name
+    try:
+        return extract_pdf_pages(tmp_path, page_timeout=page_timeout)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
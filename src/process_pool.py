@@ -0,0 +1,44 @@
+"""
+懒创建、可重建的 spawn 进程池。
+
+PDF 解析与 BM25 分词都把 CPU 密集的纯 Python 任务交给子进程，两者对进程池的要求相同：
+- 第一次使用时才创建，不用的服务进程不启动子进程；
+- 服务进程里有多个线程，fork 可能继承持有中的锁，统一用 spawn；
+- 进程池损坏 (子进程崩溃) 或有卡死的任务时整体丢弃，下次使用时重建。
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional, Sequence
+
+
+class SpawnProcessPool:
+    """线程安全；get() 取得 (必要时创建) 进程池，reset() 丢弃当前进程池。"""
+
+    def __init__(self, max_workers: int, initializer: Optional[Callable] = None, initargs: Sequence = ()):
+        self.max_workers = max_workers
+        self.initializer = initializer
+        self.initargs = tuple(initargs)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=self.initializer,
+                    initargs=self.initargs,
+                )
+            return self._pool
+
+    def reset(self):
+        """丢弃已损坏 / 有卡死任务的进程池，不等待在途任务，下次使用时重建。"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        self.reset()
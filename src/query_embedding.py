@@ -0,0 +1,233 @@
+"""
+查询向量化服务（内存 LRU + 动态微批）。
+
+每轮对话检索都要对查询做一次 embed_query，原来是阻塞的单条 HTTP 请求，
+相同 / 并发的查询各自请求一次。这里：
+- 命中进程内 LRU 直接返回：先按原文查，再按规范化文本查
+  (NFKC 全角转半角 + 合并空白，只合并写法上的差异，不改大小写与标点)；
+- 规范化后相同、正在请求中的查询共享同一个 Future，不重复请求；
+- 未命中的查询进入队列，由调度线程在 QUERY_EMBED_BATCH_WINDOW_MS 毫秒窗口内
+  收集并发到达的查询 (最多 QUERY_EMBED_MAX_BATCH 条)，合并为一次多输入 API 请求；
+  aembed 提交的查询用异步批量函数在调用方的事件循环上请求 (复用其连接池)，只与同一事件循环的查询合批。
+
+查询向量不写入持久化的 Embedding 缓存 (那是片段向量的缓存，查询文本多为一次性)。
+命中率、合批大小等指标通过 stats() 暴露在 /api/kb/metrics。
+"""
+import asyncio
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+from src.logger import get_logger
+
+logger = get_logger("QueryEmbedding")
+
+QUERY_EMBED_CACHE_SIZE = int(os.getenv("QUERY_EMBED_CACHE_SIZE", "1024"))
+QUERY_EMBED_BATCH_WINDOW_MS = float(os.getenv("QUERY_EMBED_BATCH_WINDOW_MS", "5"))
+QUERY_EMBED_MAX_BATCH = int(os.getenv("QUERY_EMBED_MAX_BATCH", "16"))
+QUERY_EMBED_WORKERS = int(os.getenv("QUERY_EMBED_WORKERS", "4"))
+
+# 批量向量化函数：文本列表 -> 对齐的向量列表 (失败的位置为 None)
+BatchFn = Callable[[List[str]], List[Optional[List[float]]]]
+# 异步版本，在提交查询的事件循环上执行
+AsyncBatchFn = Callable[[List[str]], Awaitable[List[Optional[List[float]]]]]
+
+
+def normalize_query(text: str) -> str:
+    """规范化查询文本：NFKC (全角字母数字 / 空格转半角) 后合并连续空白。"""
+    return " ".join(unicodedata.normalize("NFKC", text or "").split())
+
+
+class _Pending:
+    __slots__ = ("key", "text", "batch_fn", "loop", "future", "queued_at")
+
+    def __init__(self, key: Tuple[Hashable, str], text: str, batch_fn: BatchFn,
+                 loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.key = key
+        self.text = text
+        self.batch_fn = batch_fn
+        # 非空时 batch_fn 为异步函数，在该事件循环上执行
+        self.loop = loop
+        self.future: Future = Future()
+        self.queued_at = time.monotonic()
+
+
+class QueryEmbeddingService:
+    """线程安全；同步调用 embed，异步调用 aembed，二者共享缓存与批次。"""
+
+    def __init__(self, max_entries: int = QUERY_EMBED_CACHE_SIZE,
+                 window_ms: float = QUERY_EMBED_BATCH_WINDOW_MS,
+                 max_batch: int = QUERY_EMBED_MAX_BATCH,
+                 workers: int = QUERY_EMBED_WORKERS):
+        self.max_entries = max_entries
+        self.window = max(0.0, window_ms) / 1000.0
+        self.max_batch = max(1, max_batch)
+        self.workers = max(1, workers)
+        # (命名空间, 文本) -> float32 向量；原文与规范化文本各占一个键
+        self._cache: "OrderedDict[Tuple[Hashable, str], np.ndarray]" = OrderedDict()
+        self._inflight: Dict[Tuple[Hashable, str], _Pending] = {}
+        self._queue: List[_Pending] = []
+        self._cond = threading.Condition()
+        self._dispatcher: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.hits = 0
+        self.normalized_hits = 0
+        self.shared = 0
+        self.misses = 0
+        self.batches = 0
+        self.batched_inputs = 0
+        self.failures = 0
+
+    # ===== 缓存 =====
+
+    def _get_cached(self, key: Tuple[Hashable, str]) -> Optional[np.ndarray]:
+        vector = self._cache.get(key)
+        if vector is not None:
+            self._cache.move_to_end(key)
+        return vector
+
+    def _put_cached(self, key: Tuple[Hashable, str], vector: np.ndarray):
+        self._cache[key] = vector
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    # ===== 提交 =====
+
+    def submit(self, text: str, batch_fn: BatchFn, namespace: Hashable = None,
+               loop: Optional[asyncio.AbstractEventLoop] = None) -> Future:
+        """
+        提交一条查询，返回结果为向量 (List[float]，失败为 None) 的 Future。
+        namespace 区分不同模型，只有同一命名空间的查询会合并到一个请求中。
+        loop 非空时 batch_fn 为异步批量函数，在该事件循环上执行。
+        """
+        exact_key = (namespace, text)
+        normalized = normalize_query(text)
+        key = (namespace, normalized)
+        with self._cond:
+            vector = self._get_cached(exact_key)
+            if vector is not None:
+                self.hits += 1
+                return _done(vector.tolist())
+            vector = self._get_cached(key)
+            if vector is not None:
+                self.hits += 1
+                self.normalized_hits += 1
+                self._put_cached(exact_key, vector)
+                return _done(vector.tolist())
+            pending = self._inflight.get(key)
+            if pending is not None:
+                self.shared += 1
+                return pending.future
+            self.misses += 1
+            pending = _Pending(key, text, batch_fn, loop)
+            self._inflight[key] = pending
+            self._queue.append(pending)
+            self._ensure_dispatcher()
+            self._cond.notify()
+        return pending.future
+
+    def embed(self, text: str, batch_fn: BatchFn, namespace: Hashable = None) -> Optional[List[float]]:
+        return self.submit(text, batch_fn, namespace).result()
+
+    async def aembed(self, text: str, batch_fn: AsyncBatchFn, namespace: Hashable = None) -> Optional[List[float]]:
+        """batch_fn 为异步批量函数，未命中时在当前事件循环上请求。"""
+        loop = asyncio.get_running_loop()
+        return await asyncio.wrap_future(self.submit(text, batch_fn, namespace, loop))
+
+    # ===== 调度 =====
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None or not self._dispatcher.is_alive():
+            self._executor = self._executor or ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="query-embed"
+            )
+            self._dispatcher = threading.Thread(target=self._dispatch_loop, name="query-embed-dispatch", daemon=True)
+            self._dispatcher.start()
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                # 从最早到达的查询起等待一个窗口，期间到达的并发查询合并成一批
+                deadline = self._queue[0].queued_at + self.window
+                while len(self._queue) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                first = self._queue[0]
+                batch = [p for p in self._queue
+                         if p.key[0] == first.key[0] and p.loop is first.loop][:self.max_batch]
+                taken = set(map(id, batch))
+                self._queue = [p for p in self._queue if id(p) not in taken]
+            self._executor.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch: List[_Pending]):
+        vectors: List[Optional[List[float]]] = [None] * len(batch)
+        try:
+            texts = [p.text for p in batch]
+            if batch[0].loop is not None:
+                result = asyncio.run_coroutine_threadsafe(batch[0].batch_fn(texts), batch[0].loop).result()
+            else:
+                result = batch[0].batch_fn(texts)
+            if len(result) != len(batch):
+                raise ValueError(f"返回 {len(result)} 条向量，期望 {len(batch)} 条")
+            arrays = [None if v is None else np.asarray(v, dtype=np.float32) for v in result]
+            vectors = list(result)
+            with self._cond:
+                for pending, arr in zip(batch, arrays):
+                    if arr is not None:
+                        self._put_cached(pending.key, arr)
+                        self._put_cached((pending.key[0], pending.text), arr)
+        except Exception as e:
+            logger.error(f"查询向量化失败 ({len(batch)} 条): {e}")
+            vectors = [None] * len(batch)
+        finally:
+            # 无论成功与否都解除在途登记并完成每个 Future，否则共享该 Future 的查询会永远等待
+            with self._cond:
+                self.batches += 1
+                self.batched_inputs += len(batch)
+                self.failures += sum(1 for v in vectors if v is None)
+                for pending in batch:
+                    self._inflight.pop(pending.key, None)
+            for pending, vector in zip(batch, vectors):
+                if not pending.future.done():
+                    pending.future.set_result(vector)
+
+    def clear(self):
+        with self._cond:
+            self._cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            lookups = self.hits + self.shared + self.misses
+            return {
+                "entries": len(self._cache),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "normalized_hits": self.normalized_hits,
+                "shared_inflight": self.shared,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.shared) / lookups, 4) if lookups else 0.0,
+                "batches": self.batches,
+                "avg_batch_size": round(self.batched_inputs / self.batches, 2) if self.batches else 0.0,
+                "failures": self.failures,
+                "window_ms": self.window * 1000,
+            }
+
+
+def _done(value: Any) -> Future:
+    future: Future = Future()
+    future.set_result(value)
+    return future
+
+
+query_embedder = QueryEmbeddingService()
@@ -0,0 +1,75 @@
+"""
+外部 API 调用限速。
+
+令牌桶实现，同一个实例可同时被同步线程 (wait) 与 asyncio 协程 (acquire) 使用，
+状态只由线程锁保护，不绑定事件循环。
+"""
+import asyncio
+import os
+import threading
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """按固定速率补充令牌的令牌桶，rate <= 0 表示不限速。"""
+
+    def __init__(self, rate_per_sec: float, capacity: Optional[float] = None):
+        self.rate = rate_per_sec
+        self.capacity = capacity if capacity is not None else max(rate_per_sec, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _try_take(self, amount: float) -> float:
+        """尝试扣减令牌，成功返回 0，否则返回需要等待的秒数。"""
+        if self.rate <= 0:
+            return 0.0
+        # 单次请求超过桶容量时按整桶计，避免永远等不到
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0.0
+            return (amount - self._tokens) / self.rate
+
+    def wait(self, amount: float = 1.0):
+        while True:
+            delay = self._try_take(amount)
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    async def acquire(self, amount: float = 1.0):
+        while True:
+            delay = self._try_take(amount)
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+
+class RateLimiter:
+    """请求数 / 秒 + token 数 / 分钟 双重限速。"""
+
+    def __init__(self, requests_per_sec: float, tokens_per_min: float):
+        self.requests = TokenBucket(requests_per_sec)
+        self.tokens = TokenBucket(tokens_per_min / 60.0, capacity=tokens_per_min) if tokens_per_min > 0 else TokenBucket(0)
+
+    def wait(self, tokens: float = 0):
+        self.requests.wait(1)
+        if tokens:
+            self.tokens.wait(tokens)
+
+    async def acquire(self, tokens: float = 0):
+        await self.requests.acquire(1)
+        if tokens:
+            await self.tokens.acquire(tokens)
+
+
+embedding_rate_limiter = RateLimiter(
+    requests_per_sec=float(os.getenv("EMBEDDING_MAX_RPS", "5")),
+    tokens_per_min=float(os.getenv("EMBEDDING_MAX_TPM", "300000")),
+)
@@ -0,0 +1,171 @@
+"""
+检索结果缓存。
+
+Supervisor 在多轮、多用户间经常下发相同或几乎相同的搜索指令，每次都要重新做
+关键词扩展、BM25 计分、向量检索和查询向量化。这里按
+    (各知识库版本戳, 规范化查询, k, 过滤条件等参数)
+缓存排好序的片段 id (知识库, chunk_id, 融合得分) 及检索附带信息 (如扩展关键词)，
+命中时按 id 从片段库取回正文。
+
+- 版本戳 = 片段库写入代数 + 向量索引文件修改时间 (同 kb_cache)，任一知识库写入 / 删除文档后
+  键自然变化，旧条目不会再命中，随 TTL / LRU 淘汰；删除知识库、切换分词模式时主动清除；
+- 规范化：NFKC、忽略大小写、去掉全部标点与空白 ("什么是RAG？" 与 "什么是 rag" 同键)；
+- 条目有 TTL (RETRIEVAL_CACHE_TTL 秒) 与条数上限 (RETRIEVAL_CACHE_SIZE，LRU 淘汰)；
+- 只缓存每个片段都带 (kb_name, chunk_id) 的结果，取回时任一片段已不存在则按未命中处理。
+
+命中率等指标通过 stats() 暴露在 /api/kb/metrics。
+"""
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+
+from src import chunk_store
+from src.logger import get_logger
+
+logger = get_logger("RetrievalCache")
+
+RETRIEVAL_CACHE_ENABLED = os.getenv("RETRIEVAL_CACHE", "1") != "0"
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "512"))
+RETRIEVAL_CACHE_TTL = float(os.getenv("RETRIEVAL_CACHE_TTL", "600"))
+
+_SEPARATORS = re.compile(r"[\W_]+")
+
+# 缓存条目：([(知识库, 片段 id, 片段 metadata 中检索阶段写入的字段)], 附带信息)
+_Entry = Tuple[List[Tuple[str, int, Dict[str, Any]]], Dict[str, Any]]
+_RESULT_FIELDS = ("fusion_score", "retrievers")
+
+
+def normalize_search_query(query: str) -> str:
+    """NFKC + casefold，去掉全部标点与空白 (中文查询里空格可有可无，保留会让同一问题落到不同的键)。"""
+    text = unicodedata.normalize("NFKC", query or "").casefold()
+    return _SEPARATORS.sub("", text)
+
+
+class RetrievalCache:
+    """线程安全的 TTL + LRU 缓存。"""
+
+    def __init__(self, max_entries: int = RETRIEVAL_CACHE_SIZE, ttl: float = RETRIEVAL_CACHE_TTL,
+                 enabled: bool = RETRIEVAL_CACHE_ENABLED):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        # 键 -> (过期时间, 条目)
+        self._entries: "OrderedDict[Hashable, Tuple[float, _Entry]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(versions: Sequence[Tuple[str, Hashable]], query: str, k: int,
+                 params: Dict[str, Any] = None) -> Hashable:
+        """versions: [(知识库, 版本戳)]；params: 其他影响结果的参数 (过滤条件等)，需可 JSON 序列化。"""
+        return (
+            tuple(sorted(versions)),
+            normalize_search_query(query),
+            k,
+            json.dumps(params or {}, sort_keys=True, ensure_ascii=False, default=str),
+        )
+
+    def lookup(self, key: Hashable) -> Optional[Tuple[List[Document], Dict[str, Any]]]:
+        """命中时返回 (按原顺序重建的片段列表, 附带信息)，未命中返回 None。"""
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None and item[0] <= now:
+                del self._entries[key]
+                self.expired += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            entry = item[1]
+
+        docs = self._load(entry[0])
+        with self._lock:
+            if docs is None:
+                # 片段已被删除 (版本戳未及时变化的极端情况)，丢弃条目
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+        return docs, dict(entry[1])
+
+    def store(self, key: Hashable, docs: List[Document], info: Dict[str, Any] = None):
+        """info: 随结果一起缓存的附带信息 (命中时原样返回)。"""
+        if not self.enabled:
+            return
+        refs = []
+        for doc in docs:
+            meta = doc.metadata or {}
+            if meta.get("kb_name") is None or meta.get("chunk_id") is None:
+                return  # 无法按 id 取回的结果不缓存
+            refs.append((meta["kb_name"], int(meta["chunk_id"]),
+                         {field: meta[field] for field in _RESULT_FIELDS if field in meta}))
+        entry: _Entry = (refs, dict(info or {}))
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    @staticmethod
+    def _load(refs: List[Tuple[str, int, Dict[str, Any]]]) -> Optional[List[Document]]:
+        wanted: Dict[str, List[int]] = {}
+        for kb_name, chunk_id, _ in refs:
+            wanted.setdefault(kb_name, []).append(chunk_id)
+        records = {kb_name: chunk_store.get_chunks(kb_name, ids) for kb_name, ids in wanted.items()}
+        docs = []
+        for kb_name, chunk_id, extra in refs:
+            item = records[kb_name].get(chunk_id)
+            if item is None:
+                return None
+            docs.append(Document(
+                page_content=item["page_content"],
+                metadata={**item["metadata"], "kb_name": kb_name, **extra},
+            ))
+        return docs
+
+    def invalidate_kb(self, kb_name: str):
+        """清除涉及该知识库的条目 (删除知识库等版本戳无法可靠区分的变更)。"""
+        with self._lock:
+            stale = [key for key in self._entries if any(name == kb_name for name, _ in key[0])]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+retrieval_cache = RetrievalCache()
@@ -1,4 +1,4 @@
-from typing import List, TypedDict, Annotated, Sequence, Any, Dict
+from typing import List, TypedDict, Annotated, Sequence, Any, Dict, Optional
 from langchain_core.messages import BaseMessage
 from langchain_core.documents import Document
 import operator
@@ -50,6 +50,8 @@ class AgentState(TypedDict):
     kb_summary: str
     # [新增] 知识库名称列表：用于采样和上下文对齐
     kb_names: List[str]
+    # 检索前的元数据过滤表达式 (见 src/metadata_filter.py)，如 {"source": "2023年报.pdf"}
+    kb_filter: Optional[Dict[str, Any]]
 # === [新增] 深度写作状态 ===
 class WriterState(TypedDict):
     project_id: str
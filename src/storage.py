@@ -1,16 +1,55 @@
 import os
-import json
 import shutil
 import math
 import time
-import random
+import heapq
+import pickle
+import asyncio
+import threading
+from datetime import date
 # [新增] 引入 faiss 读取索引信息
 import faiss
-from typing import List, Tuple, Any, Dict, Callable
+from typing import List, Optional, Tuple, Any, Dict, Callable, Iterator
 from pathlib import Path
 from langchain_core.documents import Document
 from langchain_community.vectorstores import FAISS
+from src import chunk_store
+from src.bm25 import PersistentBM25Index
+from src.dedup import (
+    NearDuplicateDetector,
+    add_links,
+    count_duplicate_links,
+    filter_duplicates,
+    last_link_id,
+    new_detector,
+    orphaned_duplicates,
+    remove_links_after,
+)
+from src.dedup import remove_chunks as remove_dedup_chunks
 from src.embeddings import HunyuanEmbeddings
+from src.federated_search import FederatedVectorStore
+from src.kb_cache import kb_cache
+from src.metadata_filter import parse_filter, resolve_chunk_ids
+from src.retrieval_cache import retrieval_cache
+from src.tokenizer import TOKENIZER_JIEBA, check_mode
+from src.vector_index import (
+    TombstoneFilterIndex,
+    add_to_vectorstore,
+    apply_search_params,
+    compact_vectorstore,
+    convert_index,
+    create_vectorstore,
+    docstore_positions,
+    estimate_index_bytes,
+    index_type_of,
+    needs_compaction,
+    reconstruct_vector,
+    remove_from_vectorstore,
+    resolve_index_params,
+    tombstoned_positions,
+    unwrap_index,
+    wrap_for_search,
+)
 from src.logger import get_logger
 
 logger = get_logger("Storage")
@@ -21,77 +60,123 @@ PROJECT_ROOT = SRC_DIR.parent
 STORAGE_DIR = PROJECT_ROOT / "storage"
 STORAGE_DIR.mkdir(exist_ok=True)
 
+# 只读场景以 mmap 方式读取 FAISS 索引：向量不再整体读入进程堆内存，
+# 多个 worker 进程可通过 OS page cache 共享同一份数据页
+INDEX_MMAP = os.getenv("KB_INDEX_MMAP", "1") == "1"
+
+
+def _read_faiss_index(index_path: Path, mmap: bool = INDEX_MMAP) -> Tuple[Any, bool]:
+    """
+    读取 FAISS 索引，返回 (index, 是否为 mmap)。
+    mmap 索引只读，写入路径 (save_kb / resume_kb_embedding) 需传 mmap=False。
+    当前 faiss 版本或索引类型不支持 mmap 时自动回退为常规读取。
+    """
+    if mmap:
+        # IO_FLAG_MMAP 作用于 IVF 倒排表，IO_FLAG_MMAP_IFC 作用于 Flat / HNSW 的向量数据，
+        # 两者不能同时使用，按文件头的 fourcc 判断索引类别 (IVF 为 Iw**，OPQ 等预变换为 IxPT)
+        with open(index_path, "rb") as f:
+            fourcc = f.read(4)
+        if fourcc[:2] == b"Iw" or fourcc == b"IxPT":
+            flags = faiss.IO_FLAG_MMAP
+        else:
+            flags = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+        flags |= faiss.IO_FLAG_READ_ONLY
+        try:
+            return faiss.read_index(str(index_path), flags), True
+        except Exception as e:
+            logger.debug(f"mmap 读取索引失败，回退为常规读取: {index_path} ({e})")
+    return faiss.read_index(str(index_path)), False
+
+
+def _load_vectorstore(vector_path: Path, embeddings: HunyuanEmbeddings, mmap: bool = INDEX_MMAP) -> Tuple[FAISS, bool]:
+    """
+    等价于 FAISS.load_local，区别是索引部分可以 mmap 读取。
+    返回 (vectorstore, 是否为 mmap)。
+    """
+    index, mmapped = _read_faiss_index(vector_path / "index.faiss", mmap)
+    with open(vector_path / "index.pkl", "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(embeddings, index, docstore, index_to_docstore_id), mmapped
+
 def list_kbs() -> List[str]:
-    return [f.stem for f in STORAGE_DIR.glob("*.json")]
+    # 片段库 + 尚未迁移的旧版 JSON 知识库
+    names = set(chunk_store.list_chunk_kbs())
+    names.update(f.stem for f in STORAGE_DIR.glob("*.json"))
+    return sorted(names)
 
 
-def _read_kb_json(kb_name: str) -> List[Dict]:
+def _iter_kb_chunks(kb_name: str) -> Iterator[Dict]:
     """
-    读取指定知识库的 JSON 数据。
-    仅在本模块内部复用，避免到处重复打开文件的逻辑。
+    流式读取指定知识库的片段。
+    仅在本模块内部复用，读取失败时记录日志并按空库处理。
     """
-    json_path = STORAGE_DIR / f"{kb_name}.json"
-    if not json_path.exists():
-        return []
     try:
-        with open(json_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            if isinstance(data, list):
-                return data
+        yield from chunk_store.iter_chunks(kb_name)
     except Exception as e:
-        logger.error(f"读取知识库 {kb_name} JSON 失败: {e}", exc_info=True)
-    return []
+        logger.error(f"读取知识库 {kb_name} 片段失败: {e}", exc_info=True)
+
+
+def _index_file_stamp(index_path: Path) -> Optional[List[int]]:
+    """索引文件的 (mtime_ns, size)，用于判断 manifest 中的向量数是否仍对应当前文件。"""
+    try:
+        st = index_path.stat()
+    except FileNotFoundError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _record_vector_stats(kb_name: str, vector_count: int, index_path: Path):
+    chunk_store.set_manifest_value(
+        kb_name, "vector_stats", {"count": vector_count, "stamp": _index_file_stamp(index_path)}
+    )
 
 
 def get_kb_details(kb_name: str) -> Dict:
     """
-    获取知识库详细信息，新增向量索引健康度检查
+    获取知识库详细信息，新增向量索引健康度检查。
+    片段数 / 字符数 / 语言 / 预览均来自 manifest；向量数在索引落盘时记录，
+    索引文件未变化时不再读取索引 (文件被外部替换时读一次索引头并回写)。
     """
-    json_path = STORAGE_DIR / f"{kb_name}.json"
     # LangChain 保存 FAISS 时，会在目录下生成 index.faiss 和 index.pkl
     faiss_index_path = STORAGE_DIR / f"{kb_name}_faiss" / "index.faiss"
-    
+
+    stats = chunk_store.get_stats(kb_name, keys=("vector_stats", "vector_tombstones", _BM25_TOKENIZER_KEY))
     info = {
         "name": kb_name,
-        "doc_count": 0,       # JSON 中的片段数 (应有数量)
+        "doc_count": stats["chunk_count"],  # 片段库中的片段数 (应有数量)
         "vector_count": 0,    # FAISS 中的向量数 (实际数量)
-        "total_chars": 0,
-        "languages": set(),
-        "preview": [],
+        "total_chars": stats["total_chars"],
+        "languages": stats["languages"],
+        "preview": stats["preview"],
+        "tokenizer": stats[_BM25_TOKENIZER_KEY] or get_kb_tokenizer(kb_name),  # BM25 分词模式
+        "duplicates_linked": 0,  # 入库时折叠到已有片段上的近重复片段数
         "health_status": "unknown"  # healthy, corrupted, empty, mismatch
     }
-    
-    # 1. 读取 JSON (元数据层)
-    data = _read_kb_json(kb_name)
-    info["doc_count"] = len(data)
-    for idx, item in enumerate(data):
-        content = item.get("page_content", "")
-        meta = item.get("metadata", {})
-        info["total_chars"] += len(content)
-        if "language" in meta:
-            info["languages"].add(meta["language"])
-
-        if idx < 3:  # 预览前3条即可
-            info["preview"].append(
-                {
-                    "content": content[:100] + "..." if len(content) > 100 else content,
-                    "source": meta.get("source", "unknown"),
-                }
-            )
 
-    # 2. 读取 FAISS (物理存储层)
-    if faiss_index_path.exists():
+    try:
+        info["duplicates_linked"] = count_duplicate_links(kb_name)
+    except Exception as e:
+        logger.warning(f"知识库 {kb_name}: 读取近重复记录失败: {e}")
+
+    # 2. 向量数 (物理存储层)
+    stamp = _index_file_stamp(faiss_index_path)
+    vector_stats = stats["vector_stats"] or {}
+    if stamp is None:
+        logger.debug(f"知识库 {kb_name}: FAISS 索引文件不存在")
+    elif vector_stats.get("stamp") == stamp:
+        info["vector_count"] = vector_stats.get("count", 0)
+    else:
         try:
-            # 仅读取索引头，速度极快，不需要加载整个模型
-            index = faiss.read_index(str(faiss_index_path))
-            info["vector_count"] = index.ntotal
+            # mmap 读取时只解析索引头，不会把向量整体读入内存
+            index, _ = _read_faiss_index(faiss_index_path)
+            # 墓碑向量 (已删除、待压缩) 不计入
+            info["vector_count"] = index.ntotal - (stats["vector_tombstones"] or 0)
+            _record_vector_stats(kb_name, info["vector_count"], faiss_index_path)
             logger.debug(f"知识库 {kb_name}: FAISS 索引读取成功，向量数: {info['vector_count']}")
         except Exception as e:
             logger.error(f"知识库 {kb_name}: FAISS读取错误: {e}")
             info["vector_count"] = -1  # 标记为损坏
-    else:
-        logger.debug(f"知识库 {kb_name}: FAISS 索引文件不存在")
-    
+
     # 3. 判断健康状态
     if info["doc_count"] == 0 and info["vector_count"] == 0:
         info["health_status"] = "empty"
@@ -100,42 +185,274 @@ def get_kb_details(kb_name: str) -> Dict:
         logger.warning(f"知识库 {kb_name}: 索引文件损坏")
     elif info["doc_count"] == info["vector_count"]:
         info["health_status"] = "healthy"  # 完美匹配
-        logger.info(f"知识库 {kb_name}: 健康状态正常 (JSON: {info['doc_count']}, FAISS: {info['vector_count']})")
+        logger.info(f"知识库 {kb_name}: 健康状态正常 (片段: {info['doc_count']}, FAISS: {info['vector_count']})")
     else:
         info["health_status"] = "mismatch"  # 数量不一致 (丢包了)
         loss = info['doc_count'] - info['vector_count']
-        logger.warning(f"知识库 {kb_name}: 数据不一致！JSON片段: {info['doc_count']}, FAISS向量: {info['vector_count']}, 丢失: {loss}")
-    
-    info["languages"] = list(info["languages"])
+        logger.warning(f"知识库 {kb_name}: 数据不一致！片段: {info['doc_count']}, FAISS向量: {info['vector_count']}, 丢失: {loss}")
+
     return info
 
-def save_kb(kb_name: str, new_docs: List[Document], language: str = "Chinese", progress_callback: Callable[[int, int], None] = None):
+def _get_index_params(kb_name: str) -> Dict[str, Any]:
+    """读取知识库 manifest 中记录的向量索引参数 (类型 / nlist / nprobe / ef_search)。"""
+    return chunk_store.get_manifest_value(kb_name, "vector_index", {}) or {}
+
+
+# 同一知识库的索引追加/转换需串行，避免并发上传互相覆盖 index.faiss
+# (可重入：upsert 在持锁期间先删除再写入)
+_kb_write_locks: Dict[str, threading.RLock] = {}
+_kb_write_locks_guard = threading.Lock()
+
+
+def _kb_write_lock(kb_name: str) -> threading.RLock:
+    with _kb_write_locks_guard:
+        return _kb_write_locks.setdefault(kb_name, threading.RLock())
+
+
+# manifest 中标记向量库 docstore 以片段 id 为键 (旧版为随机 uuid，按写入顺序与片段对应)
+_VECTOR_IDS_KEY = "vector_ids"
+_VECTOR_IDS_CHUNK = "chunk_id"
+
+
+def _map_vectors_to_chunk_ids(kb_name: str, vectorstore: FAISS) -> bool:
     """
-    保存知识库，支持进度回调。
-    progress_callback: 回调函数，接受 (current, total)
+    旧版向量库按 "第 i 个向量 = 第 i 个片段" 对应，docstore 键是随机 uuid。
+    首次写入时把 docstore 改为以片段 id 为键，之后删除 / 续传都按 id 定位。
+    返回是否做了迁移 (调用方负责落盘)。
     """
-    # 1. JSON 处理
-    json_path = STORAGE_DIR / f"{kb_name}.json"
-    existing_docs = []
-    if json_path.exists():
-        with open(json_path, "r", encoding="utf-8") as f:
-            try:
-                data = json.load(f)
-                for item in data:
-                    existing_docs.append(Document(page_content=item["page_content"], metadata=item["metadata"]))
-            except: pass
-            
+    if chunk_store.get_manifest_value(kb_name, _VECTOR_IDS_KEY) == _VECTOR_IDS_CHUNK:
+        return False
+    chunk_ids = chunk_store.list_chunk_ids(kb_name)
+    docs = vectorstore.docstore._dict
+    mapping = vectorstore.index_to_docstore_id
+    mapped = 0
+    for pos in sorted(mapping):
+        old_id = mapping[pos]
+        if pos >= len(chunk_ids) or old_id not in docs:
+            continue
+        doc = docs.pop(old_id)
+        doc.metadata["chunk_id"] = chunk_ids[pos]
+        new_id = str(chunk_ids[pos])
+        docs[new_id] = doc
+        mapping[pos] = new_id
+        mapped += 1
+    if len(mapping) > len(chunk_ids):
+        logger.warning(f"知识库 {kb_name}: 向量数 {len(mapping)} 多于片段数 {len(chunk_ids)}，多出的向量无法关联片段")
+    logger.info(f"知识库 {kb_name}: 向量库已迁移为按片段 id 关联 ({mapped} 个向量)")
+    return True
+
+
+def _vector_ids(metadatas: List[dict]) -> Any:
+    """docstore 键：片段 id (入库时写入 metadata)；缺失时交给 LangChain 生成。"""
+    if metadatas and all("chunk_id" in m for m in metadatas):
+        return [str(m["chunk_id"]) for m in metadatas]
+    return None
+
+
+def _append_kb_chunks(kb_name: str, new_docs: List[Document], language: str,
+                      detector: NearDuplicateDetector = None, terms: List[List[str]] = None) -> List[int]:
+    """
+    写入片段与 BM25 倒排索引 (以及近重复检测的 LSH 索引)，返回新片段 id。
+    terms: 与 new_docs 对齐的词元列表 (按该知识库的分词模式预先分好)，不传时在这里分词。
+    """
+    # 首次写入时记录分词模式，之后入库与查询都按它分词
+    tokenizer = get_kb_tokenizer(kb_name)
+    if chunk_store.get_manifest_value(kb_name, _BM25_TOKENIZER_KEY) is None:
+        chunk_store.set_manifest_value(kb_name, _BM25_TOKENIZER_KEY, tokenizer)
+    # 1. 片段追加写入 (只写新片段，旧数据不再整库重写)
+    # 记录入库日期，供检索时按 ingested_at 过滤
+    today = date.today().isoformat()
     for doc in new_docs:
         doc.metadata["language"] = language
-        
-    all_docs = existing_docs + new_docs
-    
-    serialized_data = [{"page_content": d.page_content, "metadata": d.metadata} for d in all_docs]
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(serialized_data, f, ensure_ascii=False, indent=2)
+        doc.metadata["ingested_at"] = today
+
+    chunk_ids = chunk_store.append_chunks(
+        kb_name, ({"page_content": d.page_content, "metadata": d.metadata} for d in new_docs)
+    )
+    # 片段 id 随 metadata 进入向量库，作为 docstore 键
+    for doc, chunk_id in zip(new_docs, chunk_ids):
+        doc.metadata["chunk_id"] = chunk_id
+
+    # 增量更新 BM25 倒排索引 (失败不影响入库，查询时会自动补齐)
+    try:
+        index = _get_bm25_index(kb_name, tokenizer)
+        if terms is not None:
+            index.add_terms(zip(chunk_ids, terms))
+        else:
+            index.add_documents(zip(chunk_ids, (d.page_content for d in new_docs)))
+    except Exception as e:
+        logger.error(f"知识库 {kb_name}: BM25 索引更新失败: {e}", exc_info=True)
+
+    if detector is not None:
+        try:
+            detector.sync()
+        except Exception as e:
+            logger.error(f"知识库 {kb_name}: 近重复索引更新失败: {e}", exc_info=True)
+    return chunk_ids
+
+
+class KBWriter:
+    """
+    知识库写入器：按批追加片段与向量，FAISS 索引在内存中累积，
+    关闭时按最终规模转换索引类型并落盘；持有期间独占该知识库的写锁。
+
+    每累积 checkpoint_every 个向量保存一次索引 (Checkpoint)，
+    进程中断后可通过 resume_kb_embedding 从断点继续。
+    remove_chunks 删除片段对应的向量 (墓碑)，关闭时按墓碑比例压缩索引。
+    """
+
+    def __init__(self, kb_name: str, language: str = "Chinese", index_type: str = None,
+                 embeddings: HunyuanEmbeddings = None, checkpoint_every: int = 5000,
+                 detector: NearDuplicateDetector = None):
+        self.kb_name = kb_name
+        self.detector = detector
+        self.language = language
+        self.index_type = index_type
+        self.embeddings = embeddings or HunyuanEmbeddings()
+        self.checkpoint_every = checkpoint_every
+        self.vector_path = STORAGE_DIR / f"{kb_name}_faiss"
+        self.vectorstore = None
+        self.chunks_written = 0
+        self.vectors_written = 0
+        self._recorded_params: Dict[str, Any] = {}
+        self._params: Dict[str, Any] = {}
+        self._since_checkpoint = 0
+        self._dirty = False
+        self._modified = False
+        self._lock = _kb_write_lock(kb_name)
+
+    def __enter__(self) -> "KBWriter":
+        self._lock.acquire()
+        try:
+            self._recorded_params = _get_index_params(self.kb_name)
+            if self.vector_path.exists():
+                try:
+                    self.vectorstore, _ = _load_vectorstore(self.vector_path, self.embeddings, mmap=False)
+                except Exception as e:
+                    logger.warning(f"知识库 {self.kb_name}: 现有索引无法追加，将重建: {e}")
+                    self.vectorstore = None
+            if self.vectorstore is not None:
+                self._dirty = self._modified = _map_vectors_to_chunk_ids(self.kb_name, self.vectorstore)
+        except Exception:
+            self._lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            # 出错时也保存已写入的部分，片段与向量保持一致的前缀，可断点续传
+            self._save(final=exc_type is None)
+        finally:
+            self._lock.release()
+        return False
+
+    def add_chunks(self, docs: List[Document], terms: List[List[str]] = None) -> List[int]:
+        ids = _append_kb_chunks(self.kb_name, docs, self.language, self.detector, terms=terms)
+        self.chunks_written += len(ids)
+        return ids
+
+    def add_embeddings(self, texts: List[str], metadatas: List[dict], raw_embeddings: List[Any]) -> int:
+        """追加一批向量，返回有效向量数。"""
+        # === 关键修复：清洗数据 ===
+        # 剔除掉那些因为 API 错误变成 None 或 [] 的向量
+        valid_text_embeddings = []
+        valid_metadatas = []
+        for text, emb, meta in zip(texts, raw_embeddings, metadatas):
+            if emb and len(emb) > 0:
+                # FAISS 要求格式: (text, embedding_vector)
+                valid_text_embeddings.append((text, emb))
+                valid_metadatas.append(meta)
+            else:
+                logger.warning(f"知识库 {self.kb_name}: 跳过失败的向量: {text[:20]}...")
+        if not valid_text_embeddings:
+            return 0
+
+        ids = _vector_ids(valid_metadatas)
+        if self.vectorstore is None:
+            self._params = resolve_index_params(self._recorded_params, len(valid_text_embeddings), self.index_type)
+            self.vectorstore = create_vectorstore(
+                valid_text_embeddings, valid_metadatas, self.embeddings, self._params, self.vector_path, ids=ids
+            )
+        else:
+            add_to_vectorstore(self.vectorstore, valid_text_embeddings, valid_metadatas, self.vector_path, ids=ids)
+
+        self._dirty = self._modified = True
+        self.vectors_written += len(valid_text_embeddings)
+        self._since_checkpoint += len(valid_text_embeddings)
+        if self._since_checkpoint >= self.checkpoint_every:
+            self._save(final=False)
+        return len(valid_text_embeddings)
+
+    def live_chunk_ids(self) -> set:
+        """已有向量的片段 id。"""
+        if self.vectorstore is None:
+            return set()
+        return {int(doc_id) for doc_id in self.vectorstore.docstore._dict if doc_id.isdigit()}
+
+    def remove_chunks(self, chunk_ids: List[int]) -> int:
+        """删除片段对应的向量，返回删除数。"""
+        if self.vectorstore is None or not chunk_ids:
+            return 0
+        removed = remove_from_vectorstore(self.vectorstore, [str(i) for i in chunk_ids])
+        if removed:
+            self._dirty = self._modified = True
+        return removed
+
+    def _save(self, final: bool):
+        if self.vectorstore is None:
+            return
+        # 结束时：本次有过写入 / 删除，或显式指定了新的索引类型，都需要压缩 / 转换后落盘
+        retype = bool(self.index_type) and self.index_type != self._recorded_params.get("requested_type")
+        if not (self._dirty or (final and (self._modified or retype))):
+            return
+        if final:
+            if needs_compaction(self.vectorstore):
+                compact_vectorstore(self.vectorstore, self.vector_path)
+            # 规模跨过阈值时自动切换索引类型 (如 flat -> ivf_flat)
+            self._params = resolve_index_params(self._recorded_params, self.vectorstore.index.ntotal, self.index_type)
+            convert_index(self.vectorstore, self._params, self.vector_path)
+        elif not self._params:
+            self._params = self._recorded_params or {"index_type": index_type_of(self.vectorstore.index)}
+        self.vectorstore.save_local(str(self.vector_path))
+        chunk_store.set_manifest_value(self.kb_name, "vector_index", self._params)
+        chunk_store.set_manifest_value(self.kb_name, _VECTOR_IDS_KEY, _VECTOR_IDS_CHUNK)
+        tombstones = len(tombstoned_positions(self.vectorstore))
+        chunk_store.set_manifest_value(self.kb_name, "vector_tombstones", tombstones)
+        _record_vector_stats(self.kb_name, self.vectorstore.index.ntotal - tombstones, self.vector_path / "index.faiss")
+        self._since_checkpoint = 0
+        self._dirty = False
+
+
+def _index_kb_embeddings(kb_name: str, texts: List[str], metadatas: List[dict], raw_embeddings: List[Any],
+                         embeddings: HunyuanEmbeddings, index_type: str = None):
+    """把向量化结果追加进知识库的 FAISS 索引并落盘。"""
+    if not any(raw_embeddings):
+        logger.error(f"知识库 {kb_name}: 所有向量化请求均失败，请检查 API Key 或网络")
+        return 0 # 不保存 FAISS，但片段已经保存了，至少 BM25 能用
+
+    with KBWriter(kb_name, index_type=index_type, embeddings=embeddings) as writer:
+        success_count = writer.add_embeddings(texts, metadatas, raw_embeddings)
+    logger.info(f"知识库 {kb_name}: 有效向量 {success_count}/{len(texts)}")
+    return success_count
+
+
+def save_kb(kb_name: str, new_docs: List[Document], language: str = "Chinese", progress_callback: Callable[[int, int], None] = None, index_type: str = None,
+            detector: NearDuplicateDetector = None):
+    """
+    保存知识库，支持进度回调。
+    progress_callback: 回调函数，接受 (current, total)
+    index_type: 向量索引类型 flat / ivf_flat / hnsw / ivf_pq / auto，默认沿用知识库记录的设置
+    detector: 近重复检测器，不传时按配置新建 (替换文档时由 replace_documents 传入)
+    返回 {"chunks": 入库片段数, "vectors": 有效向量数, "duplicates": 折叠的近重复片段数}
+    """
+    detector = detector or new_detector(kb_name)
+    submitted = len(new_docs)
+    new_docs = filter_duplicates(detector, new_docs)
+    if not new_docs:
+        return {"chunks": 0, "vectors": 0, "duplicates": submitted}
+    _append_kb_chunks(kb_name, new_docs, language, detector)
 
     # 2. FAISS 向量处理 (带进度回调)
-    vector_path = STORAGE_DIR / f"{kb_name}_faiss"
     embeddings = HunyuanEmbeddings() 
 
     # 定义内部回调
@@ -144,193 +461,402 @@ def save_kb(kb_name: str, new_docs: List[Document], language: str = "Chinese", p
             progress_callback(current, total)
 
     # 提取文本进行向量化
-    print(f"开始向量化 {len(new_docs)} 个片段...")
+    logger.info(f"知识库 {kb_name}: 开始向量化 {len(new_docs)} 个片段")
     texts = [d.page_content for d in new_docs]
     metadatas = [d.metadata for d in new_docs]
     
     # 并发生成向量
     raw_embeddings = embeddings.embed_documents(texts, progress_callback=_internal_callback)
-    
-    # === 关键修复：清洗数据 ===
-    # 剔除掉那些因为 API 错误变成 None 或 [] 的向量
-    valid_text_embeddings = []
-    valid_metadatas = []
-    
-    success_count = 0
-    for text, emb, meta in zip(texts, raw_embeddings, metadatas):
-        if emb and len(emb) > 0:
-            # FAISS 要求格式: (text, embedding_vector)
-            valid_text_embeddings.append((text, emb))
-            valid_metadatas.append(meta)
-            success_count += 1
-        else:
-            print(f"⚠️ 跳过失败的向量: {text[:20]}...")
-            
-    if not valid_text_embeddings:
-        print("❌ 所有向量化请求均失败，请检查 API Key 或网络。")
-        return # 不保存 FAISS，但 JSON 已经保存了，至少 BM25 能用
+    vectors = _index_kb_embeddings(kb_name, texts, metadatas, raw_embeddings, embeddings, index_type)
+    return {"chunks": len(new_docs), "vectors": vectors, "duplicates": submitted - len(new_docs)}
 
-    print(f"有效向量: {success_count}/{len(texts)}")
-    
-    # 保存 FAISS
+
+async def asave_kb(kb_name: str, new_docs: List[Document], language: str = "Chinese", progress_callback: Callable[[int, int], None] = None, index_type: str = None):
+    """
+    save_kb 的异步版本，供 async 路由调用：
+    向量化走异步 HTTP 客户端，磁盘读写放到线程中执行，不阻塞事件循环。
+    """
+    detector = new_detector(kb_name)
+    submitted = len(new_docs)
+    new_docs = await asyncio.to_thread(filter_duplicates, detector, new_docs)
+    if not new_docs:
+        return {"chunks": 0, "vectors": 0, "duplicates": submitted}
+    await asyncio.to_thread(_append_kb_chunks, kb_name, new_docs, language, detector)
+
+    embeddings = HunyuanEmbeddings()
+    logger.info(f"知识库 {kb_name}: 开始向量化 {len(new_docs)} 个片段")
+    texts = [d.page_content for d in new_docs]
+    metadatas = [d.metadata for d in new_docs]
+
+    raw_embeddings = await embeddings.aembed_documents(texts, progress_callback=progress_callback)
+    vectors = await asyncio.to_thread(_index_kb_embeddings, kb_name, texts, metadatas, raw_embeddings, embeddings, index_type)
+    return {"chunks": len(new_docs), "vectors": vectors, "duplicates": submitted - len(new_docs)}
+
+# manifest 中记录的 BM25 分词模式 (jieba / bigram)
+_BM25_TOKENIZER_KEY = "bm25_tokenizer"
+
+
+def get_kb_tokenizer(kb_name: str) -> str:
+    """
+    知识库的 BM25 分词模式。尚无片段的新库使用默认模式 (BM25_TOKENIZER)；
+    没有记录模式的旧库都是按 jieba 建的索引。
+    """
+    recorded = chunk_store.get_manifest_value(kb_name, _BM25_TOKENIZER_KEY)
+    if recorded:
+        return recorded
+    return TOKENIZER_JIEBA if chunk_store.get_manifest(kb_name)["next_id"] > 0 else check_mode(None)
+
+
+def set_kb_tokenizer(kb_name: str, tokenizer: str) -> bool:
+    """
+    设置知识库的 BM25 分词模式；已有片段时清空倒排索引并按新模式重建。
+    返回是否发生了变更。
+    """
+    tokenizer = check_mode(tokenizer)
+    with _kb_write_lock(kb_name):
+        if chunk_store.get_manifest_value(kb_name, _BM25_TOKENIZER_KEY) == tokenizer:
+            return False
+        if get_kb_tokenizer(kb_name) == tokenizer:
+            chunk_store.set_manifest_value(kb_name, _BM25_TOKENIZER_KEY, tokenizer)
+            return False
+        chunk_store.set_manifest_value(kb_name, _BM25_TOKENIZER_KEY, tokenizer)
+        index = _get_bm25_index(kb_name, tokenizer)
+        index.reset()
+        _sync_bm25_index(kb_name, index)
+        # 分词模式不计入版本戳，BM25 结果变化后主动清除检索缓存
+        retrieval_cache.invalidate_kb(kb_name)
+    logger.info(f"知识库 {kb_name}: BM25 分词模式切换为 {tokenizer}")
+    return True
+
+
+def _get_bm25_index(kb_name: str, tokenizer: str = None) -> PersistentBM25Index:
+    # 倒排索引与片段存在同一个 SQLite 文件中，删除知识库时一并删除
+    return PersistentBM25Index(chunk_store.chunk_db_path(kb_name), tokenizer=tokenizer or get_kb_tokenizer(kb_name))
+
+
+def _sync_bm25_index(kb_name: str, index: PersistentBM25Index):
+    """补齐尚未进入倒排索引的片段 (旧版迁移的知识库、或上次写索引中断)。"""
+    start_id = index.next_doc_id()
+    if start_id >= chunk_store.get_manifest(kb_name)["next_id"]:
+        return
+    added = index.add_documents(
+        (item["id"], item["page_content"]) for item in chunk_store.iter_chunks(kb_name, start_id=start_id)
+    )
+    logger.info(f"知识库 {kb_name}: BM25 索引补齐 {added} 个片段")
+
+
+def search_kbs_bm25(kb_names: List[str], query: str, k: int = 10,
+                    metadata_filter: Dict[str, Any] = None) -> List[Document]:
+    """
+    基于持久化倒排索引的 BM25 检索，多个知识库的结果按得分合并取 top-k。
+    """
+    return [doc for doc, _ in search_kbs_bm25_with_scores(kb_names, query, k=k, metadata_filter=metadata_filter)]
+
+
+def search_kbs_bm25_with_scores(kb_names: List[str], query: str, k: int = 10,
+                                metadata_filter: Dict[str, Any] = None) -> List[Tuple[Document, float]]:
+    """
+    同 search_kbs_bm25，返回 [(片段, BM25 得分)]，片段 metadata 中带 kb_name。
+    metadata_filter 见 src/metadata_filter.py，只对满足条件的片段计分。
+    """
+    conditions = parse_filter(metadata_filter)
+    hits = []  # (score, kb_name, chunk_id)
+    for name in kb_names:
+        if not chunk_store.kb_exists(name):
+            continue
+        try:
+            index = _get_bm25_index(name)
+            _sync_bm25_index(name, index)
+            doc_ids = resolve_chunk_ids(name, conditions)
+            hits.extend((score, name, doc_id) for doc_id, score in index.search(query, k=k, doc_ids=doc_ids))
+        except Exception as e:
+            logger.warning(f"知识库 {name}: BM25 检索失败: {e}")
+
+    top_hits = heapq.nlargest(k, hits)
+    records: Dict[str, Dict[int, Dict]] = {}
+    for name in {name for _, name, _ in top_hits}:
+        records[name] = chunk_store.get_chunks(name, [doc_id for _, n, doc_id in top_hits if n == name])
+
+    results = []
+    for score, name, doc_id in top_hits:
+        item = records.get(name, {}).get(doc_id)
+        if item:
+            results.append((
+                Document(page_content=item["page_content"], metadata={**item["metadata"], "kb_name": name}),
+                score,
+            ))
+    return results
+
+def _kb_version(kb_name: str) -> Tuple[int, int]:
+    """缓存版本戳：片段库写入代数 + 向量索引文件修改时间。"""
+    faiss_index_path = STORAGE_DIR / f"{kb_name}_faiss" / "index.faiss"
+    index_mtime = faiss_index_path.stat().st_mtime_ns if faiss_index_path.exists() else 0
+    return chunk_store.get_manifest(kb_name)["generation"], index_mtime
+
+
+def kb_versions(kb_names: List[str]) -> List[Tuple[str, Tuple[int, int]]]:
+    """[(知识库, 版本戳)]，用作检索结果缓存键的一部分。"""
+    return [(name, _kb_version(name)) for name in kb_names]
+
+
+def _load_single_kb(kb_name: str, embeddings: HunyuanEmbeddings) -> Tuple[Tuple[List[Document], Any], int]:
+    """从磁盘加载单个知识库，返回 ((片段列表, 向量库), 估算字节数)。"""
+    docs = [
+        Document(page_content=item["page_content"], metadata=item["metadata"])
+        for item in _iter_kb_chunks(kb_name)
+    ]
+    # 片段文本在列表和 FAISS docstore 中各有一份，按 UTF-8 字节粗略估算
+    text_bytes = sum(len(d.page_content.encode("utf-8")) + 256 for d in docs)
+    size = text_bytes * 2
+
+    vectorstore = None
+    vector_path = STORAGE_DIR / f"{kb_name}_faiss"
     if vector_path.exists():
         try:
-            vectorstore = FAISS.load_local(str(vector_path), embeddings, allow_dangerous_deserialization=True)
-            vectorstore.add_embeddings(valid_text_embeddings, valid_metadatas)
-        except:
-            vectorstore = FAISS.from_embeddings(valid_text_embeddings, embeddings, valid_metadatas)
-    else:
-        vectorstore = FAISS.from_embeddings(valid_text_embeddings, embeddings, valid_metadatas)
-    
-    vectorstore.save_local(str(vector_path))
+            vectorstore, mmapped = _load_vectorstore(vector_path, embeddings)
+            # 尚未写入过的旧版向量库：在内存中按位置补上片段 id，检索结果可与 BM25 按 id 去重
+            _map_vectors_to_chunk_ids(kb_name, vectorstore)
+            params = _get_index_params(kb_name)
+            apply_search_params(vectorstore.index, params)
+            # 压缩索引：包装为 "PQ 粗排 + 冷文件精确重排"
+            vectorstore.index = wrap_for_search(vectorstore.index, params, vector_path)
+            # 已删除但尚未压缩的向量在检索时跳过
+            tombstones = tombstoned_positions(vectorstore)
+            if len(tombstones):
+                vectorstore.index = TombstoneFilterIndex(vectorstore.index, tombstones)
+            # mmap 的向量页由 OS page cache 管理，不计入缓存预算
+            if not mmapped:
+                size += estimate_index_bytes(vectorstore.index)
+        except Exception as e:
+            logger.warning(f"知识库 {kb_name}: 向量索引加载失败: {e}")
+    return (docs, vectorstore), size
+
 
-# load_kbs 和 delete_kb 保持不变 (或者复制之前的)
 def load_kbs(kb_names: List[str]) -> Tuple[List[Document], Any]:
+    """
+    加载知识库片段与向量库，优先命中进程级缓存 (src/kb_cache.py)。
+    返回的对象可能与其他请求共享，调用方只读使用。
+    向量库为各知识库索引的联合检索视图 (FederatedVectorStore)，不复制向量；
+    没有任何可用索引时为 None。
+    """
     all_docs = []
-    merged_vectorstore = None
+    stores = []
     embeddings = HunyuanEmbeddings()
 
     for name in kb_names:
-        json_path = STORAGE_DIR / f"{name}.json"
-        if json_path.exists():
-            with open(json_path, "r", encoding="utf-8") as f:
-                try:
-                    data = json.load(f)
-                    for item in data:
-                        all_docs.append(Document(page_content=item["page_content"], metadata=item["metadata"]))
-                except: pass
-        
-        vector_path = STORAGE_DIR / f"{name}_faiss"
-        if vector_path.exists():
-            try:
-                vs = FAISS.load_local(str(vector_path), embeddings, allow_dangerous_deserialization=True)
-                if merged_vectorstore is None:
-                    merged_vectorstore = vs
-                else:
-                    merged_vectorstore.merge_from(vs)
-            except: pass
-    return all_docs, merged_vectorstore
+        docs, vs = kb_cache.get(name, _kb_version(name), lambda: _load_single_kb(name, embeddings))
+        all_docs.extend(docs)
+        if vs is not None:
+            stores.append((name, vs))
+
+    if not stores:
+        return all_docs, None
+    return all_docs, FederatedVectorStore(stores, embeddings)
 
 def delete_kb(kb_name: str):
-    json_path = STORAGE_DIR / f"{kb_name}.json"
-    if json_path.exists(): os.remove(json_path)
+    kb_cache.invalidate(kb_name)
+    retrieval_cache.invalidate_kb(kb_name)
+    chunk_store.delete_chunk_store(kb_name)
     vector_path = STORAGE_DIR / f"{kb_name}_faiss"
     if vector_path.exists(): shutil.rmtree(vector_path)
 
-def resume_kb_embedding(kb_name: str, batch_size: int = 20, progress_callback: Callable[[int, int], None] = None) -> Tuple[int, int]:
+def _restore_duplicates(writer: "KBWriter", deleted: List[Dict[str, Any]], source: str) -> int:
+    """
+    被删片段上折叠着其他文档的近重复片段时，把这些片段按记录的正文重新入库并向量化
+    (每个被删片段恢复一个，同组其余重复记录改为指向恢复的片段)，返回恢复的片段数。
+    """
+    kb_name = writer.kb_name
+    languages = {item["id"]: item["metadata"].get("language") or writer.language for item in deleted}
+    groups = orphaned_duplicates(kb_name, list(languages), removed_source=source)
+    if not groups:
+        return 0
+
+    # 恢复的片段沿用被删片段的语言标记，并加入近重复索引
+    writer.detector = writer.detector or new_detector(kb_name)
+    by_language: Dict[str, List[Tuple[Document, List[tuple]]]] = {}
+    for canonical_id, doc, links in groups:
+        by_language.setdefault(languages[canonical_id], []).append((doc, links))
+    restored = 0
+    for language, items in by_language.items():
+        docs = [doc for doc, _ in items]
+        chunk_ids = _append_kb_chunks(kb_name, docs, language, writer.detector)
+        texts = [d.page_content for d in docs]
+        writer.add_embeddings(texts, [d.metadata for d in docs], writer.embeddings.embed_documents(texts))
+        add_links(kb_name, [
+            (chunk_id, *link) for chunk_id, (_, links) in zip(chunk_ids, items) for link in links
+        ])
+        restored += len(docs)
+    return restored
+
+
+def _drop_chunks(writer: "KBWriter", deleted: List[Dict[str, Any]], source: str = None,
+                 before_link: int = None, restore: bool = True) -> Tuple[int, int]:
+    """
+    片段已从片段库删除后，删除其向量、BM25 倒排与近重复索引，返回 (删除的向量数, 恢复的重复片段数)。
+    source: 被删除的文档，它折叠到其他片段上的重复记录一并删除 (before_link 见 remove_dedup_chunks)；
+    restore: 是否恢复折叠到被删片段上的其他文档的重复片段。
+    """
+    kb_name = writer.kb_name
+    chunk_ids = [item["id"] for item in deleted]
+    removed = writer.remove_chunks(chunk_ids)
+    if deleted:
+        try:
+            _get_bm25_index(kb_name).remove_documents((item["id"], item["page_content"]) for item in deleted)
+        except Exception as e:
+            logger.error(f"知识库 {kb_name}: BM25 索引删除失败: {e}", exc_info=True)
+    restored = 0
+    try:
+        if restore and deleted:
+            restored = _restore_duplicates(writer, deleted, source)
+        remove_dedup_chunks(kb_name, chunk_ids, source=source, before_link=before_link)
+    except Exception as e:
+        logger.error(f"知识库 {kb_name}: 近重复索引删除 / 重复片段恢复失败: {e}", exc_info=True)
+    return removed, restored
+
+
+def delete_document(kb_name: str, source: str) -> Dict[str, int]:
+    """
+    从知识库中删除一个文档 (按 metadata.source)：片段、BM25 倒排、近重复索引与向量一并删除，
+    其余文档的向量保持不变，不需要重建整个知识库。
+    其他文档入库时折叠到本文档片段上的近重复片段会重新入库 (见 _restore_duplicates)。
+    返回 {"chunks": 删除的片段数, "vectors": 删除的向量数, "restored": 恢复的重复片段数}
+    """
+    with KBWriter(kb_name) as writer:
+        # 文档的片段可能全部折叠到了其他文档上，此时只删除重复记录
+        deleted = chunk_store.delete_chunks_by_source(kb_name, source)
+        removed, restored = _drop_chunks(writer, deleted, source)
+
+    if deleted:
+        logger.info(f"知识库 {kb_name}: 已删除文档 {source} (片段 {len(deleted)}，向量 {removed}，恢复重复片段 {restored})")
+    return {"chunks": len(deleted), "vectors": removed, "restored": restored}
+
+
+def _rollback_ingest(kb_name: str, start_id: int, link_mark: int):
+    """撤销一次未完成的写入：删除 id >= start_id 的片段及其向量 / 倒排，以及之后新增的重复记录。"""
+    new_ids = [i for i in chunk_store.list_chunk_ids(kb_name) if i >= start_id]
+    with KBWriter(kb_name) as writer:
+        deleted = chunk_store.delete_chunks(kb_name, new_ids)
+        _drop_chunks(writer, deleted, restore=False)
+        remove_links_after(kb_name, link_mark)
+    logger.info(f"知识库 {kb_name}: 已撤销未完成的写入 (片段 {len(deleted)})")
+
+
+def replace_documents(kb_name: str, sources: List[str],
+                      ingest: Callable[[Optional[NearDuplicateDetector]], Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    替换知识库中的若干文档：先写入新版本，成功后再删除各来源的旧片段 / 向量 / 倒排；
+    写入抛出异常 (含取消) 或新片段全部向量化失败时撤销新写入的部分，旧版本保持不变。
+    整个过程持有该知识库的写锁，其他写入不会穿插进来。
+
+    ingest(detector) 负责写入新版本 (save_kb / 入库流水线)，返回 {"chunks", "vectors", ...}；
+    detector 已排除旧版本的片段，新版本不会被折叠到即将删除的片段上。
+    返回 ingest 的结果，另加 "replaced": 删除的旧片段数。
+    """
+    sources = list(dict.fromkeys(sources))
+    with _kb_write_lock(kb_name):
+        old_ids = {source: chunk_store.source_chunk_ids(kb_name, source) for source in sources}
+        start_id = chunk_store.get_manifest(kb_name)["next_id"]
+        link_mark = last_link_id(kb_name)
+        detector = new_detector(kb_name, exclude_ids=[i for ids in old_ids.values() for i in ids])
+        try:
+            result = ingest(detector)
+            if result.get("chunks") and not result.get("vectors"):
+                raise RuntimeError("新版本的片段全部向量化失败，已保留旧版本，请检查 API Key 或网络")
+        except BaseException:
+            _rollback_ingest(kb_name, start_id, link_mark)
+            raise
+
+        replaced = 0
+        with KBWriter(kb_name) as writer:
+            for source, ids in old_ids.items():
+                deleted = chunk_store.delete_chunks(kb_name, ids)
+                _drop_chunks(writer, deleted, source, before_link=link_mark)
+                replaced += len(deleted)
+    logger.info(f"知识库 {kb_name}: 已替换文档 {', '.join(sources)} (旧片段 {replaced}，新片段 {result.get('chunks', 0)})")
+    return {**result, "replaced": replaced}
+
+
+def upsert_document(kb_name: str, source: str, new_docs: List[Document], language: str = "Chinese",
+                    progress_callback: Callable[[int, int], None] = None, index_type: str = None) -> Dict[str, int]:
+    """用新的片段替换知识库中的某个文档 (见 replace_documents，写入失败时保留旧版本)。"""
+    for doc in new_docs:
+        doc.metadata["source"] = source
+    return replace_documents(kb_name, [source], lambda detector: save_kb(
+        kb_name, new_docs, language, progress_callback=progress_callback, index_type=index_type, detector=detector,
+    ))
+
+
+def resume_kb_embedding(kb_name: str, batch_size: int = 200, progress_callback: Callable[[int, int], None] = None, index_type: str = None, cancel_event: threading.Event = None) -> Tuple[int, int]:
     """
     断点续传核心逻辑：
-    1. 读取 JSON 获取总任务量
-    2. 读取 FAISS 获取当前进度
-    3. 跳过已完成部分，继续处理剩余部分
-    4. 每处理完一批，立即覆写保存索引文件 (Checkpoint)
+    1. 读取片段库的全部片段 id 作为总任务量
+    2. 读取 FAISS 中已有向量的片段 id (按 id 对齐，删除过文档或中间有失败批次也能补齐)
+    3. 只为缺少向量的片段生成向量
+    4. 每处理完一批，立即覆写保存索引文件 (Checkpoint)；
+       请求节奏由 Embedding 的限速器与自适应并发控制，批次之间不再固定休眠
+    cancel_event: 置位后在批次之间停止，已保存的进度可再次续传
+    5. 全部完成后按规模 / index_type 转换为目标索引类型 (IVF 在此时训练)
     
     Returns:
         Tuple[int, int]: (当前向量数, 总文档数)
     """
-    json_path = STORAGE_DIR / f"{kb_name}.json"
-    vector_path = STORAGE_DIR / f"{kb_name}_faiss"
-    
-    # 1. 加载源数据 (JSON)
-    if not json_path.exists():
-        raise FileNotFoundError(f"找不到源数据: {json_path}")
-    
-    all_docs = []
-    with open(json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-        for item in data:
-            all_docs.append(Document(page_content=item["page_content"], metadata=item["metadata"]))
-    
-    total_docs = len(all_docs)
-    logger.info(f"知识库 {kb_name}: 总文档数 {total_docs}")
-    
-    # 2. 加载当前进度 (FAISS)
-    embeddings = HunyuanEmbeddings()
-    vectorstore = None
-    current_count = 0
-    
-    if vector_path.exists():
-        try:
-            # 尝试加载现有索引
-            vectorstore = FAISS.load_local(str(vector_path), embeddings, allow_dangerous_deserialization=True)
-            current_count = vectorstore.index.ntotal
-            logger.info(f"已加载现有索引，当前进度: {current_count}/{total_docs}")
-        except Exception as e:
-            logger.warning(f"现有索引损坏或无法读取，将重建: {e}")
-            current_count = 0
-    
-    # 如果已经完成了，直接返回
-    if current_count >= total_docs:
-        logger.info("任务已完成，无需处理")
-        return current_count, total_docs
-
-    # 3. 计算剩余任务
-    remaining_docs = all_docs[current_count:]
-    logger.info(f"剩余任务: {len(remaining_docs)} 个片段")
-    
-    if progress_callback:
-        progress_callback(current_count, total_docs)
+    # 1. 加载源数据 (片段库)
+    if not chunk_store.kb_exists(kb_name):
+        raise FileNotFoundError(f"找不到源数据: {chunk_store.chunk_db_path(kb_name)}")
 
-    # 4. 分批处理循环
-    # 计算需要多少个批次
-    total_batches = math.ceil(len(remaining_docs) / batch_size)
-    
-    for i in range(total_batches):
-        start = i * batch_size
-        end = min((i + 1) * batch_size, len(remaining_docs))
-        
-        batch_docs = remaining_docs[start:end]
-        batch_texts = [d.page_content for d in batch_docs]
-        batch_metas = [d.metadata for d in batch_docs]
-        
-        # UI 进度显示
-        current_global_idx = current_count + start
+    embeddings = HunyuanEmbeddings()
+    with KBWriter(kb_name, index_type=index_type, embeddings=embeddings, checkpoint_every=batch_size) as writer:
+        # 2. 当前进度 (KBWriter 已加载现有索引，旧版索引会先迁移为按片段 id 关联)
+        all_ids = chunk_store.list_chunk_ids(kb_name)
+        total_docs = len(all_ids)
+        done = writer.live_chunk_ids()
+        missing = [i for i in all_ids if i not in done]
+        current_count = total_docs - len(missing)
+        logger.info(f"知识库 {kb_name}: 总文档数 {total_docs}，已有向量 {current_count}")
+
+        if not missing:
+            # 已经完成：退出 KBWriter 时按需压缩 / 转换 (指定了新的索引类型时)
+            logger.info("任务已完成，无需处理")
+            return current_count, total_docs
+
+        # 3. 计算剩余任务
+        logger.info(f"剩余任务: {len(missing)} 个片段")
         if progress_callback:
-            progress_callback(current_global_idx, total_docs)
+            progress_callback(current_count, total_docs)
 
-        # 调用 Embedding (这里利用了之前增加的重试机制)
-        try:
-            batch_embeddings = embeddings.embed_documents(batch_texts)
-            
-            # 过滤有效向量
-            valid_text_embeddings = []
-            valid_metadatas = []
-            for text, emb, meta in zip(batch_texts, batch_embeddings, batch_metas):
-                if emb and len(emb) > 0:
-                    valid_text_embeddings.append((text, emb))
-                    valid_metadatas.append(meta)
-            
-            # 写入 FAISS
-            if valid_text_embeddings:
-                if vectorstore is None:
-                    # 如果是第一次创建
-                    vectorstore = FAISS.from_embeddings(valid_text_embeddings, embeddings, valid_metadatas)
-                else:
-                    # 追加到现有索引
-                    vectorstore.add_embeddings(valid_text_embeddings, valid_metadatas)
-                
-                # === 关键点：每批次立即保存 (Checkpoint) ===
-                vectorstore.save_local(str(vector_path))
-                current_count = vectorstore.index.ntotal
+        # 4. 分批处理循环
+        total_batches = math.ceil(len(missing) / batch_size)
+        for i in range(total_batches):
+            if cancel_event is not None and cancel_event.is_set():
+                logger.info(f"知识库 {kb_name}: 续传已取消，当前进度 {current_count}/{total_docs}")
+                return current_count, total_docs
+
+            batch_ids = missing[i * batch_size:(i + 1) * batch_size]
+            records = chunk_store.get_chunks(kb_name, batch_ids)
+            batch = [records[cid] for cid in batch_ids if cid in records]
+            batch_texts = [item["page_content"] for item in batch]
+            batch_metas = [item["metadata"] for item in batch]
+
+            try:
+                batch_embeddings = embeddings.embed_documents(batch_texts)
+                # 写入 FAISS，KBWriter 每 batch_size 个向量保存一次 (Checkpoint)
+                current_count += writer.add_embeddings(batch_texts, batch_metas, batch_embeddings)
                 logger.info(f"Batch {i+1} Saved. Progress: {current_count}/{total_docs}")
-            
-            # 休息一下，防止 QPS 爆炸
-            time.sleep(0.5)
-            
-        except Exception as e:
-            logger.error(f"批次 {i+1} 处理失败: {e}", exc_info=True)
-            # 这里可以选择 continue 跳过，或者 raise 停止
-            # 为了数据完整性，建议 raise 停止，让用户重试，而不是跳过导致中间缺数据
-            raise e
+            except Exception as e:
+                logger.error(f"批次 {i+1} 处理失败: {e}", exc_info=True)
+                # 为了数据完整性直接停止，让用户重试；已保存的批次不会重复处理
+                raise e
+
+            if progress_callback:
+                progress_callback(current_count, total_docs)
 
-    final_count = vectorstore.index.ntotal if vectorstore else current_count
-    return final_count, total_docs
+    return current_count, total_docs
 
 
 # [新增] 以“文档”为粒度的视图，便于前端展示
 def get_kb_documents(kb_name: str) -> List[Dict]:
     """
-    将知识库 JSON 中的片段按 source 聚合成“文档”列表。
+    将知识库中的片段按 source 聚合成“文档”列表 (读取入库时维护的 source_stats)。
 
     返回示例:
     [
@@ -342,54 +868,65 @@ def get_kb_documents(kb_name: str) -> List[Dict]:
         ...
     ]
     """
-    data = _read_kb_json(kb_name)
-    docs: Dict[str, Dict[str, Any]] = {}
-
-    for item in data:
-        meta = item.get("metadata", {})
-        source = meta.get("source", "unknown")
-        content = item.get("page_content", "") or ""
-
-        if source not in docs:
-            docs[source] = {
-                "name": source,
-                "chunk_count": 0,
-                "total_chars": 0,
-            }
+    try:
+        return chunk_store.list_sources(kb_name)
+    except Exception as e:
+        logger.error(f"读取知识库 {kb_name} 文档列表失败: {e}", exc_info=True)
+        return []
 
-        docs[source]["chunk_count"] += 1
-        docs[source]["total_chars"] += len(content)
 
-    # 转为列表形式，前端更易消费
-    return list(docs.values())
+# [新增] 搜索功能
+def _highlight_spans(content: str, terms: List[str]) -> List[List[int]]:
+    """关键词在片段中出现的位置 [[start, end], ...] (大小写不敏感，重叠区间合并)，供前端高亮。"""
+    lowered = content.lower()
+    spans = []
+    for term in terms:
+        needle = term.lower()
+        pos = lowered.find(needle)
+        while pos != -1:
+            spans.append([pos, pos + len(needle)])
+            pos = lowered.find(needle, pos + len(needle))
+    spans.sort()
+    merged: List[List[int]] = []
+    for start, end in spans:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
 
 
-# [新增] 搜索功能
-def search_kb_chunks(kb_name: str, keyword: str, limit: int = 20) -> List[Dict]:
+def search_kb_chunks(kb_name: str, keyword: str, limit: int = 20, offset: int = 0,
+                     metadata_filter: Dict[str, Any] = None) -> Dict[str, Any]:
     """
-    在知识库的 JSON 源文件中搜索关键词
+    在知识库的片段中搜索关键词 (空格分隔的多个词需同时出现)。
+    走片段库的 trigram 全文索引，按相关度排序、支持 offset 分页，
+    返回 {"results": [...], "offset", "next_offset", "has_more"}，next_offset 为 None 表示没有下一页。
+    metadata_filter 不合法时抛出 ValueError。
     """
-    json_path = STORAGE_DIR / f"{kb_name}.json"
+    terms = list(dict.fromkeys(keyword.split()))
+    conditions = parse_filter(metadata_filter)
     results = []
-    
-    if json_path.exists():
-        with open(json_path, "r", encoding="utf-8") as f:
-            try:
-                data = json.load(f)
-                for i, item in enumerate(data):
-                    content = item.get("page_content", "")
-                    # 简单的大小写不敏感搜索
-                    if keyword.lower() in content.lower():
-                        results.append({
-                            "id": i,  # 记录原始索引
-                            "content": content,
-                            "metadata": item.get("metadata", {})
-                        })
-                        if len(results) >= limit:
-                            break
-            except Exception as e:
-                logger.error(f"搜索知识库 {kb_name} 出错: {e}")
-    return results
+    has_more = False
+    try:
+        records, has_more = chunk_store.search_chunks(kb_name, terms, limit=limit, offset=offset, conditions=conditions)
+        for item in records:
+            content = item.get("page_content", "")
+            results.append({
+                "id": item["id"],  # 片段 id (即写入顺序)
+                "content": content,
+                "metadata": item.get("metadata", {}),
+                "score": item["score"],
+                "highlights": _highlight_spans(content, terms),
+            })
+    except Exception as e:
+        logger.error(f"搜索知识库 {kb_name} 出错: {e}")
+    return {
+        "results": results,
+        "offset": offset,
+        "next_offset": offset + len(results) if has_more else None,
+        "has_more": has_more,
+    }
 
 # [新增] 获取特定 ID 的向量
 def get_chunk_vector(kb_name: str, chunk_index: int) -> Dict:
@@ -409,18 +946,32 @@ def get_chunk_vector(kb_name: str, chunk_index: int) -> Dict:
         return result
         
     try:
-        # 读取索引
-        index = faiss.read_index(str(faiss_path))
-        
-        # 检查 ID 是否越界
-        if chunk_index < 0 or chunk_index >= index.ntotal:
-            result["msg"] = f"索引越界 (请求 ID: {chunk_index}, 总数: {index.ntotal})"
-            return result
+        if chunk_store.get_manifest_value(kb_name, _VECTOR_IDS_KEY) == _VECTOR_IDS_CHUNK:
+            # 向量库按片段 id 关联：从 (缓存的) 向量库中查出该片段向量的内部序号
+            _, vectorstore = kb_cache.get(kb_name, _kb_version(kb_name), lambda: _load_single_kb(kb_name, HunyuanEmbeddings()))
+            if vectorstore is None:
+                result["msg"] = "索引无法加载"
+                return result
+            position = docstore_positions(vectorstore).get(str(chunk_index))
+            if position is None:
+                result["msg"] = f"片段 {chunk_index} 没有对应的向量 (不存在、已删除或尚未向量化)"
+                return result
+            index = unwrap_index(vectorstore.index)
+        else:
+            # 旧版向量库：第 i 个向量对应第 i 个片段
+            # 读取索引 (mmap 模式下 reconstruct 只触及对应向量所在的页)
+            index, _ = _read_faiss_index(faiss_path)
+            position = chunk_index
+
+            # 检查 ID 是否越界
+            if chunk_index < 0 or chunk_index >= index.ntotal:
+                result["msg"] = f"索引越界 (请求 ID: {chunk_index}, 总数: {index.ntotal})"
+                return result
             
         # 重构向量 (reconstruct)
-        # 注意：某些 FAISS 索引类型不支持 reconstruct，但 IndexFlatL2 (默认) 支持
+        # 注意：某些 FAISS 索引类型不支持 reconstruct，IVF 类索引会按需构建直接映射
         try:
-            vec = index.reconstruct(chunk_index)
+            vec = reconstruct_vector(index, position, faiss_path.parent)
             # 转换为普通列表以便 JSON 序列化，并保留前 10 位用于预览
             vec_list = vec.tolist()
             result["exists"] = True
@@ -441,28 +992,19 @@ def peek_kb_random_chunks(kb_names: List[str], sample_size: int = 3) -> str:
     """
     通用采样：从指定的知识库列表中，随机抽取几个片段。
     目的：让 LLM 快速感知这个库的"画风"、词汇习惯和年代背景。
+    样本取自片段库中随写入维护的蓄水池，耗时与知识库大小无关。
     """
     previews = []
     
     for name in kb_names:
-        json_path = STORAGE_DIR / f"{name}.json"
-        if json_path.exists():
-            try:
-                with open(json_path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    if data:
-                        # 随机抽取，或者取前几个
-                        # 为了速度和代表性，我们取前、中、后各一个，或者直接随机
-                        # 限制 sample_size 防止 token 爆炸
-                        real_sample_size = min(len(data), sample_size)
-                        samples = random.sample(data, real_sample_size)
-                        
-                        for s in samples:
-                            content = s.get("page_content", "")[:200]  # 只取前200字做样本
-                            previews.append(f"[来自库 {name}]: ...{content}...")
-            except Exception as e:
-                logger.warning(f"采样知识库 {name} 时出错: {e}")
-                continue
+        try:
+            # 限制 sample_size 防止 token 爆炸
+            for s in chunk_store.sample_chunks(name, sample_size):
+                content = s["content"][:200]  # 只取前200字做样本
+                previews.append(f"[来自库 {name}]: ...{content}...")
+        except Exception as e:
+            logger.warning(f"采样知识库 {name} 时出错: {e}")
+            continue
     
     if not previews:
         return "（知识库为空或无法读取，无样本）"
@@ -0,0 +1,164 @@
+"""
+BM25 分词服务（多进程 + 预加载词典）。
+
+jieba 的词典在第一次 cut 时才懒加载 (约 1 秒)，而且分词是纯 Python、CPU 密集的，
+入库时在写索引的线程里逐片段分词会拖慢整条流水线。这里：
+- 入库时按批提交到进程池分词 (TOKENIZE_TASK_SIZE 个片段一组)，
+  子进程启动时即加载 jieba 词典与用户词典 (JIEBA_USER_DICT)，不在第一个任务里付这笔开销；
+- 服务进程启动时在后台线程预加载词典 (preload)，第一次查询不再多等一秒；
+- 提供字符二元组 (bigram) 分词模式：中文按相邻两字切分，字母数字按词切分并转小写，
+  不依赖词典，适合对延迟敏感的知识库 (索引略大，对未登录词更友好)。
+
+分词模式按知识库记录在片段库 manifest 中 (bm25_tokenizer)，入库与查询必须使用同一模式。
+片段数较少 (< TOKENIZE_PARALLEL_MIN) 或 bigram 模式时在当前进程分词，省去进程间传输开销。
+"""
+import os
+import re
+import threading
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Sequence
+
+import jieba
+
+from src.logger import get_logger
+from src.process_pool import SpawnProcessPool
+
+logger = get_logger("Tokenizer")
+
+TOKENIZER_JIEBA = "jieba"
+TOKENIZER_BIGRAM = "bigram"
+TOKENIZER_MODES = (TOKENIZER_JIEBA, TOKENIZER_BIGRAM)
+
+BM25_TOKENIZER = os.getenv("BM25_TOKENIZER", TOKENIZER_JIEBA)
+JIEBA_USER_DICT = os.getenv("JIEBA_USER_DICT", "")
+TOKENIZE_WORKERS = int(os.getenv("TOKENIZE_WORKERS", str(min(4, os.cpu_count() or 1))))
+TOKENIZE_TASK_SIZE = int(os.getenv("TOKENIZE_TASK_SIZE", "256"))
+TOKENIZE_PARALLEL_MIN = int(os.getenv("TOKENIZE_PARALLEL_MIN", "512"))
+
+# 中日韩统一表意文字 (含扩展 A 与兼容区)；其余的字母数字按整词切分
+_CJK = "\u3400-\u9fff\uf900-\ufaff"
+_CJK_RE = re.compile(f"[{_CJK}]")
+_BIGRAM_RE = re.compile(f"[{_CJK}]+|[^\\W{_CJK}]+")
+
+
+def check_mode(mode: Optional[str]) -> str:
+    """规范化分词模式，None 表示默认模式；不支持的模式抛出 ValueError。"""
+    mode = mode or BM25_TOKENIZER
+    if mode not in TOKENIZER_MODES:
+        raise ValueError(f"不支持的分词模式: {mode} (可用: {', '.join(TOKENIZER_MODES)})")
+    return mode
+
+
+# ===== 分词 (主进程与子进程共用) =====
+
+_jieba_lock = threading.Lock()
+_jieba_ready = False
+
+
+def _load_jieba(user_dict: str = JIEBA_USER_DICT):
+    """加载 jieba 主词典与用户词典，只执行一次。"""
+    global _jieba_ready
+    if _jieba_ready:
+        return
+    with _jieba_lock:
+        if _jieba_ready:
+            return
+        jieba.initialize()
+        if user_dict:
+            try:
+                jieba.load_userdict(user_dict)
+            except Exception as e:
+                logger.warning(f"用户词典 {user_dict} 加载失败: {e}")
+        _jieba_ready = True
+
+
+def preload():
+    """预加载 jieba 词典 (服务启动时在后台线程调用；旧知识库与默认模式都依赖它)。"""
+    _load_jieba()
+
+
+def bigram_tokens(text: str) -> List[str]:
+    """中文连续片段切成相邻二字组 (单字片段保留单字)，字母数字按词切分并转小写。"""
+    tokens = []
+    for run in _BIGRAM_RE.findall(text or ""):
+        if _CJK_RE.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run.lower())
+    return tokens
+
+
+def tokenize(text: str, mode: Optional[str] = None) -> List[str]:
+    """按指定模式分词，去掉纯空白词元。"""
+    if check_mode(mode) == TOKENIZER_BIGRAM:
+        return bigram_tokens(text)
+    _load_jieba()
+    return [t for t in jieba.cut(text or "") if t.strip()]
+
+
+def _tokenize_batch(texts: Sequence[str], mode: str) -> List[List[str]]:
+    """子进程任务：分词一组文本。"""
+    return [tokenize(text, mode) for text in texts]
+
+
+def _init_worker(user_dict: str):
+    """子进程启动时预加载词典，第一个任务不再等待懒加载。"""
+    _load_jieba(user_dict)
+
+
+# ===== 进程池 =====
+
+_pool = SpawnProcessPool(TOKENIZE_WORKERS, initializer=_init_worker, initargs=(JIEBA_USER_DICT,))
+
+
+def shutdown_pool():
+    _pool.shutdown()
+
+
+def _use_pool(mode: str) -> bool:
+    # bigram 切分比进程间传输还快，始终在当前进程执行
+    return mode == TOKENIZER_JIEBA and TOKENIZE_WORKERS > 0
+
+
+def tokenize_many(texts: Sequence[str], mode: Optional[str] = None) -> List[List[str]]:
+    """批量分词，返回与 texts 对齐的词元列表；数量较多时在进程池中并行。"""
+    mode = check_mode(mode)
+    texts = list(texts)
+    if len(texts) < TOKENIZE_PARALLEL_MIN or not _use_pool(mode):
+        return _tokenize_batch(texts, mode)
+    try:
+        pool = _pool.get()
+        futures = [
+            pool.submit(_tokenize_batch, texts[start:start + TOKENIZE_TASK_SIZE], mode)
+            for start in range(0, len(texts), TOKENIZE_TASK_SIZE)
+        ]
+        results: List[List[str]] = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+    except BrokenProcessPool as e:
+        logger.warning(f"分词进程池异常，改为在当前进程分词: {e}")
+        _pool.reset()
+        return _tokenize_batch(texts, mode)
+
+
+def tokenize_async(texts: Sequence[str], mode: Optional[str] = None) -> Future:
+    """
+    提交一批文本分词，立即返回 Future (结果同 tokenize_many)。
+    入库流水线在向量化的同时分词，写索引时直接取结果。
+    """
+    mode = check_mode(mode)
+    texts = list(texts)
+    if _use_pool(mode):
+        try:
+            return _pool.get().submit(_tokenize_batch, texts, mode)
+        except (BrokenProcessPool, RuntimeError) as e:
+            logger.warning(f"分词进程池不可用，改为在当前进程分词: {e}")
+            _pool.reset()
+    future: Future = Future()
+    future.set_result(_tokenize_batch(texts, mode))
+    return future
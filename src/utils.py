@@ -1,44 +1,42 @@
 import tempfile
 import os
-from typing import List
+from typing import Iterator, List
 
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_core.documents import Document
-from pypdf import PdfReader
 
+from src.pdf_extract import iter_pdf_pages
 
-def _load_from_path(path: str, filename: str) -> List[Document]:
+
+def iter_documents_from_path(path: str, filename: str) -> Iterator[Document]:
     """
-    从本地文件路径加载为 Document 列表。
-    仅依赖 pypdf 与标准文本读取，避免 langchain_community 的兼容性问题。
+    逐页 (PDF) / 整文件 (文本) 产出 Document，供流式入库使用，不会一次性持有整份文件的文本。
+    PDF 由 src.pdf_extract 多进程解析并按页码顺序流式返回，重复文件命中文本缓存。
     """
     ext = os.path.splitext(filename)[1].lower()
 
     if ext == ".pdf":
-        reader = PdfReader(path)
-        docs: List[Document] = []
-        for i, page in enumerate(reader.pages):
-            text = page.extract_text() or ""
+        for i, text in iter_pdf_pages(path):
             if not text.strip():
                 continue
-            docs.append(
-                Document(
-                    page_content=text,
-                    metadata={"source": filename, "page": i},
-                )
+            yield Document(
+                page_content=text,
+                metadata={"source": filename, "page": i},
             )
-        return docs
     else:
         with open(path, "r", encoding="utf-8") as f:
             text = f.read()
         if not text.strip():
-            return []
-        return [
-            Document(
-                page_content=text,
-                metadata={"source": filename},
-            )
-        ]
+            return
+        yield Document(
+            page_content=text,
+            metadata={"source": filename},
+        )
+
+
+def _load_from_path(path: str, filename: str) -> List[Document]:
+    """从本地文件路径加载为 Document 列表。"""
+    return list(iter_documents_from_path(path, filename))
 
 
 def load_file(uploaded_file) -> List[Document]:
@@ -0,0 +1,618 @@
+"""
+知识库向量索引的构建与参数管理。
+
+支持四种索引类型：
+- flat:     精确检索 (IndexFlatL2)，小库默认；
+- ivf_flat: 倒排 + 精确向量 (IndexIVFFlat)，需要训练聚类中心；
+- hnsw:     图索引 (IndexHNSWFlat)，无需训练，不支持删除；
+- ivf_pq:   倒排 + 乘积量化压缩 (可选 OPQ 旋转)，每个向量只占 KB_PQ_BYTES 字节，
+            原始向量另存于冷文件 vectors.f32，检索时可对候选做精确重排。
+
+向量库的 docstore 以片段 id 为键 (index_to_docstore_id: 索引内部序号 -> 片段 id)。
+删除片段时先从 docstore 中移除 (墓碑)，检索时过滤掉墓碑序号；
+墓碑比例超过 KB_COMPACT_RATIO (flat 索引任意比例) 时重建索引回收空间，
+重建复用已训练的聚类中心 / 码本，不需要重新训练。
+
+index_type="auto" 时按知识库规模选择：低于 KB_ANN_THRESHOLD 用 flat，
+以上用 ivf_flat；ivf_pq 需显式指定。索引参数 (nlist / nprobe / ef_search 等)
+记录在知识库 manifest 中，加载时据此设置检索参数。
+"""
+import math
+import os
+import threading
+import weakref
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
+
+from src.logger import get_logger
+
+logger = get_logger("VectorIndex")
+
+INDEX_FLAT = "flat"
+INDEX_IVF_FLAT = "ivf_flat"
+INDEX_HNSW = "hnsw"
+INDEX_IVF_PQ = "ivf_pq"
+INDEX_TYPES = (INDEX_FLAT, INDEX_IVF_FLAT, INDEX_HNSW, INDEX_IVF_PQ)
+
+DEFAULT_INDEX_TYPE = os.getenv("KB_INDEX_TYPE", "auto")
+ANN_AUTO_THRESHOLD = int(os.getenv("KB_ANN_THRESHOLD", "50000"))
+
+# IVF 训练时每个聚类中心建议至少 39 个样本 (faiss 经验值)
+IVF_MIN_POINTS_PER_CENTROID = 39
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+
+# 压缩模式：每个向量的字节预算、是否启用 OPQ 旋转、精确重排的候选倍数 (0 关闭)
+PQ_BYTES_PER_VECTOR = int(os.getenv("KB_PQ_BYTES", "64"))
+PQ_USE_OPQ = os.getenv("KB_PQ_OPQ", "1") == "1"
+PQ_RERANK_FACTOR = int(os.getenv("KB_PQ_RERANK", "4"))
+# PQ 每个子空间 256 个码字，按每码字 39 个样本估算最少训练量
+PQ_MIN_TRAIN_POINTS = 256 * IVF_MIN_POINTS_PER_CENTROID
+COLD_VECTORS_FILE = "vectors.f32"
+# 墓碑 (已删除但仍在索引中的向量) 占比超过该值时压缩重建
+COMPACT_RATIO = float(os.getenv("KB_COMPACT_RATIO", "0.2"))
+# 元数据过滤后候选不超过该数量时，直接对候选向量做精确检索，否则用 faiss ID selector
+FILTER_EXACT_MAX = int(os.getenv("KB_FILTER_EXACT_MAX", "4096"))
+
+_direct_map_lock = threading.Lock()
+
+
+def _ivf_nlist(n_vectors: int) -> int:
+    # nlist ≈ 4·sqrt(N)，同时保证训练样本充足
+    nlist = int(4 * math.sqrt(max(n_vectors, 1)))
+    return max(1, min(nlist, 65536, n_vectors // IVF_MIN_POINTS_PER_CENTROID))
+
+
+def choose_pq_m(dim: int, bytes_per_vector: int = PQ_BYTES_PER_VECTOR) -> int:
+    """在字节预算内选最大的子量化器个数 m (8 bit 编码下 m 即每向量字节数)，需整除维度。"""
+    for m in range(min(bytes_per_vector, dim), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def choose_index_params(n_vectors: int, index_type: Optional[str] = None) -> Dict[str, Any]:
+    """
+    根据向量数量与期望类型给出索引参数。
+    index_type 为空或 "auto" 时按规模自动选择。
+    """
+    index_type = index_type or DEFAULT_INDEX_TYPE
+    if index_type == "auto":
+        index_type = INDEX_IVF_FLAT if n_vectors >= ANN_AUTO_THRESHOLD else INDEX_FLAT
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"不支持的索引类型: {index_type}，可选 {INDEX_TYPES} 或 auto")
+
+    params: Dict[str, Any] = {"index_type": index_type}
+    if index_type == INDEX_IVF_PQ and n_vectors < PQ_MIN_TRAIN_POINTS:
+        # 样本不足以训练码本，退回 IVF-Flat / Flat
+        logger.info(f"向量数 {n_vectors} 不足以训练 PQ (至少 {PQ_MIN_TRAIN_POINTS})，暂不压缩")
+        index_type = INDEX_IVF_FLAT
+        params["index_type"] = index_type
+
+    if index_type in (INDEX_IVF_FLAT, INDEX_IVF_PQ):
+        nlist = _ivf_nlist(n_vectors)
+        if nlist < 16:
+            # 数据太少，IVF 没有意义
+            return {"index_type": INDEX_FLAT}
+        params["nlist"] = nlist
+        params["nprobe"] = min(nlist, max(8, nlist // 16))
+        if index_type == INDEX_IVF_PQ:
+            params["pq_bytes"] = PQ_BYTES_PER_VECTOR
+            params["opq"] = PQ_USE_OPQ
+            params["rerank_factor"] = PQ_RERANK_FACTOR
+    elif index_type == INDEX_HNSW:
+        params["hnsw_m"] = HNSW_M
+        params["ef_construction"] = HNSW_EF_CONSTRUCTION
+        params["ef_search"] = HNSW_EF_SEARCH
+    return params
+
+
+def resolve_index_params(recorded: Dict[str, Any], n_vectors: int, index_type: Optional[str] = None) -> Dict[str, Any]:
+    """
+    结合 manifest 中已记录的参数，计算当前规模下的目标索引参数。
+    类型不变 (或已是显式指定的类型) 时沿用已记录的参数，
+    IVF 的 nlist、PQ 码本在训练时已固定。
+    """
+    requested = index_type or recorded.get("requested_type") or DEFAULT_INDEX_TYPE
+    target = choose_index_params(n_vectors, requested)
+    if recorded.get("index_type") in (target["index_type"], requested):
+        target = {**target, **recorded}
+    target["requested_type"] = requested
+    return target
+
+
+def unwrap_index(index: Any) -> Any:
+    """去掉检索时的包装 (精确重排 / 墓碑过滤)，返回底层 faiss 索引。"""
+    while isinstance(index, (RescoringIndex, TombstoneFilterIndex)):
+        index = index.index
+    return index
+
+
+def index_type_of(index: Any) -> str:
+    """识别已有 faiss 索引的类型。"""
+    index = unwrap_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return INDEX_HNSW
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except Exception:
+        return INDEX_FLAT
+    return INDEX_IVF_PQ if isinstance(faiss.downcast_index(ivf), faiss.IndexIVFPQ) else INDEX_IVF_FLAT
+
+
+def build_index(vectors: np.ndarray, params: Dict[str, Any]) -> Any:
+    """
+    按参数创建 (并在需要时训练) 一个空索引，不添加向量。
+    vectors: 训练样本，shape = (n, d)
+    """
+    dim = vectors.shape[1]
+    index_type = params["index_type"]
+
+    if index_type == INDEX_IVF_FLAT:
+        quantizer = faiss.IndexFlatL2(dim)
+        index = faiss.IndexIVFFlat(quantizer, dim, params["nlist"], faiss.METRIC_L2)
+        logger.info(f"训练 IVF 索引: nlist={params['nlist']}, 样本数={len(vectors)}")
+        index.train(vectors)
+    elif index_type == INDEX_IVF_PQ:
+        m = choose_pq_m(dim, params["pq_bytes"])
+        prefix = f"OPQ{m}," if params.get("opq") else ""
+        index = faiss.index_factory(dim, f"{prefix}IVF{params['nlist']},PQ{m}", faiss.METRIC_L2)
+        # 工厂默认开启 polysemous 训练 (比训练码本本身慢数十倍)，检索不使用汉明过滤，关闭
+        faiss.downcast_index(faiss.extract_index_ivf(index)).do_polysemous_training = False
+        logger.info(f"训练 IVF-PQ 索引: {prefix}IVF{params['nlist']},PQ{m} (每向量 {m} 字节), 样本数={len(vectors)}")
+        index.train(vectors)
+        params["pq_m"] = m
+    elif index_type == INDEX_HNSW:
+        index = faiss.IndexHNSWFlat(dim, params["hnsw_m"])
+        index.hnsw.efConstruction = params["ef_construction"]
+    else:
+        index = faiss.IndexFlatL2(dim)
+
+    apply_search_params(index, params)
+    return index
+
+
+def apply_search_params(index: Any, params: Dict[str, Any]):
+    """把 manifest 中记录的检索参数应用到加载后的索引上。"""
+    index_type = params.get("index_type", INDEX_FLAT)
+    if index_type in (INDEX_IVF_FLAT, INDEX_IVF_PQ) and params.get("nprobe"):
+        faiss.extract_index_ivf(index).nprobe = params["nprobe"]
+    elif index_type == INDEX_HNSW and params.get("ef_search") and isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = params["ef_search"]
+
+
+def estimate_index_bytes(index: Any) -> int:
+    """估算索引常驻内存字节数 (供知识库缓存计算预算)。"""
+    index_type = index_type_of(index)
+    index = unwrap_index(index)
+    if index_type == INDEX_IVF_PQ:
+        # 每个向量: PQ 编码 + 8 字节 id
+        return index.ntotal * (faiss.extract_index_ivf(index).code_size + 8)
+    size = index.ntotal * index.d * 4
+    if index_type == INDEX_HNSW:
+        size += index.ntotal * index.hnsw.nb_neighbors(0) * 4
+    return size
+
+
+def reconstruct_all(index: Any, vector_path: Optional[Path] = None) -> np.ndarray:
+    """
+    按内部顺序取出索引中的全部向量 (用于索引类型转换)。
+    压缩索引优先从冷文件读取原始向量，避免量化误差被带入新索引。
+    """
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype="float32")
+    if vector_path is not None and index_type_of(index) == INDEX_IVF_PQ:
+        cold = load_cold_vectors(vector_path, index.d)
+        if cold is not None and len(cold) == index.ntotal:
+            return np.array(cold)
+    _ensure_direct_map(index)
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def _ensure_direct_map(index: Any):
+    """IVF 类索引按 id 重构向量前需要直接映射，按需在内存中构建 (不写回磁盘)。"""
+    index = unwrap_index(index)
+    if index_type_of(index) in (INDEX_IVF_FLAT, INDEX_IVF_PQ):
+        ivf = faiss.extract_index_ivf(index)
+        if ivf.direct_map.type == faiss.DirectMap.NoMap:
+            # 缓存中的只读索引可能被多个请求同时使用，只构建一次
+            with _direct_map_lock:
+                if ivf.direct_map.type == faiss.DirectMap.NoMap:
+                    ivf.make_direct_map()
+
+
+def reconstruct_vector(index: Any, i: int, vector_path: Optional[Path] = None) -> np.ndarray:
+    """按内部序号取出单个向量；压缩索引优先读取冷文件中的原始向量。"""
+    if vector_path is not None and index_type_of(index) == INDEX_IVF_PQ:
+        cold = load_cold_vectors(vector_path, index.d)
+        if cold is not None and i < len(cold):
+            return np.array(cold[i])
+    _ensure_direct_map(index)
+    return index.reconstruct(i)
+
+
+# === 压缩模式的冷向量文件 ===
+
+def write_cold_vectors(vector_path: Path, vectors: np.ndarray, append: bool = False):
+    """原始向量按索引内部顺序写入 vector_path/vectors.f32 (float32 行优先)。"""
+    vector_path.mkdir(parents=True, exist_ok=True)
+    with open(vector_path / COLD_VECTORS_FILE, "ab" if append else "wb") as f:
+        f.write(np.ascontiguousarray(vectors, dtype="float32").tobytes())
+
+
+def load_cold_vectors(vector_path: Path, dim: int) -> Optional[np.ndarray]:
+    """以只读 memmap 打开冷向量文件，只有被访问到的行才会读入内存。"""
+    path = vector_path / COLD_VECTORS_FILE
+    if not path.exists() or path.stat().st_size == 0:
+        return None
+    return np.memmap(path, dtype="float32", mode="r").reshape(-1, dim)
+
+
+def _exact_l2(queries: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+    """平方 L2 距离矩阵，与 IndexFlatL2 的返回值一致。"""
+    return (
+        (queries ** 2).sum(axis=1, keepdims=True)
+        - 2 * queries @ vectors.T
+        + (vectors ** 2).sum(axis=1)[None, :]
+    )
+
+
+class RescoringIndex:
+    """
+    压缩索引的精确重排包装：先在 PQ 索引里取 k * rerank_factor 个候选，
+    再用冷文件中的原始向量计算精确距离重新排序。
+    其余属性 (ntotal / d / reconstruct 等) 透传给底层索引，仅用于只读检索。
+    """
+
+    def __init__(self, index: Any, cold_vectors: np.ndarray, rerank_factor: int):
+        self.index = index
+        self.cold_vectors = cold_vectors
+        self.rerank_factor = max(1, rerank_factor)
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+    def search(self, x: np.ndarray, k: int, **kwargs) -> Tuple[np.ndarray, np.ndarray]:
+        x = np.ascontiguousarray(x, dtype="float32")
+        n_candidates = min(self.index.ntotal, k * self.rerank_factor)
+        _, candidates = self.index.search(x, n_candidates, **kwargs)
+
+        distances = np.full((len(x), k), np.inf, dtype="float32")
+        labels = np.full((len(x), k), -1, dtype="int64")
+        for row, cand in enumerate(candidates):
+            # 排序后再取行，memmap 顺序读取候选所在的页
+            cand = np.sort(cand[cand >= 0])
+            if len(cand) == 0:
+                continue
+            exact = _exact_l2(x[row:row + 1], np.asarray(self.cold_vectors[cand]))[0]
+            order = np.argsort(exact)[:k]
+            distances[row, :len(order)] = exact[order]
+            labels[row, :len(order)] = cand[order]
+        return distances, labels
+
+    def reconstruct(self, i: int) -> np.ndarray:
+        return np.array(self.cold_vectors[i])
+
+
+def wrap_for_search(index: Any, params: Dict[str, Any], vector_path: Path) -> Any:
+    """只读加载后按参数包装索引；冷文件缺失或行数不一致时不做重排。"""
+    if params.get("index_type") != INDEX_IVF_PQ or not params.get("rerank_factor"):
+        return index
+    cold = load_cold_vectors(vector_path, index.d)
+    if cold is None or len(cold) != index.ntotal:
+        logger.warning(f"冷向量文件与索引不一致，跳过精确重排: {vector_path}")
+        return index
+    return RescoringIndex(index, cold, params["rerank_factor"])
+
+
+def estimate_recall(index: Any, vectors: np.ndarray, k: int = 10, n_queries: int = 100, block_size: int = 50000) -> float:
+    """
+    用库内随机向量作查询，估算 recall@k (相对精确检索)。
+    精确结果按块计算，内存占用与库大小无关。
+    """
+    n = len(vectors)
+    if n == 0:
+        return 1.0
+    rng = np.random.default_rng(0)
+    query_ids = rng.choice(n, size=min(n_queries, n), replace=False)
+    queries = np.array(vectors[np.sort(query_ids)], dtype="float32")
+    k = min(k, n)
+
+    best_d = np.full((len(queries), k), np.inf, dtype="float32")
+    best_i = np.full((len(queries), k), -1, dtype="int64")
+    for start in range(0, n, block_size):
+        block = np.asarray(vectors[start:start + block_size], dtype="float32")
+        d = _exact_l2(queries, block)
+        all_d = np.concatenate([best_d, d], axis=1)
+        all_i = np.concatenate([best_i, np.arange(start, start + len(block))[None, :].repeat(len(queries), 0)], axis=1)
+        top = np.argsort(all_d, axis=1)[:, :k]
+        best_d = np.take_along_axis(all_d, top, axis=1)
+        best_i = np.take_along_axis(all_i, top, axis=1)
+
+    _, found = index.search(queries, k)
+    hits = sum(len(set(found[r]) & set(best_i[r])) for r in range(len(queries)))
+    return round(hits / (len(queries) * k), 4)
+
+
+def _record_pq_recall(index: Any, params: Dict[str, Any], vectors: np.ndarray, vector_path: Path):
+    """构建压缩索引后测量召回率并写入参数，便于权衡压缩率与精度。"""
+    try:
+        params["recall_at_10"] = estimate_recall(index, vectors)
+        if params.get("rerank_factor"):
+            params["recall_at_10_rerank"] = estimate_recall(
+                RescoringIndex(index, load_cold_vectors(vector_path, index.d), params["rerank_factor"]), vectors
+            )
+        logger.info(
+            f"IVF-PQ 召回率: recall@10={params['recall_at_10']}, "
+            f"精确重排后={params.get('recall_at_10_rerank', '-')}"
+        )
+    except Exception as e:
+        logger.warning(f"召回率测量失败: {e}")
+
+
+def create_vectorstore(
+    text_embeddings: List[Tuple[str, List[float]]],
+    metadatas: List[Dict[str, Any]],
+    embeddings: Embeddings,
+    params: Dict[str, Any],
+    vector_path: Optional[Path] = None,
+    ids: Optional[List[str]] = None,
+) -> FAISS:
+    """
+    FAISS.from_embeddings 的替代：按参数构建指定类型的索引后再写入向量。
+    压缩模式下需传入 vector_path，用于写入冷向量文件。
+    ids: docstore 键 (片段 id)，为空时由 LangChain 生成随机 id
+    """
+    vectors = np.array([emb for _, emb in text_embeddings], dtype="float32")
+    index = build_index(vectors, params)
+    vectorstore = FAISS(embeddings, index, InMemoryDocstore(), {})
+    vectorstore.add_embeddings(text_embeddings, metadatas, ids=ids)
+    if params["index_type"] == INDEX_IVF_PQ and vector_path is not None:
+        write_cold_vectors(vector_path, vectors)
+        _record_pq_recall(index, params, vectors, vector_path)
+    return vectorstore
+
+
+def add_to_vectorstore(
+    vectorstore: FAISS,
+    text_embeddings: List[Tuple[str, List[float]]],
+    metadatas: List[Dict[str, Any]],
+    vector_path: Path,
+    ids: Optional[List[str]] = None,
+):
+    """追加向量；压缩索引同时追加冷向量文件，保证两者行号一致。"""
+    vectorstore.add_embeddings(text_embeddings, metadatas, ids=ids)
+    if index_type_of(vectorstore.index) == INDEX_IVF_PQ:
+        write_cold_vectors(vector_path, np.array([emb for _, emb in text_embeddings], dtype="float32"), append=True)
+
+
+def convert_index(vectorstore: FAISS, params: Dict[str, Any], vector_path: Optional[Path] = None) -> bool:
+    """
+    将向量库的索引转换为 params 指定的类型 (例如小库长大后 flat -> ivf_flat)。
+    向量顺序保持不变，index_to_docstore_id 无需改动。
+    返回是否发生了转换。
+    """
+    current = index_type_of(vectorstore.index)
+    if current == params["index_type"]:
+        apply_search_params(vectorstore.index, params)
+        return False
+
+    vectors = reconstruct_all(vectorstore.index, vector_path)
+    index = build_index(vectors, params)
+    index.add(vectors)
+    vectorstore.index = index
+    logger.info(f"索引类型转换: {current} -> {params['index_type']} (向量数 {index.ntotal})")
+
+    if vector_path is not None:
+        if params["index_type"] == INDEX_IVF_PQ:
+            write_cold_vectors(vector_path, vectors)
+            _record_pq_recall(index, params, vectors, vector_path)
+        elif (vector_path / COLD_VECTORS_FILE).exists():
+            # 不再是压缩索引，冷文件不再维护
+            (vector_path / COLD_VECTORS_FILE).unlink()
+    return True
+
+
+# === 删除：墓碑与压缩 ===
+
+def tombstoned_positions(vectorstore: FAISS) -> np.ndarray:
+    """docstore 中已删除、但向量仍留在索引里的内部序号。"""
+    docs = vectorstore.docstore._dict
+    return np.array(
+        sorted(pos for pos, doc_id in vectorstore.index_to_docstore_id.items() if doc_id not in docs),
+        dtype="int64",
+    )
+
+
+def remove_from_vectorstore(vectorstore: FAISS, doc_ids: List[str]) -> int:
+    """把 doc_ids 对应的片段标记为墓碑 (只删 docstore，向量留待压缩)，返回删除数。"""
+    docs = vectorstore.docstore._dict
+    removed = 0
+    for doc_id in doc_ids:
+        if docs.pop(doc_id, None) is not None:
+            removed += 1
+    if removed:
+        _forget_positions(vectorstore)
+    return removed
+
+
+def needs_compaction(vectorstore: FAISS, n_tombstones: Optional[int] = None) -> bool:
+    if n_tombstones is None:
+        n_tombstones = len(tombstoned_positions(vectorstore))
+    if n_tombstones == 0:
+        return False
+    # flat 重建只是一次内存拷贝，直接回收；其余类型按比例触发
+    if index_type_of(vectorstore.index) == INDEX_FLAT:
+        return True
+    return n_tombstones >= COMPACT_RATIO * max(vectorstore.index.ntotal, 1)
+
+
+def compact_vectorstore(vectorstore: FAISS, vector_path: Optional[Path] = None) -> int:
+    """
+    去掉墓碑向量并重排内部序号，返回回收的向量数。
+    新索引由原索引克隆后 reset 得到，IVF 聚类中心 / PQ 码本 / HNSW 参数保持不变。
+    """
+    tombstones = tombstoned_positions(vectorstore)
+    if len(tombstones) == 0:
+        return 0
+    index = vectorstore.index
+    mapping = vectorstore.index_to_docstore_id
+    dead = set(tombstones.tolist())
+    live = np.array(sorted(pos for pos in mapping if pos not in dead), dtype="int64")
+
+    vectors = reconstruct_all(index, vector_path)[live] if len(live) else np.zeros((0, index.d), dtype="float32")
+    new_index = faiss.clone_index(index)
+    new_index.reset()
+    if len(vectors):
+        new_index.add(vectors)
+    vectorstore.index = new_index
+    vectorstore.index_to_docstore_id = {i: mapping[int(pos)] for i, pos in enumerate(live)}
+    _forget_positions(vectorstore)
+
+    if vector_path is not None and index_type_of(new_index) == INDEX_IVF_PQ:
+        write_cold_vectors(vector_path, vectors)
+    logger.info(f"索引压缩: 回收墓碑向量 {len(tombstones)} 个，剩余 {new_index.ntotal}")
+    return len(tombstones)
+
+
+class TombstoneFilterIndex:
+    """
+    检索时跳过墓碑序号的只读包装 (墓碑在压缩前仍会被 faiss 返回)。
+    先多取候选再过滤，候选不足 k 个时按倍数扩大重新检索。
+    """
+
+    def __init__(self, index: Any, tombstones: np.ndarray):
+        self.index = index
+        self.tombstones = np.asarray(tombstones, dtype="int64")
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+    def search(self, x: np.ndarray, k: int, **kwargs) -> Tuple[np.ndarray, np.ndarray]:
+        ntotal = self.index.ntotal
+        fetch = min(ntotal, k + min(len(self.tombstones), max(k, 16)))
+        while True:
+            distances, labels = self.index.search(x, fetch, **kwargs)
+            valid = (labels >= 0) & ~np.isin(labels, self.tombstones)
+            if fetch >= ntotal or valid.sum(axis=1).min() >= k:
+                break
+            fetch = min(ntotal, fetch * 2)
+
+        out_d = np.full((len(labels), k), np.inf, dtype="float32")
+        out_l = np.full((len(labels), k), -1, dtype="int64")
+        for row in range(len(labels)):
+            keep = np.flatnonzero(valid[row])[:k]
+            out_d[row, :len(keep)] = distances[row, keep]
+            out_l[row, :len(keep)] = labels[row, keep]
+        return out_d, out_l
+
+    def reconstruct(self, i: int) -> np.ndarray:
+        return self.index.reconstruct(i)
+
+
+# === 按序号子集检索 (元数据过滤) ===
+
+# 向量库 -> (版本键, {docstore id: 内部序号})；向量库被缓存淘汰后自动释放
+_positions_cache: "weakref.WeakKeyDictionary[FAISS, Tuple[Tuple[int, int, int], Dict[str, int]]]" = weakref.WeakKeyDictionary()
+_positions_lock = threading.Lock()
+
+
+def docstore_positions(vectorstore: FAISS) -> Dict[str, int]:
+    """
+    docstore id (片段 id) -> 向量内部序号，不含墓碑；按对象缓存。
+    缓存键包含序号映射对象与条目数、docstore 条目数：追加、压缩、打墓碑后都会重建
+    (remove_from_vectorstore / compact_vectorstore 也会主动清除)。
+    """
+    live = vectorstore.docstore._dict
+    key = (id(vectorstore.index_to_docstore_id), len(vectorstore.index_to_docstore_id), len(live))
+    with _positions_lock:
+        cached = _positions_cache.get(vectorstore)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+    mapping = {doc_id: pos for pos, doc_id in vectorstore.index_to_docstore_id.items() if doc_id in live}
+    with _positions_lock:
+        _positions_cache[vectorstore] = (key, mapping)
+    return mapping
+
+
+def _forget_positions(vectorstore: FAISS):
+    with _positions_lock:
+        _positions_cache.pop(vectorstore, None)
+
+
+def reconstruct_positions(index: Any, positions: np.ndarray) -> np.ndarray:
+    """按内部序号批量取出向量 (检索包装会透传到冷文件 / 底层索引)。"""
+    positions = np.asarray(positions, dtype="int64")
+    wrapped = index
+    while isinstance(wrapped, TombstoneFilterIndex):
+        wrapped = wrapped.index
+    if isinstance(wrapped, RescoringIndex):
+        return np.asarray(wrapped.cold_vectors[positions], dtype="float32")
+    base = unwrap_index(index)
+    _ensure_direct_map(base)
+    try:
+        return np.asarray(base.reconstruct_batch(positions), dtype="float32")
+    except (AttributeError, RuntimeError):
+        return np.stack([base.reconstruct(int(p)) for p in positions]).astype("float32")
+
+
+def _selector_params(index: Any, positions: np.ndarray):
+    base = unwrap_index(index)
+    selector = faiss.IDSelectorBatch(positions)
+    index_type = index_type_of(base)
+    if index_type == INDEX_HNSW:
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=faiss.downcast_index(base).hnsw.efSearch)
+    elif index_type in (INDEX_IVF_FLAT, INDEX_IVF_PQ):
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=faiss.extract_index_ivf(base).nprobe)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    # selector 由 Python 持有，检索期间不能被回收
+    params._selector = selector
+    return params
+
+
+def search_positions(vectorstore: FAISS, embedding: List[float], k: int,
+                     positions: np.ndarray) -> List[Tuple[Any, float]]:
+    """
+    只在给定内部序号中检索，返回与 FAISS.similarity_search_with_score_by_vector 相同形式的 [(Document, 原始得分)]。
+    候选较少时取出候选向量精确计算；较多时用 faiss ID selector 限定检索范围。
+    """
+    positions = np.unique(np.asarray(positions, dtype="int64"))
+    if len(positions) == 0 or k <= 0:
+        return []
+    query = np.asarray([embedding], dtype="float32")
+    if getattr(vectorstore, "_normalize_L2", False):
+        faiss.normalize_L2(query)
+    index = vectorstore.index
+    inner_product = getattr(unwrap_index(index), "metric_type", faiss.METRIC_L2) == faiss.METRIC_INNER_PRODUCT
+
+    if len(positions) <= FILTER_EXACT_MAX:
+        vectors = reconstruct_positions(index, positions)
+        if inner_product:
+            scores = vectors @ query[0]
+            order = np.argsort(-scores)[:k]
+        else:
+            scores = _exact_l2(query, vectors)[0]
+            order = np.argsort(scores)[:k]
+        hits = [(int(positions[i]), float(scores[i])) for i in order]
+    else:
+        # 墓碑不在候选序号中，直接用底层索引 (精确重排包装保留，selector 透传)
+        search_index = index.index if isinstance(index, TombstoneFilterIndex) else index
+        distances, labels = search_index.search(query, min(k, len(positions)),
+                                                params=_selector_params(index, positions))
+        hits = [(int(pos), float(dist)) for pos, dist in zip(labels[0], distances[0]) if pos >= 0]
+
+    results = []
+    for pos, score in hits:
+        doc = vectorstore.docstore._dict.get(vectorstore.index_to_docstore_id.get(pos))
+        if doc is not None:
+            results.append((doc, score))
+    return results
+
@@ -0,0 +1,116 @@
+"""
+测试公共夹具：知识库存储隔离到临时目录，Embedding API 用确定性的假向量代替。
+"""
+import hashlib
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from src import chunk_store, db, embeddings, storage  # noqa: E402
+from src.embedding_cache import embedding_cache  # noqa: E402
+from src.kb_cache import kb_cache  # noqa: E402
+from src.query_embedding import query_embedder  # noqa: E402
+from src.retrieval_cache import retrieval_cache  # noqa: E402
+
+DIM = 32
+
+
+def fake_vector(text: str) -> list:
+    """按文本哈希生成的固定向量，同一文本每次相同。"""
+    seed = int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).standard_normal(DIM).astype("float32").tolist()
+
+
+class _Response:
+    status_code = 200
+
+    def __init__(self, data):
+        self._data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._data
+
+
+class FakeEmbeddingAPI:
+    """替换 requests.post，记录请求次数与输入条数。"""
+
+    def __init__(self):
+        self.requests = 0
+        self.inputs = 0
+
+    def __call__(self, url, headers=None, json=None, timeout=None, **kwargs):
+        items = json["input"] if isinstance(json["input"], list) else [json["input"]]
+        self.requests += 1
+        self.inputs += len(items)
+        return _Response({"data": [{"index": i, "embedding": fake_vector(t)} for i, t in enumerate(items)]})
+
+
+@pytest.fixture
+def kb_storage(tmp_path, monkeypatch):
+    """知识库、Embedding 缓存都写到临时目录，进程级缓存清空。"""
+    for module in (db, chunk_store, storage):
+        monkeypatch.setattr(module, "STORAGE_DIR", tmp_path)
+    monkeypatch.setattr(embedding_cache, "db_path", tmp_path / "embedding_cache.db")
+    kb_cache.clear()
+    retrieval_cache.clear()
+    query_embedder.clear()
+    yield tmp_path
+    kb_cache.clear()
+    retrieval_cache.clear()
+
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    api = FakeEmbeddingAPI()
+    monkeypatch.setattr(embeddings.requests, "post", api)
+    monkeypatch.setattr(embeddings.embedding_rate_limiter.requests, "rate", 0)
+    monkeypatch.setattr(embeddings.embedding_rate_limiter.tokens, "rate", 0)
+    return api
+
+
+def make_docs(source: str, texts) -> list:
+    from langchain_core.documents import Document
+
+    return [Document(page_content=text, metadata={"source": source, "page": i}) for i, text in enumerate(texts)]
+
+
+def paragraph(tag: str, i: int) -> str:
+    """互不相似的段落文本 (MinHash 去重不会误判)。"""
+    digest = hashlib.sha256(f"{tag}-{i}".encode("utf-8")).hexdigest()
+    return f"{tag} 第 {i} 段：{digest} {digest[::-1]}"
+
+
+def vector_ids(kb_name: str) -> set:
+    """向量库中未删除的片段 id。"""
+    path = storage.STORAGE_DIR / f"{kb_name}_faiss"
+    if not path.exists():
+        return set()
+    vectorstore, _ = storage._load_vectorstore(path, embeddings.HunyuanEmbeddings(), mmap=False)
+    return {int(doc_id) for doc_id in vectorstore.docstore._dict}
+
+
+def bm25_ids(kb_name: str) -> set:
+    import sqlite3
+
+    conn = sqlite3.connect(str(chunk_store.chunk_db_path(kb_name)))
+    try:
+        return {row[0] for row in conn.execute("SELECT doc_id FROM bm25_doclen")}
+    finally:
+        conn.close()
+
+
+def assert_aligned(kb_name: str):
+    """片段库、BM25 倒排与向量库中的片段 id 完全一致。"""
+    chunk_ids = set(chunk_store.list_chunk_ids(kb_name))
+    assert bm25_ids(kb_name) == chunk_ids
+    assert vector_ids(kb_name) == chunk_ids
+    return chunk_ids
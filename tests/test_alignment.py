@@ -0,0 +1,37 @@
+from src import storage
+
+from conftest import assert_aligned, make_docs, paragraph, vector_ids
+
+
+def test_save_delete_upsert_keep_ids_aligned(kb_storage, fake_api):
+    storage.save_kb("kb", make_docs("a.pdf", [paragraph("A", i) for i in range(6)]))
+    storage.save_kb("kb", make_docs("b.pdf", [paragraph("B", i) for i in range(4)]))
+    assert assert_aligned("kb") == set(range(10))
+
+    storage.delete_document("kb", "a.pdf")
+    assert assert_aligned("kb") == set(range(6, 10))
+
+    storage.save_kb("kb", make_docs("c.pdf", [paragraph("C", i) for i in range(3)]))
+    assert assert_aligned("kb") == set(range(6, 13))
+
+    storage.upsert_document("kb", "b.pdf", make_docs("b.pdf", [paragraph("B2", i) for i in range(2)]))
+    assert assert_aligned("kb") == {10, 11, 12, 13, 14}
+
+
+def test_resume_fills_missing_vectors(kb_storage, fake_api, monkeypatch):
+    call_api = storage.HunyuanEmbeddings._call_api_batch
+
+    def _fail_b(self, texts):
+        if any(text.startswith("B ") for text in texts):
+            raise ValueError("invalid input")
+        return call_api(self, texts)
+
+    storage.save_kb("kb", make_docs("a.pdf", [paragraph("A", i) for i in range(4)]))
+    monkeypatch.setattr(storage.HunyuanEmbeddings, "_call_api_batch", _fail_b)
+    result = storage.save_kb("kb", make_docs("b.pdf", [paragraph("B", i) for i in range(4)]))
+    assert result["chunks"] == 4 and result["vectors"] == 0
+    assert vector_ids("kb") == set(range(4))
+
+    monkeypatch.setattr(storage.HunyuanEmbeddings, "_call_api_batch", call_api)
+    assert storage.resume_kb_embedding("kb", batch_size=3) == (8, 8)
+    assert assert_aligned("kb") == set(range(8))
@@ -0,0 +1,52 @@
+import pytest
+
+from src.bm25 import PersistentBM25Index
+
+DOCS = [
+    (0, "向量检索 使用 FAISS 索引"),
+    (1, "BM25 关键词检索 倒排索引"),
+    (2, "知识库 文档 切分 与 向量化"),
+    (3, "倒排索引 的 增量 更新"),
+]
+
+
+def _index(tmp_path, name="bm25.db"):
+    return PersistentBM25Index(tmp_path / name, tokenizer="bigram")
+
+
+def _scores(index, query):
+    return {doc_id: pytest.approx(score) for doc_id, score in index.search(query, k=10)}
+
+
+def test_incremental_add_matches_full_build(tmp_path):
+    incremental = _index(tmp_path)
+    assert incremental.add_documents(DOCS[:2]) == 2
+    assert incremental.add_documents(DOCS[2:]) == 2
+    # 已索引的 id 再次写入被跳过
+    assert incremental.add_documents(DOCS[:1]) == 0
+    assert incremental.next_doc_id() == 4
+
+    full = _index(tmp_path, "full.db")
+    full.add_documents(DOCS)
+    assert _scores(incremental, "倒排索引") == _scores(full, "倒排索引")
+    assert {doc_id for doc_id, _ in incremental.search("倒排索引", k=2)} == {1, 3}
+
+
+def test_remove_matches_build_without_document(tmp_path):
+    index = _index(tmp_path)
+    index.add_documents(DOCS)
+    assert index.remove_documents([(1, DOCS[1][1])]) == 1
+    assert index.remove_documents([(1, DOCS[1][1])]) == 0
+    assert 1 not in dict(index.search("BM25 倒排索引", k=10))
+
+    rebuilt = _index(tmp_path, "rebuilt.db")
+    rebuilt.add_documents([DOCS[0]])
+    rebuilt.add_documents(DOCS[2:])
+    assert _scores(index, "倒排索引 向量") == _scores(rebuilt, "倒排索引 向量")
+
+
+def test_search_restricted_to_candidates(tmp_path):
+    index = _index(tmp_path)
+    index.add_documents(DOCS)
+    assert [doc_id for doc_id, _ in index.search("倒排索引", k=10, doc_ids=[3, 2])] == [3]
+    assert index.search("倒排索引", k=10, doc_ids=[]) == []
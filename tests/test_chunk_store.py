@@ -0,0 +1,38 @@
+import sqlite3
+
+from src import chunk_store
+
+
+def _records(source, n):
+    return [{"page_content": f"{source} 第 {i} 段", "metadata": {"source": source, "page": i}} for i in range(n)]
+
+
+def test_read_paths_do_not_write(kb_storage, monkeypatch):
+    chunk_store.append_chunks("kb", _records("a.pdf", 5))
+    # 模拟新进程首次打开已是最新结构的库，同时另一个连接持有写锁
+    monkeypatch.setattr(chunk_store, "_schema_ready", set())
+    open_ = chunk_store._open
+
+    def _open_short_timeout(path):
+        conn = open_(path)
+        conn.execute("PRAGMA busy_timeout = 100")
+        return conn
+
+    monkeypatch.setattr(chunk_store, "_open", _open_short_timeout)
+    writer = sqlite3.connect(str(chunk_store.chunk_db_path("kb")))
+    writer.execute("BEGIN IMMEDIATE")
+    try:
+        assert chunk_store.get_manifest("kb")["chunk_count"] == 5
+        assert [item["id"] for item in chunk_store.iter_chunks("kb")] == [0, 1, 2, 3, 4]
+        assert chunk_store.list_sources("kb")[0]["chunk_count"] == 5
+    finally:
+        writer.rollback()
+        writer.close()
+
+
+def test_schema_created_on_first_open_and_after_delete(kb_storage):
+    chunk_store.append_chunks("kb", _records("a.pdf", 2))
+    chunk_store.delete_chunk_store("kb")
+    assert chunk_store.get_manifest("kb")["chunk_count"] == 0
+    assert chunk_store.append_chunks("kb", _records("b.pdf", 3)) == [0, 1, 2]
+    assert chunk_store.filter_chunk_ids("kb", {"page": {"$eq": 1}}) == [1]
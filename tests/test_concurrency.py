@@ -0,0 +1,15 @@
+import httpx
+
+from src.concurrency import AdaptiveConcurrencyController, AdaptiveTransport
+
+
+def test_transport_releases_slot_before_stream_ends():
+    controller = AdaptiveConcurrencyController("test", initial=1, max_limit=1)
+    inner = httpx.MockTransport(lambda request: httpx.Response(200, content=b"data: x\n\n" * 3))
+    client = httpx.Client(transport=AdaptiveTransport(controller, inner))
+    with client.stream("POST", "http://llm/chat") as first:
+        # 流式响应尚未读完，槽位已释放，第二个请求不会被挡住
+        assert controller.in_flight == 0
+        assert client.post("http://llm/chat").status_code == 200
+        assert b"".join(first.iter_bytes())
+    assert controller.in_flight == 0
@@ -0,0 +1,39 @@
+from src import chunk_store, storage
+from src.dedup import get_duplicate_links
+
+from conftest import assert_aligned, make_docs, paragraph
+
+
+def _source_counts(kb_name):
+    return {item["name"]: item["chunk_count"] for item in chunk_store.list_sources(kb_name)}
+
+
+def test_delete_canonical_restores_linked_duplicates(kb_storage, fake_api):
+    a_texts = [paragraph("A", i) for i in range(30)]
+    storage.save_kb("kb", make_docs("a.pdf", a_texts))
+    # b.pdf 的前 10 段与 a.pdf 相同，入库时折叠为重复记录
+    result = storage.save_kb("kb", make_docs("b.pdf", a_texts[:10] + [paragraph("B", i) for i in range(5)]))
+    assert result == {"chunks": 5, "vectors": 5, "duplicates": 10}
+    assert _source_counts("kb") == {"a.pdf": 30, "b.pdf": 5}
+
+    removed = storage.delete_document("kb", "a.pdf")
+    assert removed["chunks"] == 30
+    assert removed["restored"] == 10
+    assert _source_counts("kb") == {"b.pdf": 15}
+    contents = {item["page_content"] for item in chunk_store.iter_chunks("kb")}
+    assert set(a_texts[:10]) <= contents
+    assert len(assert_aligned("kb")) == 15
+    assert get_duplicate_links("kb") == {}
+
+
+def test_delete_duplicate_source_drops_its_links(kb_storage, fake_api):
+    a_texts = [paragraph("A", i) for i in range(6)]
+    storage.save_kb("kb", make_docs("a.pdf", a_texts))
+    storage.save_kb("kb", make_docs("b.pdf", a_texts[:3]))
+    assert sum(len(v) for v in get_duplicate_links("kb").values()) == 3
+
+    storage.delete_document("kb", "b.pdf")
+    assert get_duplicate_links("kb") == {}
+    # b.pdf 已删除，删除 a.pdf 时不应再恢复它的片段
+    assert storage.delete_document("kb", "a.pdf")["restored"] == 0
+    assert chunk_store.count_chunks("kb") == 0
@@ -0,0 +1,47 @@
+import requests
+
+from src import embeddings
+
+from conftest import fake_vector
+
+
+class _StatusAPI:
+    """每条输入里含 bad 时按 status 返回错误，其余正常。"""
+
+    def __init__(self, status, always=False):
+        self.status = status
+        self.always = always
+        self.requests = 0
+
+    def __call__(self, url, headers=None, json=None, timeout=None, **kwargs):
+        self.requests += 1
+        response = requests.Response()
+        if self.always or any("bad" in text for text in json["input"]):
+            response.status_code = self.status
+            response.raise_for_status = lambda: (_ for _ in ()).throw(requests.HTTPError(response=response))
+        else:
+            response.status_code = 200
+            data = {"data": [{"index": i, "embedding": fake_vector(t)} for i, t in enumerate(json["input"])]}
+            response.json = lambda: data
+            response.raise_for_status = lambda: None
+        return response
+
+
+def _embed(monkeypatch, api, texts):
+    monkeypatch.setattr(embeddings.requests, "post", api)
+    monkeypatch.setattr(embeddings.embedding_rate_limiter.requests, "rate", 0)
+    monkeypatch.setattr(embeddings.embedding_rate_limiter.tokens, "rate", 0)
+    return embeddings.HunyuanEmbeddings(api_key="test")._embed_batch(texts)
+
+
+def test_input_error_splits_to_the_bad_text(monkeypatch):
+    api = _StatusAPI(400)
+    result = _embed(monkeypatch, api, ["a", "b", "bad", "c"])
+    assert result[2] is None
+    assert [r is not None for r in result] == [True, True, False, True]
+
+
+def test_auth_error_fails_whole_batch_without_splitting(monkeypatch):
+    api = _StatusAPI(401, always=True)
+    assert _embed(monkeypatch, api, ["a", "b", "c", "d"]) == [None] * 4
+    assert api.requests == 1
@@ -0,0 +1,72 @@
+import faiss
+import numpy as np
+import pytest
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+
+from src import storage
+from src.embeddings import HunyuanEmbeddings
+from src.federated_search import FederatedVectorStore, normalize_score
+
+from conftest import fake_vector, make_docs, paragraph
+
+
+def _store(prefix, n, **kwargs):
+    texts = [f"{prefix} {i}" for i in range(n)]
+    return FAISS.from_embeddings(
+        [(t, fake_vector(t)) for t in texts], HunyuanEmbeddings(api_key="test"),
+        ids=[str(i) for i in range(n)], **kwargs,
+    )
+
+
+def test_normalize_score_is_larger_for_closer_vectors():
+    l2 = _store("a", 1)
+    assert normalize_score(l2, 0.0) == 1.0
+    assert normalize_score(l2, 0.5) > normalize_score(l2, 1.5)
+    ip = _store("b", 1, distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT)
+    assert ip.index.metric_type == faiss.METRIC_INNER_PRODUCT
+    assert normalize_score(ip, 0.7) == pytest.approx(0.7)
+
+
+def test_merge_matches_single_combined_search():
+    stores = [("kb1", _store("甲", 20)), ("kb2", _store("乙", 30)), ("kb3", _store("丙", 10))]
+    federated = FederatedVectorStore(stores, HunyuanEmbeddings(api_key="test"))
+    query = np.asarray(fake_vector("查询"), dtype="float32")
+
+    results = federated.similarity_search_with_relevance_by_vector(query.tolist(), k=8)
+    assert len(results) == 8
+    scores = [score for _, score in results]
+    assert scores == sorted(scores, reverse=True)
+
+    # 与把全部向量放在一起做精确检索的结果一致
+    expected = sorted(
+        ((1 - float(((query - np.asarray(fake_vector(doc.page_content))) ** 2).sum()) / 2, name, doc.page_content)
+         for name, vs in stores for doc in vs.docstore._dict.values()),
+        reverse=True,
+    )[:8]
+    assert [(doc.metadata["kb_name"], doc.page_content) for doc, _ in results] == [(n, t) for _, n, t in expected]
+    np.testing.assert_allclose(scores, [s for s, _, _ in expected], rtol=1e-4, atol=1e-4)
+    # 标注来源时不修改缓存中共享的 Document
+    assert all("kb_name" not in doc.metadata for _, vs in stores for doc in vs.docstore._dict.values())
+
+
+def test_metadata_filter_across_kbs(kb_storage, fake_api):
+    storage.save_kb("kb1", make_docs("a.pdf", [paragraph("A", i) for i in range(4)]))
+    storage.save_kb("kb2", make_docs("b.pdf", [paragraph("B", i) for i in range(4)]))
+    _, federated = storage.load_kbs(["kb1", "kb2"])
+    assert isinstance(federated, FederatedVectorStore)
+
+    docs = federated.similarity_search_by_vector(fake_vector("查询"), k=10, metadata_filter={"page": {"$lte": 1}})
+    assert sorted((d.metadata["kb_name"], d.metadata["page"]) for d in docs) == [
+        ("kb1", 0), ("kb1", 1), ("kb2", 0), ("kb2", 1),
+    ]
+    docs = federated.similarity_search_by_vector(fake_vector("查询"), k=10, metadata_filter={"source": "b.pdf"})
+    assert {d.metadata["kb_name"] for d in docs} == {"kb2"} and len(docs) == 4
+
+
+def test_read_only():
+    federated = FederatedVectorStore([("kb1", _store("甲", 2))], HunyuanEmbeddings(api_key="test"))
+    with pytest.raises(TypeError):
+        federated.add_texts(["新片段"])
+    with pytest.raises(TypeError):
+        FederatedVectorStore.from_texts(["新片段"], HunyuanEmbeddings(api_key="test"))
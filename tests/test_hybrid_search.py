@@ -0,0 +1,73 @@
+import pytest
+from langchain_core.documents import Document
+
+from src.hybrid_search import FUSION_RRF, FUSION_WEIGHTED, HybridRetriever, doc_key, fuse
+
+
+def _doc(chunk_id, kb_name="kb"):
+    return Document(page_content=f"片段 {chunk_id}", metadata={"kb_name": kb_name, "chunk_id": chunk_id})
+
+
+def _hits(ids, scores=None):
+    scores = scores or [1.0 / (i + 1) for i in range(len(ids))]
+    return [(_doc(i), s) for i, s in zip(ids, scores)]
+
+
+def _ids(results):
+    return [doc.metadata["chunk_id"] for doc, _ in results]
+
+
+def test_rrf_rewards_agreement_between_retrievers():
+    # 2 在两路中都排第二，应超过只在一路排第一的 1 与 3
+    ranked = {"vector": _hits([1, 2, 4]), "bm25": _hits([3, 2, 5])}
+    results = fuse(ranked, k=5, method=FUSION_RRF, rrf_k=60)
+    assert _ids(results)[0] == 2
+    assert results[0][1] == pytest.approx(2 / 62)
+    assert results[0][0].metadata["retrievers"] == ["vector", "bm25"]
+    # 同分时按首次出现的顺序
+    assert _ids(results)[1:] == [1, 3, 4, 5]
+    assert [score for _, score in results] == sorted((score for _, score in results), reverse=True)
+
+
+def test_rrf_ignores_score_scale_and_honours_weights():
+    ranked = {"vector": _hits([1, 2], [0.9, 0.8]), "bm25": _hits([2, 1], [1000.0, 1.0])}
+    assert _ids(fuse(ranked, k=2, method=FUSION_RRF)) == [1, 2]
+    weighted = fuse(ranked, k=2, method=FUSION_RRF, weights={"bm25": 2.0})
+    assert _ids(weighted) == [2, 1]
+
+
+def test_weighted_fusion_uses_normalized_scores():
+    ranked = {"vector": _hits([1, 2, 3], [0.9, 0.5, 0.1]), "bm25": _hits([3, 2], [12.0, 2.0])}
+    results = fuse(ranked, k=3, method=FUSION_WEIGHTED)
+    assert dict(zip(_ids(results), (s for _, s in results))) == {
+        3: pytest.approx(1.0), 1: pytest.approx(1.0), 2: pytest.approx(0.5),
+    }
+    with pytest.raises(ValueError):
+        fuse(ranked, k=3, method="max")
+
+
+def test_dedup_by_kb_and_chunk_id():
+    same_id_other_kb = _doc(1, kb_name="other")
+    assert doc_key(_doc(1)) != doc_key(same_id_other_kb)
+    assert doc_key(Document(page_content="无 id")) == ("content", "无 id")
+    ranked = {"vector": [(_doc(1), 1.0), (_doc(1), 0.5), (same_id_other_kb, 0.4)]}
+    results = fuse(ranked, k=5, method=FUSION_RRF, rrf_k=0)
+    assert [(d.metadata["kb_name"], d.metadata["chunk_id"]) for d, _ in results] == [("kb", 1), ("other", 1)]
+    # 同一路里重复出现只按最好的名次计一次
+    assert results[0][1] == pytest.approx(1.0)
+
+
+def test_retriever_survives_failing_source_and_routes_queries():
+    seen = {}
+
+    def _bm25(query, k):
+        seen["bm25"] = query
+        return _hits([2, 3])[:k]
+
+    def _broken(query, k):
+        raise RuntimeError("index offline")
+
+    retriever = HybridRetriever(top_k=2).add("vector", _broken, k=5).add("bm25", _bm25, k=5)
+    docs = retriever.invoke("问题", queries={"bm25": "问题 关键词"})
+    assert [d.metadata["chunk_id"] for d in docs] == [2, 3]
+    assert seen["bm25"] == "问题 关键词"
@@ -0,0 +1,35 @@
+import threading
+
+import pytest
+
+from src import chunk_store, storage
+from src.ingest_pipeline import IngestCancelled, run_ingest_pipeline
+
+from conftest import assert_aligned, paragraph
+
+
+def _contents(kb_name, source):
+    return [item["page_content"] for item in chunk_store.iter_chunks(kb_name) if item["metadata"]["source"] == source]
+
+
+def test_pipeline_replace_and_cancel(kb_storage, fake_api, tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_text("\n\n".join(paragraph("N", i) for i in range(40)), encoding="utf-8")
+    run_ingest_pipeline("kb", [(str(path), "notes.txt")])
+    before = sorted(_contents("kb", "notes.txt"))
+
+    path.write_text("\n\n".join(paragraph("N2", i) for i in range(40)), encoding="utf-8")
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(IngestCancelled):
+        storage.replace_documents("kb", ["notes.txt"], lambda detector: run_ingest_pipeline(
+            "kb", [(str(path), "notes.txt")], cancel_event=cancel, detector=detector,
+        ))
+    assert sorted(_contents("kb", "notes.txt")) == before
+
+    result = storage.replace_documents("kb", ["notes.txt"], lambda detector: run_ingest_pipeline(
+        "kb", [(str(path), "notes.txt")], detector=detector,
+    ))
+    assert result["replaced"] == len(before)
+    assert all(text.startswith("N2") for text in _contents("kb", "notes.txt"))
+    assert_aligned("kb")
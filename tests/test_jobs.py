@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+from src.jobs import (
+    STATUS_CANCELLED,
+    STATUS_FAILED,
+    STATUS_QUEUED,
+    STATUS_RUNNING,
+    STATUS_SUCCEEDED,
+    TERMINAL_STATUSES,
+    JobManager,
+)
+
+
+def _wait_for(manager, job_id, statuses, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = manager.get(job_id)
+        if job["status"] in statuses:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"任务 {job_id} 未进入 {statuses}: {manager.get(job_id)['status']}")
+
+
+@pytest.fixture
+def manager(tmp_path):
+    # workers=0：不启动工作线程，由测试直接调用 _claim
+    manager = JobManager(tmp_path / "jobs.db", workers=0, max_per_kb=1, max_per_host=2)
+    manager.register("noop", lambda ctx: None)
+    return manager
+
+
+def test_claim_respects_kb_and_host_limits(manager):
+    a1 = manager.submit("noop", "a")
+    a2 = manager.submit("noop", "a")
+    b1 = manager.submit("noop", "b")
+    c1 = manager.submit("noop", "c")
+
+    assert manager._claim()["id"] == a1
+    # 知识库 a 已有运行中的任务，跳过 a2 领取 b1
+    assert manager._claim()["id"] == b1
+    # 本机已有 2 个运行中的任务
+    assert manager._claim() is None
+    assert manager.get(c1)["status"] == STATUS_QUEUED
+
+    manager._finish(a1, STATUS_SUCCEEDED)
+    assert manager._claim()["id"] == a2
+    assert manager.get(a2)["status"] == STATUS_RUNNING
+
+
+def test_cancel_queued_job_is_never_claimed(manager):
+    job_id = manager.submit("noop", "a")
+    assert manager.cancel(job_id)["status"] == STATUS_CANCELLED
+    assert manager._claim() is None
+
+
+def test_unknown_kind_rejected(manager):
+    with pytest.raises(ValueError):
+        manager.submit("missing", "a")
+
+
+def test_running_job_cancel_and_results(tmp_path):
+    manager = JobManager(tmp_path / "jobs.db", workers=2, max_per_kb=1, max_per_host=2)
+    started = threading.Event()
+
+    def _long(ctx):
+        started.set()
+        while True:
+            ctx.progress(1, 10)
+            ctx.check_cancelled()
+            time.sleep(0.01)
+
+    def _fail(ctx):
+        raise RuntimeError("解析失败")
+
+    manager.register("long", _long)
+    manager.register("ok", lambda ctx: {"chunks": ctx.params["n"]})
+    manager.register("fail", _fail)
+    try:
+        long_id = manager.submit("long", "a")
+        assert started.wait(5)
+        assert manager.cancel(long_id)["cancel_requested"]
+        assert _wait_for(manager, long_id, TERMINAL_STATUSES)["status"] == STATUS_CANCELLED
+
+        ok = _wait_for(manager, manager.submit("ok", "a", {"n": 3}), TERMINAL_STATUSES)
+        assert ok["status"] == STATUS_SUCCEEDED and ok["result"] == {"chunks": 3}
+        failed = _wait_for(manager, manager.submit("fail", "b"), TERMINAL_STATUSES)
+        assert failed["status"] == STATUS_FAILED and failed["error"] == "解析失败"
+    finally:
+        manager.stop()
@@ -0,0 +1,50 @@
+from src import storage
+from src.kb_cache import KBCache, kb_cache
+
+from conftest import make_docs, paragraph
+
+
+def _loader(value, size, calls):
+    def load():
+        calls.append(value)
+        return value, size
+    return load
+
+
+def test_version_change_reloads():
+    cache = KBCache(max_bytes=100)
+    calls = []
+    assert cache.get("kb", 1, _loader("v1", 10, calls)) == "v1"
+    assert cache.get("kb", 1, _loader("unused", 10, calls)) == "v1"
+    assert cache.get("kb", 2, _loader("v2", 10, calls)) == "v2"
+    assert calls == ["v1", "v2"]
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+
+def test_lru_eviction_by_bytes():
+    cache = KBCache(max_bytes=100)
+    calls = []
+    cache.get("a", 1, _loader("a", 40, calls))
+    cache.get("b", 1, _loader("b", 40, calls))
+    cache.get("a", 1, _loader("a", 40, calls))  # a 变为最近使用
+    cache.get("c", 1, _loader("c", 40, calls))  # 超出上限，淘汰最久未用的 b
+    assert cache.stats()["entries"] == ["a", "c"]
+    assert cache.stats()["evictions"] == 1
+    # 单个超过上限的知识库照常返回但不缓存
+    assert cache.get("huge", 1, _loader("huge", 500, calls)) == "huge"
+    assert "huge" not in cache.stats()["entries"]
+
+
+def test_load_kbs_invalidated_by_writes(kb_storage, fake_api):
+    storage.save_kb("kb", make_docs("a.pdf", [paragraph("A", i) for i in range(3)]))
+    assert len(storage.load_kbs(["kb"])[0]) == 3
+    hits = kb_cache.stats()["hits"]
+    assert len(storage.load_kbs(["kb"])[0]) == 3
+    assert kb_cache.stats()["hits"] == hits + 1
+
+    storage.save_kb("kb", make_docs("b.pdf", [paragraph("B", 0)]))
+    assert len(storage.load_kbs(["kb"])[0]) == 4
+    storage.delete_document("kb", "a.pdf")
+    assert len(storage.load_kbs(["kb"])[0]) == 1
+    storage.delete_kb("kb")
+    assert "kb" not in kb_cache.stats()["entries"]
@@ -0,0 +1,56 @@
+import pytest
+
+from src import chunk_store
+from src.metadata_filter import parse_filter
+
+
+def test_parse_filter_normalizes():
+    assert parse_filter(None) == {}
+    assert parse_filter({"source": "a.pdf", "page": {"$gte": "3", "$lt": 10}}) == {
+        "source": {"$eq": "a.pdf"},
+        "page": {"$gte": 3, "$lt": 10},
+    }
+    assert parse_filter({"source": {"$in": ["a.pdf", "b.pdf"]}}) == {"source": {"$in": ["a.pdf", "b.pdf"]}}
+    assert parse_filter({"source": {"$prefix": "2023"}}) == {"source": {"$prefix": "2023"}}
+
+
+@pytest.mark.parametrize("expr", [
+    ["source"],
+    {"author": "x"},
+    {"source": {}},
+    {"source": {"$regex": "a"}},
+    {"source": {"$in": []}},
+    {"page": True},
+    {"page": {"$prefix": "1"}},
+    {"page": {"$prefix": 1}},
+    {"source": {"$prefix": 2023}},
+    {"source": {"$eq": ["a.pdf"]}},
+])
+def test_parse_filter_rejects(expr):
+    with pytest.raises(ValueError):
+        parse_filter(expr)
+
+
+def test_filter_chunk_ids(kb_storage):
+    chunk_store.append_chunks("kb", [
+        {"page_content": f"{source} {page}", "metadata": {"source": source, "page": page, "language": "Chinese"}}
+        for source in ("a.pdf", "b.pdf") for page in range(3)
+    ])
+    assert chunk_store.filter_chunk_ids("kb", parse_filter({"source": "b.pdf"})) == [3, 4, 5]
+    assert chunk_store.filter_chunk_ids("kb", parse_filter({"source": {"$prefix": "a"}, "page": {"$gte": 1}})) == [1, 2]
+    assert chunk_store.filter_chunk_ids("kb", parse_filter({"page": {"$in": [0, 2]}, "language": "Chinese"})) == [0, 2, 3, 5]
+
+
+def test_ingested_at_filter(kb_storage, fake_api):
+    from datetime import date
+
+    from src import storage
+    from conftest import make_docs, paragraph
+
+    storage.save_kb("kb", make_docs("a.pdf", [paragraph("A", i) for i in range(3)]))
+    today = date.today().isoformat()
+    assert parse_filter({"ingested_at": today[:4]}) == {"ingested_at": {"$prefix": today[:4]}}
+    assert chunk_store.filter_chunk_ids("kb", parse_filter({"ingested_at": today[:7]})) == [0, 1, 2]
+    assert chunk_store.filter_chunk_ids("kb", parse_filter({"ingested_at": {"$lt": "2000-01-01"}})) == []
+    with pytest.raises(ValueError):
+        parse_filter({"date": "2023"})
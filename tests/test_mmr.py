@@ -0,0 +1,35 @@
+import numpy as np
+from langchain_core.documents import Document
+
+from src import chunk_store, storage
+from src.mmr import lookup_vectors, mmr_select
+
+from conftest import fake_vector, make_docs, paragraph
+
+
+def _docs(kb_name, ids):
+    records = chunk_store.get_chunks(kb_name, ids)
+    return [
+        Document(page_content=records[i]["page_content"], metadata={**records[i]["metadata"], "kb_name": kb_name})
+        for i in ids
+    ]
+
+
+def test_lookup_vectors_by_chunk_id(kb_storage, fake_api):
+    storage.save_kb("kb", make_docs("a.pdf", [paragraph("A", i) for i in range(6)]))
+    storage.save_kb("kb", make_docs("b.pdf", [paragraph("B", i) for i in range(3)]))
+    storage.delete_document("kb", "a.pdf")
+    _, vector_store = storage.load_kbs(["kb"])
+
+    docs = _docs("kb", [6, 7, 8])
+    docs.append(Document(page_content="无 id 的片段", metadata={"kb_name": "kb"}))
+    vectors = lookup_vectors(docs, vector_store)
+    for row, doc in zip(vectors[:3], docs[:3]):
+        np.testing.assert_allclose(row, fake_vector(doc.page_content), rtol=1e-5)
+    assert not vectors[3].any()
+
+
+def test_mmr_select_skips_near_duplicates():
+    base = np.array([1.0, 0.0, 0.0])
+    vectors = np.stack([base, base + [0, 0.01, 0], np.array([0.0, 1.0, 0.0])]).astype("float32")
+    assert mmr_select(np.array([1.0, 0.99, 0.5]), vectors, k=2, lambda_mult=0.5) == [0, 2]
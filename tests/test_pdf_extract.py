@@ -0,0 +1,91 @@
+import time
+
+import pypdf
+import pytest
+
+from src import pdf_extract
+from src.pdf_extract import PdfTextCache, iter_pdf_pages
+
+
+def _write_pdf(path, texts):
+    """生成每页一行 ASCII 文本的最小 PDF。"""
+    n = len(texts)
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [" + b" ".join(f"{3 + 2 * i} 0 R".encode() for i in range(n))
+        + f"] /Count {n} >>".encode(),
+    ]
+    font_id = 3 + 2 * n
+    for i, text in enumerate(texts):
+        stream = f"BT /F1 12 Tf 20 100 Td ({text}) Tj ET".encode()
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 200 200] /Contents {4 + 2 * i} 0 R "
+            f"/Resources << /Font << /F1 {font_id} 0 R >> >> >>".encode()
+        )
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n".encode() + stream + b"\nendstream")
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += b"".join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    path.write_bytes(bytes(out))
+    return str(path)
+
+
+@pytest.fixture
+def text_cache(tmp_path, monkeypatch):
+    cache = PdfTextCache(tmp_path / "pdf_text_cache.db")
+    monkeypatch.setattr(pdf_extract, "pdf_text_cache", cache)
+    monkeypatch.setattr(pdf_extract, "PDF_TEXT_CACHE_ENABLED", True)
+    return cache
+
+
+def test_pages_in_order_and_cached(tmp_path, text_cache):
+    path = _write_pdf(tmp_path / "a.pdf", ["Page zero", "Page one", "Page two"])
+    pages = list(iter_pdf_pages(path))
+    assert [i for i, _ in pages] == [0, 1, 2]
+    assert [text.strip() for _, text in pages] == ["Page zero", "Page one", "Page two"]
+    assert text_cache.stats()["misses"] == 1
+
+    # 同样内容的文件 (不同路径) 命中缓存
+    copy = _write_pdf(tmp_path / "copy.pdf", ["Page zero", "Page one", "Page two"])
+    assert list(iter_pdf_pages(copy)) == pages
+    assert text_cache.stats()["hits"] == 1
+
+
+def test_slow_page_times_out_and_is_not_cached(tmp_path, text_cache, monkeypatch):
+    extract_text = pypdf.PageObject.extract_text
+
+    def _slow_second_page(page, *args, **kwargs):
+        text = extract_text(page, *args, **kwargs)
+        if "slow" in text:
+            time.sleep(5)
+        return text
+
+    monkeypatch.setattr(pypdf.PageObject, "extract_text", _slow_second_page)
+    path = _write_pdf(tmp_path / "b.pdf", ["fast", "slow", "fast again"])
+    start = time.monotonic()
+    texts = [text.strip() for _, text in iter_pdf_pages(path, page_timeout=0.2)]
+    assert time.monotonic() - start < 3
+    assert texts == ["fast", "", "fast again"]
+    # 有失败页面时不写缓存，下次重新解析
+    assert text_cache.get(pdf_extract.file_hash(path)) is None
+
+
+def test_parallel_extraction_matches_serial(tmp_path, text_cache, monkeypatch):
+    texts = [f"Page {i}" for i in range(5)]
+    path = _write_pdf(tmp_path / "c.pdf", texts)
+    monkeypatch.setattr(pdf_extract, "PDF_EXTRACT_WORKERS", 2)
+    monkeypatch.setattr(pdf_extract, "PDF_PARALLEL_MIN_PAGES", 1)
+    monkeypatch.setattr(pdf_extract, "PDF_PAGES_PER_TASK", 2)
+    try:
+        pages = list(iter_pdf_pages(path, use_cache=False))
+    finally:
+        pdf_extract.shutdown_pool()
+    assert [(i, text.strip()) for i, text in pages] == list(enumerate(texts))
@@ -0,0 +1,41 @@
+import asyncio
+
+from src.query_embedding import QueryEmbeddingService
+
+from conftest import fake_vector
+
+
+def test_short_batch_result_resolves_every_query():
+    service = QueryEmbeddingService(window_ms=0)
+    assert service.embed("查询", lambda texts: []) is None
+    assert not service._inflight
+    # 失败不缓存，下次重新请求
+    assert service.embed("查询", lambda texts: [fake_vector(t) for t in texts]) == fake_vector("查询")
+
+
+def test_batch_fn_error_resolves_every_query():
+    service = QueryEmbeddingService(window_ms=0)
+
+    def _fail(texts):
+        raise RuntimeError("boom")
+
+    assert service.embed("查询", _fail) is None
+    assert not service._inflight
+    assert service.stats()["failures"] == 1
+
+
+def test_aembed_runs_async_batch_on_caller_loop():
+    service = QueryEmbeddingService(window_ms=20)
+    loops = []
+
+    async def _batch(texts):
+        loops.append(asyncio.get_running_loop())
+        return [fake_vector(t) for t in texts]
+
+    async def _main():
+        results = await asyncio.gather(service.aembed("甲", _batch), service.aembed("乙", _batch))
+        return asyncio.get_running_loop(), results
+
+    loop, results = asyncio.run(_main())
+    assert results == [fake_vector("甲"), fake_vector("乙")]
+    assert loops == [loop]
@@ -0,0 +1,52 @@
+import pytest
+
+from src import chunk_store, storage
+
+from conftest import assert_aligned, make_docs, paragraph
+
+
+def _contents(kb_name, source):
+    return [item["page_content"] for item in chunk_store.iter_chunks(kb_name) if item["metadata"]["source"] == source]
+
+
+def test_upsert_replaces_document(kb_storage, fake_api):
+    storage.save_kb("kb", make_docs("a.pdf", [paragraph("A", i) for i in range(8)]))
+    storage.save_kb("kb", make_docs("b.pdf", [paragraph("B", i) for i in range(4)]))
+
+    # 新版本保留旧版本的前 3 段：它们不应被折叠到即将删除的旧片段上
+    new_texts = [paragraph("A", i) for i in range(3)] + [paragraph("A2", i) for i in range(3)]
+    result = storage.upsert_document("kb", "a.pdf", make_docs("ignored", new_texts))
+    assert result["replaced"] == 8
+    assert result["chunks"] == 6
+    assert _contents("kb", "a.pdf") == new_texts
+    assert len(_contents("kb", "b.pdf")) == 4
+    assert len(assert_aligned("kb")) == 10
+
+
+def test_failed_replace_keeps_old_version(kb_storage, fake_api):
+    old_texts = [paragraph("A", i) for i in range(5)]
+    storage.save_kb("kb", make_docs("a.pdf", old_texts))
+
+    def _ingest(detector):
+        storage.save_kb("kb", make_docs("a.pdf", [paragraph("A2", i) for i in range(4)]), detector=detector)
+        raise RuntimeError("解析中断")
+
+    with pytest.raises(RuntimeError):
+        storage.replace_documents("kb", ["a.pdf"], _ingest)
+    assert _contents("kb", "a.pdf") == old_texts
+    assert len(assert_aligned("kb")) == 5
+
+
+def test_replace_without_vectors_keeps_old_version(kb_storage, fake_api, monkeypatch):
+    old_texts = [paragraph("A", i) for i in range(5)]
+    storage.save_kb("kb", make_docs("a.pdf", old_texts))
+
+    def _broken_api(*args, **kwargs):
+        raise ValueError("invalid input")
+
+    monkeypatch.setattr(storage.HunyuanEmbeddings, "_call_api_batch", lambda self, texts: _broken_api())
+    with pytest.raises(RuntimeError):
+        storage.upsert_document("kb", "a.pdf", make_docs("a.pdf", [paragraph("A2", i) for i in range(3)]))
+    assert _contents("kb", "a.pdf") == old_texts
+    assert len(assert_aligned("kb")) == 5
+
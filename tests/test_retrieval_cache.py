@@ -0,0 +1,55 @@
+from langchain_core.documents import Document
+
+from src import chunk_store, storage
+from src.retrieval_cache import RetrievalCache, normalize_search_query
+
+from conftest import make_docs, paragraph
+
+
+def test_normalize_search_query():
+    assert normalize_search_query("什么是RAG？") == normalize_search_query("什么是 rag") == "什么是rag"
+    assert normalize_search_query("ＲＡＧ  检索，\n原理!") == normalize_search_query("rag检索原理")
+    assert normalize_search_query("") == ""
+
+
+def _cached_docs(kb_name):
+    """检索结果的样子：片段 metadata 带 kb_name 与 chunk_id。"""
+    return [
+        Document(page_content=item["page_content"],
+                 metadata={**item["metadata"], "kb_name": kb_name, "chunk_id": item["id"]})
+        for item in chunk_store.iter_chunks(kb_name)
+    ]
+
+
+def test_kb_version_change_misses(kb_storage, fake_api):
+    cache = RetrievalCache(max_entries=8, ttl=60, enabled=True)
+    storage.save_kb("kb", make_docs("a.pdf", [paragraph("A", i) for i in range(3)]))
+    key = cache.make_key(storage.kb_versions(["kb"]), "什么是RAG？", k=3)
+    docs = _cached_docs("kb")[:2]
+    cache.store(key, docs, {"keywords": ["rag"]})
+
+    hit = cache.lookup(cache.make_key(storage.kb_versions(["kb"]), "什么是 rag", k=3))
+    assert hit is not None
+    assert [d.page_content for d in hit[0]] == [d.page_content for d in docs]
+    assert hit[1] == {"keywords": ["rag"]}
+
+    # 写入新文档后版本戳变化，旧条目不再命中
+    storage.save_kb("kb", make_docs("b.pdf", [paragraph("B", 0)]))
+    assert cache.lookup(cache.make_key(storage.kb_versions(["kb"]), "什么是RAG？", k=3)) is None
+
+
+def test_deleted_chunks_and_invalidate_kb(kb_storage, fake_api):
+    cache = RetrievalCache(max_entries=8, ttl=60, enabled=True)
+    storage.save_kb("kb", make_docs("a.pdf", [paragraph("A", i) for i in range(3)]))
+    versions = storage.kb_versions(["kb"])
+    cache.store(cache.make_key(versions, "q1", k=3), _cached_docs("kb"))
+    cache.store(cache.make_key(versions, "q2", k=3), _cached_docs("kb"))
+
+    # 键未变但片段已被删除：按未命中处理并丢弃条目
+    chunk_store.delete_chunks("kb", [0])
+    assert cache.lookup(cache.make_key(versions, "q1", k=3)) is None
+    assert cache.stats()["entries"] == 1
+
+    cache.invalidate_kb("kb")
+    assert cache.stats()["entries"] == 0
+    assert cache.stats()["invalidations"] == 1
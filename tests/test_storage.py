@@ -0,0 +1,18 @@
+import numpy as np
+
+from src import storage
+
+from conftest import fake_vector, make_docs, paragraph
+
+
+def test_get_chunk_vector(kb_storage, fake_api):
+    texts = [paragraph("A", i) for i in range(5)]
+    storage.save_kb("kb", make_docs("a.pdf", texts))
+    storage.save_kb("kb", make_docs("b.pdf", [paragraph("B", 0)]))
+    storage.delete_document("kb", "a.pdf")
+
+    result = storage.get_chunk_vector("kb", 5)
+    assert result["exists"]
+    np.testing.assert_allclose(result["vector"], fake_vector(paragraph("B", 0)), rtol=1e-5)
+    assert not storage.get_chunk_vector("kb", 2)["exists"]
+    assert not storage.get_chunk_vector("kb", 99)["exists"]
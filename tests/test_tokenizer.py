@@ -0,0 +1,67 @@
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from src import tokenizer
+from src.process_pool import SpawnProcessPool
+from src.tokenizer import TOKENIZER_BIGRAM, TOKENIZER_JIEBA, bigram_tokens, check_mode, tokenize, tokenize_many
+
+
+def test_bigram_tokens():
+    assert bigram_tokens("向量检索 FAISS-Index 2024") == ["向量", "量检", "检索", "faiss", "index", "2024"]
+    assert bigram_tokens("字") == ["字"]
+    assert bigram_tokens("") == []
+
+
+def test_check_mode():
+    assert check_mode(TOKENIZER_BIGRAM) == TOKENIZER_BIGRAM
+    assert check_mode(None) == tokenizer.BM25_TOKENIZER
+    with pytest.raises(ValueError):
+        check_mode("whitespace")
+
+
+def test_pool_tokenization_matches_serial(monkeypatch):
+    texts = [f"第 {i} 段：知识库检索与向量化" for i in range(7)]
+    monkeypatch.setattr(tokenizer, "TOKENIZE_PARALLEL_MIN", 1)
+    monkeypatch.setattr(tokenizer, "TOKENIZE_TASK_SIZE", 3)
+    monkeypatch.setattr(tokenizer, "_pool", SpawnProcessPool(1, initializer=tokenizer._init_worker, initargs=("",)))
+    try:
+        assert tokenize_many(texts, TOKENIZER_JIEBA) == [tokenize(t, TOKENIZER_JIEBA) for t in texts]
+        assert tokenizer.tokenize_async(texts[:2], TOKENIZER_JIEBA).result() == [
+            tokenize(t, TOKENIZER_JIEBA) for t in texts[:2]
+        ]
+    finally:
+        tokenizer.shutdown_pool()
+
+
+class _BrokenPool:
+    def submit(self, *args, **kwargs):
+        raise BrokenProcessPool("worker died")
+
+
+def test_broken_pool_falls_back_and_resets(monkeypatch):
+    resets = []
+    pool = SpawnProcessPool(1)
+    monkeypatch.setattr(pool, "get", lambda: _BrokenPool())
+    monkeypatch.setattr(pool, "reset", lambda: resets.append(True))
+    monkeypatch.setattr(tokenizer, "_pool", pool)
+    monkeypatch.setattr(tokenizer, "TOKENIZE_PARALLEL_MIN", 1)
+
+    texts = ["分词失败后在当前进程完成", "第二段"]
+    expected = [tokenize(t, TOKENIZER_JIEBA) for t in texts]
+    assert tokenize_many(texts, TOKENIZER_JIEBA) == expected
+    assert tokenizer.tokenize_async(texts, TOKENIZER_JIEBA).result() == expected
+    assert len(resets) == 2
+
+
+def test_spawn_pool_is_lazy_and_rebuilt_after_reset():
+    pool = SpawnProcessPool(1)
+    assert pool._pool is None
+    first = pool.get()
+    assert pool.get() is first
+    pool.reset()
+    assert pool._pool is None
+    second = pool.get()
+    assert second is not first
+    assert second.submit(sum, [1, 2, 3]).result() == 6
+    pool.shutdown()
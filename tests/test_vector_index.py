@@ -0,0 +1,134 @@
+import faiss
+import numpy as np
+import pytest
+from langchain_community.vectorstores import FAISS
+
+from src import vector_index
+from src.embeddings import HunyuanEmbeddings
+from src.vector_index import (
+    INDEX_FLAT,
+    INDEX_HNSW,
+    INDEX_IVF_FLAT,
+    INDEX_IVF_PQ,
+    RescoringIndex,
+    build_index,
+    choose_index_params,
+    choose_pq_m,
+    convert_index,
+    create_vectorstore,
+    docstore_positions,
+    index_type_of,
+    remove_from_vectorstore,
+    resolve_index_params,
+    wrap_for_search,
+)
+
+from conftest import fake_vector
+
+
+def _flat_store(n):
+    texts = [f"片段 {i}" for i in range(n)]
+    return FAISS.from_embeddings(
+        [(t, fake_vector(t)) for t in texts], HunyuanEmbeddings(api_key="test"),
+        ids=[str(i) for i in range(n)],
+    )
+
+
+def test_docstore_positions_follow_tombstones():
+    store = _flat_store(4)
+    assert docstore_positions(store) == {"0": 0, "1": 1, "2": 2, "3": 3}
+
+    # 打墓碑不改变序号映射的条目数，缓存不能返回已删除的片段
+    remove_from_vectorstore(store, ["1"])
+    assert docstore_positions(store) == {"0": 0, "2": 2, "3": 3}
+    store.docstore._dict.pop("3")
+    assert docstore_positions(store) == {"0": 0, "2": 2}
+
+
+def _random_vectors(n, dim=16, seed=0):
+    return np.random.default_rng(seed).standard_normal((n, dim)).astype("float32")
+
+
+def test_auto_index_type_by_size(monkeypatch):
+    monkeypatch.setattr(vector_index, "ANN_AUTO_THRESHOLD", 1000)
+    assert choose_index_params(999, "auto") == {"index_type": INDEX_FLAT}
+    params = choose_index_params(5000, "auto")
+    assert params["index_type"] == INDEX_IVF_FLAT
+    assert 16 <= params["nlist"] <= 5000 // vector_index.IVF_MIN_POINTS_PER_CENTROID
+    # 数据太少时 IVF 没有意义，退回 flat
+    assert choose_index_params(100, INDEX_IVF_FLAT) == {"index_type": INDEX_FLAT}
+    with pytest.raises(ValueError):
+        choose_index_params(100, "lsh")
+
+
+def test_resolve_keeps_recorded_training_params():
+    recorded = {"index_type": INDEX_IVF_FLAT, "nlist": 40, "nprobe": 8, "requested_type": INDEX_IVF_FLAT}
+    params = resolve_index_params(recorded, 50000)
+    assert params["nlist"] == 40 and params["nprobe"] == 8
+
+
+@pytest.mark.parametrize("index_type", [INDEX_IVF_FLAT, INDEX_HNSW])
+def test_ann_index_finds_stored_vectors(index_type):
+    vectors = _random_vectors(2000)
+    params = choose_index_params(len(vectors), index_type)
+    assert params["index_type"] == index_type
+    index = build_index(vectors, params)
+    index.add(vectors)
+    assert index_type_of(index) == index_type
+    _, labels = index.search(vectors[:50], 1)
+    assert (labels[:, 0] == np.arange(50)).mean() >= 0.9
+
+
+def test_convert_flat_to_hnsw_keeps_ids():
+    vectors = _random_vectors(300)
+    texts = [f"片段 {i}" for i in range(len(vectors))]
+    store = FAISS.from_embeddings(
+        list(zip(texts, vectors.tolist())), HunyuanEmbeddings(api_key="test"), ids=[str(i) for i in range(len(vectors))],
+    )
+    assert convert_index(store, choose_index_params(len(vectors), INDEX_HNSW))
+    assert index_type_of(store.index) == INDEX_HNSW
+    docs = store.similarity_search_by_vector(vectors[7].tolist(), k=1)
+    assert docs[0].page_content == "片段 7"
+    assert not convert_index(store, choose_index_params(len(vectors), INDEX_HNSW))
+
+
+def test_choose_pq_m_divides_dim():
+    assert choose_pq_m(1024, 64) == 64
+    assert choose_pq_m(48, 64) == 48
+    assert choose_pq_m(100, 64) == 50
+    # 样本不足以训练码本时不压缩
+    assert choose_index_params(1000, INDEX_IVF_PQ)["index_type"] != INDEX_IVF_PQ
+
+
+def test_pq_index_with_exact_rescoring(tmp_path, monkeypatch):
+    # 缩小训练量下限，测试里只需要码本能训练出来
+    monkeypatch.setattr(vector_index, "PQ_MIN_TRAIN_POINTS", 2000)
+    vectors = _random_vectors(2000, dim=16)
+    texts = [f"片段 {i}" for i in range(len(vectors))]
+    params = {**choose_index_params(len(vectors), INDEX_IVF_PQ), "pq_bytes": 4, "opq": False}
+    assert params["index_type"] == INDEX_IVF_PQ
+    store = create_vectorstore(
+        list(zip(texts, vectors.tolist())), [{} for _ in texts], HunyuanEmbeddings(api_key="test"),
+        params, vector_path=tmp_path, ids=[str(i) for i in range(len(vectors))],
+    )
+    assert index_type_of(store.index) == INDEX_IVF_PQ
+    assert store.index.ntotal == len(vectors)
+    # 冷文件保存原始向量，重排后的召回率不低于只用 PQ 编码
+    np.testing.assert_array_equal(vector_index.load_cold_vectors(tmp_path, 16), vectors)
+    assert params["recall_at_10_rerank"] >= params["recall_at_10"]
+
+    wrapped = wrap_for_search(store.index, params, tmp_path)
+    assert isinstance(wrapped, RescoringIndex)
+    distances, labels = wrapped.search(vectors[:20], 1)
+    assert (labels[:, 0] == np.arange(20)).mean() >= 0.9
+    np.testing.assert_allclose(distances[labels[:, 0] == np.arange(20), 0], 0, atol=1e-4)
+
+
+def test_rescoring_reorders_candidates_by_exact_distance():
+    coarse = faiss.IndexFlatL2(2)
+    coarse.add(np.array([[0, 0], [1, 0], [2, 0]], dtype="float32"))
+    # 冷文件中的原始向量与粗排索引不同，最终顺序以原始向量为准
+    cold = np.array([[5, 0], [0, 0], [1, 0]], dtype="float32")
+    distances, labels = RescoringIndex(coarse, cold, rerank_factor=3).search(np.zeros((1, 2), dtype="float32"), 2)
+    assert labels.tolist() == [[1, 2]]
+    np.testing.assert_allclose(distances, [[0, 1]])